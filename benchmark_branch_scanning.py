@@ -0,0 +1,457 @@
+#! /usr/bin/env python
+
+# script for benchmarking scan_unmerged_branches
+
+# Standard Imports
+from optparse import OptionParser
+from collections import namedtuple
+import multiprocessing
+import contextlib
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import platform
+import asyncio
+import threading
+import time
+import tracemalloc
+import scan_unmerged_branches
+try:
+    import resource
+except ImportError:  # windows, runs are measured without peak rss
+    resource = None
+
+# the commit representation used before CommitRecord, for comparison
+LEGACY_COMMIT_DETAILS = namedtuple('COMMIT_DETAILS', ['hash', 'date', 'author', 'subject'])
+
+
+def make_batch_log_lines(n_commits, n_authors=50, seed=0):
+    """lines like `git log --format=BATCH_COMMIT_FRMT` of one long branch, newest first"""
+    rnd = random.Random(seed)
+    authors = ['developer{}@example.com'.format(i) for i in range(n_authors)]
+    now = int(time.time())
+    hashes = ['{:040x}'.format(rnd.getrandbits(160)) for _ in range(n_commits + 1)]
+    lines = []
+    for i in range(n_commits):
+        timestamp = str(now - 30 * 86400 - 60 * i)
+        # new strings for every line, like reading them from git output
+        author = ''.join(list(rnd.choice(authors)))
+        subject = 'change number {} of the synthetic branch'.format(i)
+        lines.append('|'.join([hashes[i], hashes[i + 1], timestamp, '+0200', author, subject]))
+    return lines
+
+
+def legacy_report(lines):
+    """collect commits as namedtuples, then convert each one to a dict (how reports were built before)"""
+    commits = []
+    for line in lines:
+        hash_, parent_hashes, timestamp, utc_offset, author, subject = line.split('|', 5)
+        commits.append(LEGACY_COMMIT_DETAILS(hash_, scan_unmerged_branches.CommitRecord.from_git(
+            hash_, timestamp, utc_offset, author, subject).date, author, subject))
+    dict_by_author = {}
+    for commit in commits:
+        commit_dict = dict(commit._asdict())
+        dict_by_author.setdefault(commit_dict.pop('author'), []).append(commit_dict)
+    return commits, dict_by_author
+
+
+def compact_report(lines):
+    sub = scan_unmerged_branches.ScanUnmergedBranches()
+    commits, parents = scan_unmerged_branches.SubprocessGitBackend.parse_batch_log(lines)
+    del parents  # only needed while attributing commits to branches
+    commits = list(commits.values())
+    return commits, sub.create_report_by_branch({'origin/synthetic': commits})
+
+
+def measure_peak_memory(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {'current_bytes': current, 'peak_bytes': peak}
+
+
+def benchmark_commit_memory(n_commits):
+    lines = make_batch_log_lines(n_commits)
+    results = {
+        'commits': n_commits,
+        'legacy': measure_peak_memory(legacy_report, lines),
+        'compact': measure_peak_memory(compact_report, lines),
+    }
+    results['reduction'] = round(1 - results['compact']['current_bytes'] / results['legacy']['current_bytes'], 3)
+    return results
+
+
+def make_scan_results(n_branches, n_repos=100, n_authors=50, max_age_days=365, seed=0):
+    """multi-scan results (like scan_multiple builds them) of n_branches stale branches spread over n_repos repos"""
+    rnd = random.Random(seed)
+    authors = ['developer{}@example.com'.format(i) for i in range(n_authors)]
+    now = int(time.time())
+    results = []
+    for r in range(n_repos):
+        for target in ('main', 'develop'):
+            report = {}
+            for b in range(r * 2 + (target == 'develop'), n_branches, n_repos * 2):
+                commits_by_author = {}
+                for c in range(rnd.randint(1, 4)):
+                    author = rnd.choice(authors)
+                    timestamp = now - rnd.randint(8, max_age_days) * 86400
+                    commits_by_author.setdefault(author, []).append(scan_unmerged_branches.CommitRecord(
+                        '{:040x}'.format(rnd.getrandbits(160)), timestamp, 0, author, 'commit {}'.format(c)))
+                report['origin/feature/branch-{:06d}'.format(b)] = commits_by_author
+            results.append({'branch': target, 'repo_dir': '/repos/repo-{}'.format(r), 'report': report, 'kwargs': {}})
+    return results
+
+
+def legacy_aggregations(results_by_branch, now):
+    """group by repo, by email and build the pipeline report by walking the results for each (how it was done before)"""
+    sub = scan_unmerged_branches.ScanUnmergedBranches
+    results_by_repo = {}
+    for result_by_branch in results_by_branch:
+        repo_dict = results_by_repo.setdefault(result_by_branch['repo_dir'], {})
+        repo_dict[result_by_branch['branch']] = result_by_branch['report']
+    results_by_email = {}
+    for result_by_branch in results_by_branch:
+        for branch, commits_by_author in result_by_branch['report'].items():
+            for author, commits_list in commits_by_author.items():
+                author_dict = results_by_email.setdefault(author, {})
+                repo_dict = author_dict.setdefault(result_by_branch['repo_dir'], {})
+                repo_dict[result_by_branch['branch']] = commits_list
+    pipeline_results = {'scans': {}}
+    message_lines = []
+    for result_by_branch in sorted(results_by_branch, key=lambda r: (os.path.basename(r['repo_dir']), r['branch'])):
+        scan_id = '<{}>:{}'.format(os.path.basename(result_by_branch['repo_dir']), result_by_branch['branch'])
+        if not result_by_branch['report']:
+            message_lines.append(' - {} *fresh*'.format(scan_id))
+            continue
+        pipeline_results['scans'][scan_id] = result_by_branch['report']
+        message_lines.append(' - {}'.format(scan_id))
+        for branch, commits_by_author in result_by_branch['report'].items():
+            for author, commits_list in commits_by_author.items():
+                latest_timestamp = sub.extract_latest_timestamp_from_commits(commits_list)
+                message_lines.append('    * {} ({} days)'.format(branch, sub.days_between(latest_timestamp, now)))
+    pipeline_results['message'] = '\n'.join(message_lines)
+    return results_by_repo, results_by_email, pipeline_results
+
+
+def facts_aggregations(results_by_branch, now):
+    facts = scan_unmerged_branches.ScanFacts(results_by_branch)
+    return facts.by_repo(), facts.by_email(), facts.pipeline_report(now)
+
+
+def benchmark_aggregation(n_branches, repeat=3):
+    """time the groupings of multi-scan results of n_branches branches, and check both ways give the same output"""
+    results_by_branch = make_scan_results(n_branches)
+    now = int(time.time())
+    timings = {}
+    outputs = {}
+    for name, func in (('legacy', legacy_aggregations), ('facts', facts_aggregations)):
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = func(results_by_branch, now)
+            runs.append(time.perf_counter() - start)
+        timings[name] = round(min(runs), 4)
+    return {
+        'branches': n_branches,
+        'wall_time': timings['facts'],
+        'legacy_wall_time': timings['legacy'],
+        'speedup': round(timings['legacy'] / timings['facts'], 2),
+        'identical': outputs['legacy'] == outputs['facts'],
+    }
+
+
+def create_origin_repo(origin_dir, n_branches, n_commits, n_authors, max_age_days, rnd):
+    """
+    create a bare repo with main and n_branches branches of n_commits commits each, using git fast-import
+
+    every branch starts from main and has its own age (its tip is between 0 and max_age_days days old),
+    authors are picked at random from n_authors.
+    """
+    authors = ['developer{}@example.com'.format(i) for i in range(n_authors)]
+    now = int(time.time())
+    lines = []
+    mark = [0]
+
+    def add_commit(ref, timestamp, author, subject, from_mark=None):
+        mark[0] += 1
+        data = subject.encode()
+        lines.extend([
+            'commit {}'.format(ref),
+            'mark :{}'.format(mark[0]),
+            'author {} <{}> {} +0000'.format(author.split('@')[0], author, timestamp),
+            'committer {} <{}> {} +0000'.format(author.split('@')[0], author, timestamp),
+            'data {}'.format(len(data)),
+            subject,
+        ])
+        if from_mark is not None:
+            lines.append('from :{}'.format(from_mark))
+        lines.append('')
+        return mark[0]
+
+    main_start = now - (max_age_days + 30) * 86400
+    main_tip = None
+    for i in range(10):
+        main_tip = add_commit('refs/heads/main', main_start + i * 3600, authors[0], 'main commit {}'.format(i),
+                              main_tip)
+    for b in range(n_branches):
+        tip_timestamp = now - rnd.randint(0, max_age_days * 86400)
+        parent = main_tip
+        for c in range(n_commits):
+            timestamp = tip_timestamp - (n_commits - 1 - c) * 3600
+            parent = add_commit('refs/heads/feature/branch-{:05d}'.format(b), timestamp, rnd.choice(authors),
+                                'branch {} commit {}'.format(b, c), parent)
+
+    git_exec_or_fail('git init -q --bare {}'.format(origin_dir))
+    git_exec_or_fail('git fast-import --quiet', cwd=origin_dir, input='\n'.join(lines) + '\n')
+
+
+def git_exec_or_fail(cmd, **kwargs):
+    res = scan_unmerged_branches.git_exec(cmd, **kwargs)
+    if res.rc != 0:
+        raise RuntimeError('command failed: {} {}'.format(cmd, res.stderr))
+    return res
+
+
+def create_workspace(root_dir, n_repos, n_branches, n_commits, n_authors, max_age_days, seed=0):
+    """create origins/repo-N.git and their clones workspace/repo-N, return the workspace dir and repo names"""
+    rnd = random.Random(seed)
+    workspace = os.path.join(root_dir, 'workspace')
+    os.makedirs(os.path.join(root_dir, 'origins'))
+    os.makedirs(workspace)
+    repo_names = []
+    for r in range(n_repos):
+        repo_name = 'repo-{}'.format(r)
+        origin_dir = os.path.join(root_dir, 'origins', '{}.git'.format(repo_name))
+        create_origin_repo(origin_dir, n_branches, n_commits, n_authors, max_age_days, rnd)
+        git_exec_or_fail('git clone -q {} {}'.format(origin_dir, repo_name), cwd=workspace)
+        repo_names.append(repo_name)
+    return workspace, repo_names
+
+
+def benchmark_scan(workspace, repo_names, kwargs):
+    scan_unmerged_branches.scan('main', os.path.join(workspace, repo_names[0]), return_report=True, **kwargs)
+
+
+def benchmark_scan_multiple(workspace, repo_names, kwargs):
+    configs = [{'branch': 'main', 'repo_dir': os.path.join(workspace, name)} for name in repo_names]
+    scan_unmerged_branches.scan_multiple(configs, return_report=True, **kwargs)
+
+
+def benchmark_scan_multiple_async(workspace, repo_names, kwargs):
+    configs = [{'branch': 'main', 'repo_dir': os.path.join(workspace, name)} for name in repo_names]
+    asyncio.run(scan_unmerged_branches.scan_multiple_async(configs, return_report=True, **kwargs))
+
+
+def benchmark_scan_multiple_summary(workspace, repo_names, kwargs):
+    configs = [{'branch': 'main', 'repo_dir': os.path.join(workspace, name)} for name in repo_names]
+    scan_unmerged_branches.scan_multiple(configs, return_report=True, summary=True, **kwargs)
+
+
+def benchmark_scan_multiple_pipeline(workspace, repo_names, kwargs):
+    pipeline_input = os.path.join(workspace, 'pipeline_input.json')
+    with open(pipeline_input, 'w') as f:
+        json.dump([{'TARGET_BRANCH': 'main', 'REPO_NAME': name} for name in repo_names], f)
+    pipeline_output = os.path.join(workspace, 'pipeline_output', 'report.json')
+    scan_unmerged_branches.scan_multiple_pipeline(pipeline_input, pipeline_output, workspace=workspace, **kwargs)
+
+
+BENCHMARKS = {
+    'scan': benchmark_scan,
+    'scan_multiple': benchmark_scan_multiple,
+    'scan_multiple_async': benchmark_scan_multiple_async,
+    'scan_multiple_pipeline': benchmark_scan_multiple_pipeline,
+    'scan_multiple_summary': benchmark_scan_multiple_summary,
+}
+
+
+def run_benchmark(name, workspace, repo_names, kwargs):
+    """run one benchmark (in a fresh process, so peak rss is its own) and return its measurements"""
+    git_processes = [0]
+    lock = threading.Lock()
+    git_exec = scan_unmerged_branches.git_exec
+    git_exec_async = scan_unmerged_branches.git_exec_async
+
+    def count_git_process():
+        with lock:
+            git_processes[0] += 1
+
+    def counting_git_exec(cmd, **git_kwargs):
+        count_git_process()
+        return git_exec(cmd, **git_kwargs)
+
+    async def counting_git_exec_async(cmd, **git_kwargs):
+        count_git_process()
+        return await git_exec_async(cmd, **git_kwargs)
+
+    scan_unmerged_branches.git_exec = counting_git_exec
+    scan_unmerged_branches.git_exec_async = counting_git_exec_async
+    try:
+        with contextlib.redirect_stdout(sys.stderr):  # keep stdout for the results
+            start = time.perf_counter()
+            BENCHMARKS[name](workspace, repo_names, kwargs)
+            wall_time = time.perf_counter() - start
+    finally:
+        scan_unmerged_branches.git_exec = git_exec
+        scan_unmerged_branches.git_exec_async = git_exec_async
+    result = {'wall_time': round(wall_time, 4), 'git_processes': git_processes[0]}
+    if resource is not None:
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peak_git_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+
+def run_benchmark_in_process(name, workspace, repo_names, kwargs):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_benchmark, (name, workspace, repo_names, kwargs))
+
+
+def run_benchmarks(names, workspace, repo_names, kwargs, repeat=1):
+    """run each benchmark repeat times and keep its fastest run"""
+    results = {}
+    for name in names:
+        runs = [run_benchmark_in_process(name, workspace, repo_names, kwargs) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda run: run['wall_time'])
+        print('{}: {}'.format(name, results[name]), file=sys.stderr)
+    return results
+
+
+def get_git_version():
+    return git_exec_or_fail('git --version').stdout[0]
+
+
+def compare_results(results, baseline, tolerance) -> list:
+    """
+    list the regressions of results compared to baseline (both as saved by main)
+
+    wall time, peak rss and memory may grow up to tolerance (a fraction), git process counts may not grow at all
+    """
+    regressions = []
+    if results['params'] != baseline['params']:
+        print('warning: comparing runs with different params: {} vs {}'.format(
+            results['params'], baseline['params']), file=sys.stderr)
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        for key in ('wall_time', 'peak_rss_kb', 'current_bytes'):
+            if key in result and key in base and result[key] > base[key] * (1 + tolerance):
+                regressions.append('{} {}: {} > {} (+{:.0%})'.format(name, key, result[key], base[key], tolerance))
+        if 'git_processes' in result and 'git_processes' in base and result['git_processes'] > base['git_processes']:
+            regressions.append('{} git_processes: {} > {}'.format(name, result['git_processes'], base['git_processes']))
+    return regressions
+
+
+usage = """%prog [options]
+
+create synthetic repos (bare "origin" repos and their clones) and time the scanner on them:
+    scan                    : scan main of the first repo
+    scan_multiple           : scan main of all repos
+    scan_multiple_async     : scan main of all repos with asyncio subprocesses
+    scan_multiple_pipeline  : pipeline scan of main of all repos
+    scan_multiple_summary   : scan main of all repos, reporting a summary of each branch (--summary)
+each benchmark runs in its own process, recording wall time, how many git processes it ran and peak rss (not on
+windows).
+
+commit_memory measures the memory held by the unmerged commits of a synthetic branch (current_bytes is what stays
+allocated after building the report, peak_bytes includes the temporary objects made while parsing)
+
+aggregation times grouping the results of a multi-scan of synthetic stale branches (--aggregation-branches) by repo,
+by email and into the pipeline report, from the indexed ScanFacts compared to walking the results for each.
+
+results are printed (or saved with --output) as json, with --baseline the run fails (exit code 1) when it is
+slower or uses more memory than the baseline beyond --tolerance, or runs more git processes.
+"""
+
+
+def main(args):
+    parser = OptionParser(usage=usage)
+    parser.add_option('--output', dest='output', default='',
+                      help='(optional) the path for the results file (MUST be a .json file)')
+    parser.add_option('--baseline', dest='baseline', default='',
+                      help='(optional) results file of an earlier run to compare with (MUST be a .json file)')
+    parser.add_option('--tolerance', dest='tolerance', default=0.25, type='float',
+                      help='how much slower or larger than the baseline is still ok (default 0.25)')
+    parser.add_option('--benchmarks', dest='benchmarks', default=','.join(BENCHMARKS),
+                      help='comma separated benchmarks to run (default: all)')
+    parser.add_option('--repos', dest='repos', default=3, type='int',
+                      help='how many repos to create (default 3)')
+    parser.add_option('--branches', dest='branches', default=200, type='int',
+                      help='how many branches in each repo (default 200)')
+    parser.add_option('--commits', dest='commits', default=10, type='int',
+                      help='how many commits in each branch (default 10)')
+    parser.add_option('--authors', dest='authors', default=20, type='int',
+                      help='how many commit authors (default 20)')
+    parser.add_option('--max-age-days', dest='max_age_days', default=60, type='int',
+                      help='tips of branches are up to this many days old (default 60)')
+    parser.add_option('--seed', dest='seed', default=0, type='int',
+                      help='seed for the random branch ages and authors (default 0)')
+    parser.add_option('--jobs', dest='jobs', default=1, type='int',
+                      help='jobs for scan_multiple and scan_multiple_pipeline (default 1)')
+    parser.add_option('--repeat', dest='repeat', default=3, type='int',
+                      help='run each benchmark this many times and keep the fastest run (default 3)')
+    parser.add_option('--commit-memory', dest='commit_memory', default=100000, type='int',
+                      help='how many unmerged commits for the commit_memory benchmark, 0 to skip (default 100000)')
+    parser.add_option('--aggregation-branches', dest='aggregation_branches', default=100000, type='int',
+                      help='how many stale branches for the aggregation benchmark, 0 to skip (default 100000)')
+    parser.add_option('--workdir', dest='workdir', default='',
+                      help='(optional) create the repos in this directory and keep them (default: temporary)')
+    options, args = parser.parse_args(args)
+
+    if options.output and not options.output.endswith('.json'):
+        parser.error('output path must be a .json file')
+    names = [name for name in options.benchmarks.split(',') if name]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(unknown))
+
+    params = {
+        'repos': options.repos, 'branches': options.branches, 'commits': options.commits,
+        'authors': options.authors, 'max_age_days': options.max_age_days, 'seed': options.seed,
+        'jobs': options.jobs, 'commit_memory': options.commit_memory,
+        'aggregation_branches': options.aggregation_branches,
+    }
+    root_dir = options.workdir or tempfile.mkdtemp(prefix='benchmark.')
+    try:
+        workspace, repo_names = create_workspace(root_dir, options.repos, options.branches, options.commits,
+                                                 options.authors, options.max_age_days, options.seed)
+        kwargs = {'fetch_first': False, 'jobs': options.jobs}
+        benchmarks = run_benchmarks(names, workspace, repo_names, kwargs, options.repeat)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(root_dir, ignore_errors=True)
+    if options.commit_memory:
+        commit_memory = benchmark_commit_memory(options.commit_memory)
+        benchmarks['commit_memory'] = dict(commit_memory['compact'], reduction=commit_memory['reduction'])
+    if options.aggregation_branches:
+        benchmarks['aggregation'] = benchmark_aggregation(options.aggregation_branches, options.repeat)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'git': get_git_version(),
+        'params': params,
+        'benchmarks': benchmarks,
+    }
+    if options.output:
+        scan_unmerged_branches.ScanUnmergedBranches.save_json_to_file(results, os.path.abspath(options.output), indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, options.tolerance)
+        for regression in regressions:
+            print('regression: {}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
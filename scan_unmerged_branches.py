@@ -3,36 +3,2292 @@
 # script for scanning repositories and finding branches that have changes which are not merged (to master)
 
 # Standard Imports
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 from optparse import OptionParser
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
+import re
 import csv
 import sys
 import json
+import mmap
+import time
+import zlib
+import heapq
+import bisect
+import shlex
+import shutil
+import struct
+import hashlib
 import string
+import tempfile
+import warnings
+import select
+import signal
+import sqlite3
+import threading
+import asyncio
 import datetime
+import operator
+import itertools
+import contextlib
+import collections
+import ctypes
+import ctypes.util
+import urllib.parse
+
+try:
+    import fcntl
+except ImportError:  # windows, mirrors are used without locking
+    fcntl = None
 
 ExecRes = namedtuple('ExecRes', 'rc stdout stderr')
+GitCmd = namedtuple('GitCmd', 'cmd kwargs')
+BlockingCall = namedtuple('BlockingCall', 'func')  # in-process work which blocks (pipes, files, locks)
 DEFAULT_MAIN_BRANCH = 'main'
+DEFAULT_MAX_CONCURRENT_GIT = 32
+DEFAULT_FETCH_JOBS = 4
+DEFAULT_GIT_BACKEND = 'subprocess'
+DEFAULT_FETCH_INTERVAL = 300
+DEFAULT_SERVE_HOST = '127.0.0.1'
+
+
+def get_umask():
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+UMASK = get_umask()  # read once, setting it to read it is not thread safe
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """
+    a text file to write path through: a temp file in the dir of path, which replaces path once it is written, so
+    readers of path see the previous content or the new one, never a partly written file
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_path, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            os.chmod(temp_path, 0o666 & ~UMASK)  # like open would create it, mkstemp creates it private
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
 
 
 def git_exec(cmd, **kwargs):
     timeout = kwargs.pop('timeout', 60)
+    input_ = kwargs.pop('input', None)
     kwargs.setdefault('shell', True)
     kwargs.setdefault('text', True)
     kwargs.setdefault('stdout', PIPE)
     kwargs.setdefault('stderr', PIPE)
+    if input_ is not None:
+        kwargs.setdefault('stdin', PIPE)
+    tracer = ScanTracer.active
+    span = tracer.begin_git(cmd, kwargs) if tracer is not None else None
     proc = Popen(cmd, **kwargs)
-    stdout, stderr = proc.communicate(timeout=timeout)
+    try:
+        stdout, stderr = proc.communicate(input=input_, timeout=timeout)
+    except TimeoutExpired:
+        if span is not None:
+            span.end(rc=None, timeout=True)
+        raise
     rc = proc.returncode
+    if span is not None:
+        span.end(rc=rc, stdout_bytes=len(stdout.encode(errors='replace') if isinstance(stdout, str) else stdout))
     res = ExecRes(rc, stdout.splitlines(), stderr.splitlines())
     return res
 
 
+async def git_exec_async(cmd, **kwargs):
+    """asyncio version of git_exec, the git process is killed when the timeout expires or the task is cancelled"""
+    timeout = kwargs.pop('timeout', 60)
+    input_ = kwargs.pop('input', None)
+    kwargs.setdefault('stdout', PIPE)
+    kwargs.setdefault('stderr', PIPE)
+    if input_ is not None:
+        kwargs.setdefault('stdin', PIPE)
+        input_ = input_.encode()
+    if os.name == 'posix':
+        kwargs.setdefault('start_new_session', True)  # so the shell and git can be killed together
+    tracer = ScanTracer.active
+    span = tracer.begin_git(cmd, kwargs) if tracer is not None else None
+    proc = await asyncio.create_subprocess_shell(cmd, **kwargs)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(input_), timeout)
+    except asyncio.TimeoutError:
+        await kill_process_async(proc)
+        if span is not None:
+            span.end(rc=proc.returncode, timeout=True)
+        raise TimeoutExpired(cmd, timeout)
+    except asyncio.CancelledError:
+        await kill_process_async(proc)
+        if span is not None:
+            span.end(rc=proc.returncode, cancelled=True)
+        raise
+    if span is not None:
+        span.end(rc=proc.returncode, stdout_bytes=len(stdout))
+    res = ExecRes(proc.returncode, stdout.decode(errors='replace').splitlines(),
+                  stderr.decode(errors='replace').splitlines())
+    return res
+
+
+async def kill_process_async(proc):
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+# the scanner describes its git work as generators ("steps") which yield GitCmd and receive the ExecRes back,
+# so the same scanning logic runs with blocking subprocesses or on an asyncio event loop. steps yield BlockingCall
+# for blocking work in process, and receive its result back (it runs in an executor on an event loop).
+def run_git_steps(steps):
+    res = None
+    while True:
+        try:
+            step = steps.send(res)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, BlockingCall):
+            res = step.func()
+        else:
+            res = git_exec(step.cmd, **step.kwargs)
+
+
+async def run_git_steps_async(steps, semaphore=None):
+    res = None
+    while True:
+        try:
+            step = steps.send(res)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(step, BlockingCall):
+            res = await asyncio.get_event_loop().run_in_executor(None, step.func)
+        elif semaphore is None:
+            res = await git_exec_async(step.cmd, **step.kwargs)
+        else:
+            async with semaphore:
+                res = await git_exec_async(step.cmd, **step.kwargs)
+
+
+class CommitRecord(object):
+    """
+    an unmerged commit, kept small since a scan can hold a lot of them
+
+    the date is epoch seconds and the utc offset (minutes) of the author date, and author emails are interned.
+    commit dicts for the report are only made when the report is returned or written.
+    """
+    __slots__ = ('hash', 'timestamp', 'utc_offset', 'author', 'subject')
+
+    def __init__(self, hash_, timestamp, utc_offset, author, subject):
+        self.hash = hash_
+        self.timestamp = timestamp
+        self.utc_offset = utc_offset
+        self.author = sys.intern(author)
+        self.subject = subject
+
+    @classmethod
+    def from_git(cls, hash_, timestamp, utc_offset, author, subject):
+        """from git log fields %at and %ad with --date=format:%z (e.g. 1709267400 and +0530)"""
+        sign = -1 if utc_offset.startswith('-') else 1
+        minutes = sign * (int(utc_offset[1:3]) * 60 + int(utc_offset[3:5]))
+        return cls(hash_, int(timestamp), minutes, author, subject)
+
+    @classmethod
+    def from_list(cls, values):
+        if len(values) == 4:
+            # hash, iso date, author, subject (cache entries written by older versions)
+            hash_, date_, author, subject = values
+            dt = datetime.datetime.fromisoformat(date_)
+            return cls(hash_, int(dt.timestamp()), int(dt.utcoffset().total_seconds()) // 60, author, subject)
+        return cls(*values)
+
+    @property
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(
+            self.timestamp, datetime.timezone(datetime.timedelta(minutes=self.utc_offset)))
+
+    @property
+    def date(self):
+        return self.datetime.isoformat()
+
+    def to_list(self):
+        return list(self.to_tuple())
+
+    def to_report_dict(self):
+        # the author is the key of the commit list in reports
+        return {'hash': self.hash, 'date': self.date, 'subject': self.subject}
+
+    @staticmethod
+    def json_default(obj):
+        """default hook for json.dump, so reports with commit records can be written as they are"""
+        if isinstance(obj, CommitRecord):
+            return obj.to_report_dict()
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+    def __eq__(self, other):
+        if not isinstance(other, CommitRecord):
+            return NotImplemented
+        return self.to_tuple() == other.to_tuple()
+
+    __hash__ = None
+
+    def to_tuple(self):
+        return self.hash, self.timestamp, self.utc_offset, self.author, self.subject
+
+    def __repr__(self):
+        return 'CommitRecord(hash={!r}, date={!r}, author={!r}, subject={!r})'.format(
+            self.hash, self.date, self.author, self.subject)
+
+
+class ScanCache(object):
+    """
+    on-disk cache of unmerged commits, keyed by (repo, source tip hash, target tip hash)
+
+    the unmerged commits of a branch can only change when its tip or the target tip moves, so entries never go
+    out of date. they are evicted when unused for max_age_days, or least recently used first above max_entries.
+
+    for skip_unchanged scans, the cache also keeps a fingerprint of the remote refs of each repo as of its last
+    fetch, and the branches listed for each target under that fingerprint.
+    """
+    FILE_NAME = 'scan_cache.sqlite'
+    MAX_AGE_DAYS_DEFAULT = 30
+    MAX_ENTRIES_DEFAULT = 200000
+    QUERY_CHUNK = 500  # stay below the sqlite limit of variables per statement
+
+    def __init__(self, cache_dir, max_age_days=MAX_AGE_DAYS_DEFAULT, max_entries=MAX_ENTRIES_DEFAULT):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.FILE_NAME)
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS unmerged_commits ('
+                'repo TEXT, source_tip TEXT, target_tip TEXT, commits TEXT, last_used REAL, '
+                'PRIMARY KEY (repo, source_tip, target_tip))')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS unmerged_commits_last_used ON unmerged_commits (last_used)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS remote_fingerprints (repo TEXT PRIMARY KEY, fingerprint TEXT, '
+                'last_used REAL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS branch_listings ('
+                'repo TEXT, target TEXT, include_main INTEGER, fingerprint TEXT, listing TEXT, last_used REAL, '
+                'PRIMARY KEY (repo, target, include_main))')
+
+    def get_many(self, repo, target_tip, source_tips) -> dict:
+        """return {source_tip: commits} for the cached source tips (commits as decoded json lists)"""
+        source_tips = list(source_tips)
+        found = {}
+        with self.lock, self.connection:
+            for start in range(0, len(source_tips), self.QUERY_CHUNK):
+                chunk = source_tips[start:start + self.QUERY_CHUNK]
+                rows = self.connection.execute(
+                    'SELECT source_tip, commits FROM unmerged_commits WHERE repo = ? AND target_tip = ? '
+                    'AND source_tip IN ({})'.format(','.join('?' * len(chunk))), [repo, target_tip] + chunk)
+                found.update((source_tip, json.loads(commits)) for source_tip, commits in rows)
+            self.connection.executemany(
+                'UPDATE unmerged_commits SET last_used = ? WHERE repo = ? AND source_tip = ? AND target_tip = ?',
+                [(time.time(), repo, source_tip, target_tip) for source_tip in found])
+        return found
+
+    def put_many(self, repo, target_tip, commits_by_source_tip):
+        """store {source_tip: commits}, commits must be json serializable"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO unmerged_commits VALUES (?, ?, ?, ?, ?)',
+                [(repo, source_tip, target_tip, json.dumps(commits), time.time())
+                 for source_tip, commits in commits_by_source_tip.items()])
+
+    def get_fingerprint(self, repo):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT fingerprint FROM remote_fingerprints WHERE repo = ?', (repo,)).fetchone()
+        return row[0] if row else None
+
+    def put_fingerprint(self, repo, fingerprint):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO remote_fingerprints VALUES (?, ?, ?)', (repo, fingerprint, time.time()))
+
+    def get_listing(self, repo, target, include_main, fingerprint):
+        """the listing put for target while the remote refs had fingerprint (decoded json), None if there is none"""
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT listing FROM branch_listings WHERE repo = ? AND target = ? AND include_main = ? '
+                'AND fingerprint = ?', (repo, target, int(include_main), fingerprint)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                'UPDATE branch_listings SET last_used = ? WHERE repo = ? AND target = ? AND include_main = ?',
+                (time.time(), repo, target, int(include_main)))
+        return json.loads(row[0])
+
+    def put_listing(self, repo, target, include_main, fingerprint, listing):
+        """store the listing (json serializable) of target, replacing the one of an older fingerprint"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO branch_listings VALUES (?, ?, ?, ?, ?, ?)',
+                (repo, target, int(include_main), fingerprint, json.dumps(listing), time.time()))
+
+    def evict(self):
+        with self.lock, self.connection:
+            for table in ('unmerged_commits', 'remote_fingerprints', 'branch_listings'):
+                self.connection.execute(
+                    'DELETE FROM {} WHERE last_used < ?'.format(table), (time.time() - self.max_age_days * 86400,))
+            self.connection.execute(
+                'DELETE FROM unmerged_commits WHERE rowid NOT IN '
+                '(SELECT rowid FROM unmerged_commits ORDER BY last_used DESC LIMIT ?)', (self.max_entries,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM unmerged_commits').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MemoryScanCache(object):
+    """the unmerged commits part of ScanCache in memory, for a long-running scanner (see watch)"""
+
+    def __init__(self, max_entries=ScanCache.MAX_ENTRIES_DEFAULT):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # (repo, source_tip, target_tip): commits, least recently used first
+
+    def get_many(self, repo, target_tip, source_tips) -> dict:
+        found = {}
+        with self.lock:
+            for source_tip in source_tips:
+                key = (repo, source_tip, target_tip)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[source_tip] = self.entries[key]
+        return found
+
+    def put_many(self, repo, target_tip, commits_by_source_tip):
+        with self.lock:
+            for source_tip, commits in commits_by_source_tip.items():
+                self.entries[(repo, source_tip, target_tip)] = commits
+                self.entries.move_to_end((repo, source_tip, target_tip))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class ScanHistory(object):
+    """
+    sqlite store of the stale branches found by every multi-scan run, to answer what changed between runs
+
+    a run is a set of scans (repo_dir, target) recorded together, each with a row per stale (branch, author). the
+    delta of a run compares each of its scans to the previous scan of the same repo_dir and target.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, scanned_at INTEGER)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY, run_id INTEGER, repo_dir TEXT, target TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS stale_branches ('
+                'scan_id INTEGER, branch TEXT, author TEXT, commits INTEGER, newest_timestamp INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS runs_scanned_at ON runs (scanned_at)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS scans_repo_target ON scans (repo_dir, target, run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS scans_run ON scans (run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS stale_branches_scan ON stale_branches (scan_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS stale_branches_branch ON stale_branches (branch)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS stale_branches_author ON stale_branches (author)')
+
+    def record(self, results_by_branch, scanned_at=None) -> int:
+        """append the results of a multi-scan as a new run and return its id"""
+        scanned_at = int(time.time()) if scanned_at is None else int(scanned_at)
+        facts = ScanFacts.of(results_by_branch)
+        with self.lock, self.connection:
+            run_id = self.connection.execute('INSERT INTO runs (scanned_at) VALUES (?)', (scanned_at,)).lastrowid
+            for scan, result in enumerate(facts.results):
+                scan_id = self.connection.execute(
+                    'INSERT INTO scans (run_id, repo_dir, target) VALUES (?, ?, ?)',
+                    (run_id, result['repo_dir'], result['branch'])).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO stale_branches VALUES (?, ?, ?, ?, ?)',
+                    [(scan_id, fact.branch, fact.author, len(fact.commits), fact.newest_timestamp)
+                     for fact in facts.facts_of(scan)])
+        return run_id
+
+    def latest_run(self):
+        with self.lock:
+            row = self.connection.execute('SELECT MAX(id) FROM runs').fetchone()
+        return row[0]
+
+    def delta(self, run_id=None) -> dict:
+        """
+        {'run': run id, 'scanned_at': epoch, 'new': [...], 'gone': [...]} for run_id (default the latest run)
+
+        new are the branches which are stale in the run but were not in the previous scan of their repo and target
+        (all of them for a first scan), gone are those of the previous scan which are not stale in the run any more
+        (merged, deleted or updated). each is a dict of repo_dir, target, branch and the authors of its commits.
+        """
+        run_id = self.latest_run() if run_id is None else run_id
+        delta = {'run': run_id, 'scanned_at': None, 'new': [], 'gone': []}
+        if run_id is None:
+            return delta
+        with self.lock:
+            delta['scanned_at'] = self.connection.execute(
+                'SELECT scanned_at FROM runs WHERE id = ?', (run_id,)).fetchone()[0]
+            scans = self.connection.execute(
+                'SELECT id, repo_dir, target FROM scans WHERE run_id = ? ORDER BY id', (run_id,)).fetchall()
+            for scan_id, repo_dir, target in scans:
+                previous = self.connection.execute(
+                    'SELECT MAX(id) FROM scans WHERE repo_dir = ? AND target = ? AND run_id < ?',
+                    (repo_dir, target, run_id)).fetchone()[0]
+                branches = self.read_branches(scan_id)
+                previous_branches = self.read_branches(previous) if previous is not None else {}
+                for key, branches_, other in (('new', branches, previous_branches),
+                                              ('gone', previous_branches, branches)):
+                    delta[key].extend({'repo_dir': repo_dir, 'target': target, 'branch': branch, 'authors': authors}
+                                      for branch, authors in sorted(branches_.items()) if branch not in other)
+        return delta
+
+    def read_branches(self, scan_id) -> dict:
+        """{branch: sorted authors} of a scan"""
+        branches = {}
+        for branch, author in self.connection.execute(
+                'SELECT branch, author FROM stale_branches WHERE scan_id = ? ORDER BY author', (scan_id,)):
+            branches.setdefault(branch, []).append(author)
+        return branches
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MirrorCache(object):
+    """
+    local bare mirrors of remote repos, so a repo can be scanned by its url
+
+    a mirror fetches the branches of its url into refs/remotes/origin, without blobs (scans only read commits),
+    so after the first fetch it is updated by the same incremental fetch as any clone. a mirror is locked (flock)
+    while a scan uses it, concurrent scans of the same url wait for each other. when the cache is larger than
+    max_mb, the least recently used mirrors which are not locked are evicted.
+    """
+    MAX_MB_DEFAULT = 10240
+    URL_REGEX = re.compile(r'^([a-z][a-z0-9+.-]*://|[\w.-]+@[\w.-]+:)', re.IGNORECASE)  # scheme:// or user@host:
+
+    def __init__(self, cache_dir, max_mb=MAX_MB_DEFAULT):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+
+    @classmethod
+    def is_url(cls, repo_dir) -> bool:
+        return bool(cls.URL_REGEX.match(repo_dir))
+
+    @staticmethod
+    def default_cache_dir():
+        cache_home = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'stale-branch-scanner', 'mirrors')
+
+    def mirror_dir(self, url):
+        """the dir of the mirror of url, named after the repo and a hash of the url"""
+        name = re.split(r'[/:]', url.rstrip('/'))[-1]
+        name = re.sub(r'[^\w.-]', '_', name[:-len('.git')] if name.endswith('.git') else name)
+        return os.path.join(self.cache_dir, '{}-{}.git'.format(name, hashlib.sha1(url.encode()).hexdigest()[:12]))
+
+    def lock(self, url):
+        """lock the mirror of url (waiting for other scans of it), closing the returned lock file unlocks it"""
+        # the lock file stays when its mirror is evicted, so every process always locks the same file
+        lock_file = open(self.mirror_dir(url) + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            os.utime(lock_file.name)  # last used, for eviction
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+
+    @contextlib.contextmanager
+    def locked(self, url):
+        """lock the mirror of url (waiting for other scans of it) and yield its dir"""
+        with self.lock(url):
+            yield self.mirror_dir(url)
+
+    @staticmethod
+    def is_fetched(mirror_dir) -> bool:
+        """whether a fetch into the mirror succeeded, a mirror is created again until one does"""
+        if os.path.isdir(os.path.join(mirror_dir, 'refs', 'remotes', 'origin')):
+            return True
+        try:
+            with open(os.path.join(mirror_dir, 'packed-refs')) as f:
+                return any(' refs/remotes/origin/' in line for line in f)
+        except OSError:
+            return False
+
+    @staticmethod
+    def create_steps(url, mirror_dir):
+        """(re)create the mirror of url, the next fetch into it fetches the whole history"""
+        yield BlockingCall(lambda: shutil.rmtree(mirror_dir, ignore_errors=True))
+        res = yield GitCmd('git init -q --bare {}'.format(shlex.quote(mirror_dir)), {})
+        assert res.rc == 0, 'failed to create mirror:{} ({})'.format(mirror_dir, '\n'.join(res.stderr))
+        # a partial clone, like git clone --filter=blob:none would configure it
+        configs = [('remote.origin.url', url), ('remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'),
+                   ('remote.origin.promisor', 'true'), ('remote.origin.partialclonefilter', 'blob:none'),
+                   ('core.repositoryformatversion', '1'), ('extensions.partialclone', 'origin')]
+        for key, value in configs:
+            res = yield GitCmd('git config {} {}'.format(key, shlex.quote(value)), {'cwd': mirror_dir})
+            assert res.rc == 0, 'failed to configure mirror:{} {} ({})'.format(mirror_dir, key, '\n'.join(res.stderr))
+        # without them the first fetch would fetch every blob of the repo
+        for key, value in (('remote.origin.promisor', 'true'), ('extensions.partialclone', 'origin')):
+            res = yield GitCmd('git config --get {}'.format(key), {'cwd': mirror_dir})
+            assert res.stdout == [value], 'mirror:{} is not a partial clone, {} is not set'.format(mirror_dir, key)
+
+    def evict(self):
+        """delete the least recently used mirrors which are not locked until the cache fits in max_mb"""
+        mirrors = []
+        for name in os.listdir(self.cache_dir):
+            mirror_dir = os.path.join(self.cache_dir, name)
+            if name.endswith('.git') and os.path.isdir(mirror_dir):
+                last_used = os.path.getmtime(mirror_dir + '.lock') if os.path.exists(mirror_dir + '.lock') else 0
+                mirrors.append((last_used, mirror_dir, self.size_of(mirror_dir)))
+        total = sum(size for last_used, mirror_dir, size in mirrors)
+        for last_used, mirror_dir, size in sorted(mirrors):
+            if total <= self.max_mb * 1024 * 1024:
+                break
+            with open(mirror_dir + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # in use by a scan
+                shutil.rmtree(mirror_dir, ignore_errors=True)
+            total -= size
+
+    @staticmethod
+    def size_of(path) -> int:
+        return sum(os.path.getsize(os.path.join(dir_path, name))
+                   for dir_path, dir_names, names in os.walk(path) for name in names)
+
+
+class ScanMetrics(object):
+    """
+    time spent in each phase of a scan, with the git processes each phase ran and the size of the output they returned
+
+    git work is measured by wrapping the steps of a phase (see measure_steps), so it is counted the same way for
+    blocking, threaded and asyncio scans.
+    """
+    PROMETHEUS_PREFIX = 'stale_branch_scanner'
+
+    def __init__(self):
+        self.phases = {}  # name: {seconds, git_processes, git_output_bytes}
+
+    def get_phase(self, name) -> dict:
+        return self.phases.setdefault(name, {'seconds': 0.0, 'git_processes': 0, 'git_output_bytes': 0})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = self.get_phase(name)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase['seconds'] += time.perf_counter() - start
+
+    def measure_steps(self, name, steps):
+        """yield from steps as phase name, counting the git commands it runs"""
+        with self.phase(name) as phase:
+            res = None
+            while True:
+                try:
+                    cmd = steps.send(res)
+                except StopIteration as stop:
+                    return stop.value
+                res = yield cmd
+                if isinstance(cmd, BlockingCall):
+                    continue
+                phase['git_processes'] += 1
+                # size of the output as git wrote it (utf-8), with newlines
+                phase['git_output_bytes'] += sum(len(line.encode(errors='replace')) + 1 for line in res.stdout)
+
+    def add(self, other):
+        for name, other_phase in other.phases.items():
+            phase = self.get_phase(name)
+            for key, value in other_phase.items():
+                phase[key] += value
+
+    def as_dict(self) -> dict:
+        phases = {name: dict(phase, seconds=round(phase['seconds'], 6)) for name, phase in self.phases.items()}
+        total = {
+            'seconds': round(sum(phase['seconds'] for phase in self.phases.values()), 6),
+            'git_processes': sum(phase['git_processes'] for phase in self.phases.values()),
+            'git_output_bytes': sum(phase['git_output_bytes'] for phase in self.phases.values()),
+        }
+        return {'phases': phases, 'total': total}
+
+    @classmethod
+    def write_prometheus_textfile(cls, path, metrics_by_repo):
+        """
+        write {repo: ScanMetrics} in the prometheus text format, for the textfile collector of node exporter
+
+        the file is replaced at once, so the collector never reads a partly written file
+        """
+        samples = [
+            ('phase_duration_seconds', 'seconds', 'Time spent in each phase of the scans of a repo'),
+            ('phase_git_processes', 'git_processes', 'Git processes run by each phase of the scans of a repo'),
+            ('phase_git_output_bytes', 'git_output_bytes', 'Size of the git output parsed by each phase'),
+        ]
+        lines = []
+        for name, key, help_ in samples:
+            metric = '{}_{}'.format(cls.PROMETHEUS_PREFIX, name)
+            lines.append('# HELP {} {}'.format(metric, help_))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for repo, metrics in sorted(metrics_by_repo.items()):
+                for phase_name, phase in sorted(metrics.phases.items()):
+                    lines.append('{}{{repo="{}",phase="{}"}} {}'.format(
+                        metric, cls.escape_label_value(repo), cls.escape_label_value(phase_name), phase[key]))
+        metric = '{}_last_run_timestamp_seconds'.format(cls.PROMETHEUS_PREFIX)
+        lines.append('# HELP {} When the scan that wrote this file finished'.format(metric))
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{} {}'.format(metric, int(time.time())))
+        with atomic_write(path) as f:
+            f.write('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def escape_label_value(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ScanTracer(object):
+    """
+    record git commands and scan phases as chrome trace events (open the file in chrome://tracing or perfetto)
+
+    at most one tracer is active (see start). while none is, tracing costs git_exec and the scan phases a check
+    for None. every thread and every asyncio task gets its own row in the trace.
+    the active tracer is global to the process: it records every scan running while it is active, in any thread,
+    so scans which are traced must not run concurrently with scans which are not (or with another traced run).
+    """
+    active = None
+
+    def __init__(self):
+        self.events = []
+        self.lanes = {}  # thread or task: tid
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def start(self):
+        assert ScanTracer.active is None, 'a tracer is active already, there is one per process'
+        ScanTracer.active = self
+        return self
+
+    def stop(self):
+        if ScanTracer.active is self:
+            ScanTracer.active = None
+
+    def timestamp(self):
+        """microseconds since the tracer was created"""
+        return (time.perf_counter() - self.origin) * 1000000
+
+    def lane(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None  # no event loop running in this thread
+        key = task if task is not None else threading.get_ident()
+        with self.lock:
+            tid = self.lanes.get(key)
+            if tid is None:
+                tid = self.lanes[key] = len(self.lanes) + 1
+                name = 'task {}'.format(tid) if task is not None else threading.current_thread().name
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                    'args': {'name': name}})
+        return tid
+
+    def begin(self, name, category, **args):
+        return TraceSpan(self, name, category, self.lane(), self.timestamp(), args)
+
+    def begin_git(self, cmd, kwargs):
+        name = 'git {}'.format(cmd.split(' -P ', 1)[-1].split(' ', 1)[0])  # e.g. git log
+        return self.begin(name, 'git', cmd=cmd, cwd=kwargs.get('cwd'))
+
+    def add_span(self, span, end, args):
+        event = {'name': span.name, 'cat': span.category, 'ph': 'X', 'ts': round(span.start, 3),
+                 'dur': round(end - span.start, 3), 'pid': self.pid, 'tid': span.tid, 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def trace_steps(self, name, steps, category='phase', **args):
+        """yield from steps, as a span from its first to its last git command (or to where it raised)"""
+        span = self.begin(name, category, **args)
+        try:
+            return (yield from steps)
+        finally:
+            span.end()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.lock, open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        print('trace saved to file: {}'.format(path), file=sys.stderr)
+
+    @classmethod
+    @contextlib.contextmanager
+    def tracing(cls, path):
+        """trace what runs inside the context into path, a no-op when path is empty"""
+        if not path:
+            yield None
+            return
+        tracer = cls().start()
+        try:
+            yield tracer
+        finally:
+            tracer.stop()
+            tracer.save(path)
+
+
+class TraceSpan(object):
+    __slots__ = ('tracer', 'name', 'category', 'tid', 'start', 'args')
+
+    def __init__(self, tracer, name, category, tid, start, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.tid = tid
+        self.start = start
+        self.args = args
+
+    def end(self, **args):
+        self.args.update(args)
+        self.tracer.add_span(self, self.tracer.timestamp(), self.args)
+
+
+class NdjsonReportWriter(object):
+    """
+    write scan reports as newline delimited json, one record per stale branch
+
+    each record is flushed as soon as it is written, so reports can be dropped after writing and readers of the
+    output see the results of every scan while the next scans are still running.
+    """
+
+    def __init__(self, output=None):
+        self.output = output or None
+        self.file = None
+
+    def __enter__(self):
+        if self.output is None:
+            self.file = sys.stdout
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.output)), exist_ok=True)
+            self.file = open(self.output, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.output is not None:
+            self.file.close()
+            print('report saved to file: {}'.format(self.output))
+
+    def write_scan(self, branch, repo_dir, report_by_branch):
+        for stale_branch, commits_by_author in report_by_branch.items():
+            self.write_record({'repo_dir': repo_dir, 'target_branch': branch, 'branch': stale_branch,
+                               'commits_by_author': commits_by_author})
+
+    def write_record(self, record):
+        self.file.write(json.dumps(record, default=CommitRecord.json_default) + '\n')
+        self.file.flush()
+
+
+class ScanJournal(object):
+    """
+    checkpoint journal of a multi-scan, a json line per scan appended (and synced to disk) as soon as it is done,
+    so a multi-scan which dies can be resumed without doing again the scans it finished
+
+    a line has the key of the scan (target, repo_dir and the options which change its report), a fingerprint of
+    the refs of the repo when it was scanned and the report. a line cut short by a crash is ignored, and the last
+    line of a key is the one kept. the age of stale branches moves with time, a journal is for retrying a run soon
+    after it failed, not for skipping scans for days.
+
+    every scan option is part of the key except those known to give the same report (how the commits are read,
+    cached, measured or written), so a new option is never mistaken for one which does not matter. multi_target is
+    not a scan option, a multi-target walk gives the same reports as scanning each target.
+    """
+    REPORT_NEUTRAL_OPTIONS = frozenset([
+        'fetch_first', 'batch', 'pushdown', 'backend', 'write_commit_graph', 'skip_unchanged', 'cache_dir',
+        'cache_max_age_days', 'cache_max_entries', 'memory_cache', 'mirror_dir', 'mirror_max_mb', 'metrics',
+        'metrics_file', 'trace', 'return_report', 'save_scan', 'format', 'output', 'indent', 'raise_exceptions'])
+
+    def __init__(self, path, resume=False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.entries = self.read(path) if resume else {}
+        self.file = open(path, 'a' if resume else 'w')
+        if self.file.tell() and not self.ends_with_newline(path):
+            self.file.write('\n')  # after a line cut short
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def read(path) -> dict:
+        """{key: entry} of the scans in the journal in path"""
+        entries = {}
+        if not os.path.exists(path):
+            return entries
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # cut short by a crash
+                entries[entry['key']] = entry
+        return entries
+
+    @staticmethod
+    def ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    @classmethod
+    def scan_key(cls, branch, repo_dir, scan_kwargs) -> str:
+        if not MirrorCache.is_url(repo_dir):
+            repo_dir = os.path.abspath(repo_dir)  # ./repo and /abs/repo are the same scan
+        options = {name: value for name, value in scan_kwargs.items() if name not in cls.REPORT_NEUTRAL_OPTIONS}
+        if 'stale' in options:
+            options['stale'] = int(options['stale'])  # '7' from the command line is 7
+        return json.dumps([branch, repo_dir, options], sort_keys=True, default=str)
+
+    def get(self, key, tips):
+        """the journaled report of key, None if it has none or the repo refs changed since (tips)"""
+        entry = self.entries.get(key)
+        if entry is None or tips is None or entry['tips'] != tips:
+            return None
+        return entry['report']
+
+    def record(self, key, tips, report):
+        line = json.dumps({'key': key, 'tips': tips, 'report': report}, default=CommitRecord.json_default)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class UnsupportedRepository(Exception):
+    """a repository feature an in-process backend does not read, the backend falls back to the git CLI"""
+
+
+class GitBackend(object):
+    """
+    how a scanner reads the branches and unmerged commits of a repo, as steps (which may yield GitCmd like the rest
+    of a scan)
+
+    a backend belongs to one scanner and may keep state per repo (processes, parsed commits) until it is closed.
+    """
+    name = None
+    BRANCH_REF = namedtuple('BRANCH_REF', ['hash', 'timestamp'])  # a remote branch tip and its author date
+
+    def refs_steps(self, repo_dir, **kwargs):
+        """{name: BRANCH_REF} of the remote branches (symbolic refs such as origin/HEAD are not branches)"""
+        raise NotImplementedError
+
+    def branches_steps(self, target, repo_dir, **kwargs):
+        """the remote branches which are not merged to target, as listed by git branch -r --no-merged target"""
+        raise NotImplementedError
+
+    def log_steps(self, source, target, repo_dir, **kwargs):
+        """[CommitRecord] of the commits of source which are not in target, like git log source --not target"""
+        raise NotImplementedError
+
+    def walk_steps(self, revisions, repo_dir, **kwargs):
+        """({hash: CommitRecord} in walk order, {hash: [parent hashes]}) of the commits of git log revisions"""
+        raise NotImplementedError
+
+    def summary_walk_steps(self, revisions, repo_dir, **kwargs):
+        """({hash: (timestamp, author)}, {hash: [parent hashes]}) of the commits of git log revisions, for summaries"""
+        commits, parents = yield from self.walk_steps(revisions, repo_dir, **kwargs)
+        return {hash_: (commit.timestamp, commit.author) for hash_, commit in commits.items()}, parents
+
+    def close(self):
+        pass
+
+
+class SubprocessGitBackend(GitBackend):
+    """a git process per query"""
+    name = 'subprocess'
+    COMMIT_FRMT = '%H|%at|%ad|%aE|%s'
+    BATCH_COMMIT_FRMT = '%H|%P|%at|%ad|%aE|%s'  # like COMMIT_FRMT, with parent hashes for attributing commits to branches
+    SUMMARY_COMMIT_FRMT = '%H|%P|%at|%aE'  # what a summary needs of a commit, no subject or utc offset
+    COMMIT_DATE_OPTION = '--date=format:%z'  # so %ad is the utc offset of the author date (%at is epoch seconds)
+
+    def refs_steps(self, repo_dir, **kwargs):
+        # build command
+        cmd = 'git -P for-each-ref --format="%(objectname)|%(authordate:unix)|%(symref)|%(refname:short)" ' \
+              'refs/remotes'
+        # executed
+        res = yield GitCmd(cmd, kwargs)
+        # make dict of branch:ref (symbolic refs such as origin/HEAD are not branches)
+        refs = {}
+        for line in res.stdout:
+            hash_, timestamp, symref, name = line.strip().split('|', 3)
+            if not symref:
+                refs[name] = self.BRANCH_REF(hash_, int(timestamp))
+        return refs
+
+    def branches_steps(self, target, repo_dir, **kwargs):
+        # build command
+        cmd = 'git -P branch -r --no-merged {}'.format(target)
+        # executed
+        res = yield GitCmd(cmd, kwargs)
+        # make list of branches
+        return [branch.strip() for branch in res.stdout]
+
+    def log_steps(self, source, target, repo_dir, **kwargs):
+        # build command
+        cmd = 'git -P log {} --not {} {} --format="{}"'.format(
+            source, target, self.COMMIT_DATE_OPTION, self.COMMIT_FRMT)
+        # executed
+        res = yield GitCmd(cmd, kwargs)
+        # make list of commit author:hash:subject:date
+        commits = [CommitRecord.from_git(*commit.strip().split('|', 4)) for commit in res.stdout]
+        return commits
+
+    def walk_steps(self, revisions, repo_dir, **kwargs):
+        # revisions are passed on stdin, thousands of branches do not fit a command line
+        cmd = 'git -P log --stdin {} --format="{}"'.format(self.COMMIT_DATE_OPTION, self.BATCH_COMMIT_FRMT)
+        res = yield GitCmd(cmd, dict(kwargs, input='\n'.join(revisions) + '\n'))
+        return self.parse_batch_log(res.stdout)
+
+    def summary_walk_steps(self, revisions, repo_dir, **kwargs):
+        cmd = 'git -P log --stdin --format="{}"'.format(self.SUMMARY_COMMIT_FRMT)
+        res = yield GitCmd(cmd, dict(kwargs, input='\n'.join(revisions) + '\n'))
+        commits = {}
+        parents = {}
+        for line in res.stdout:
+            hash_, parent_hashes, timestamp, author = line.strip().split('|', 3)
+            commits[hash_] = (int(timestamp), sys.intern(author))
+            parents[hash_] = parent_hashes.split()
+        return commits, parents
+
+    @staticmethod
+    def parse_batch_log(lines):
+        """make dict of hash:commit in the order git listed them, and dict of hash:parent hashes"""
+        commits = {}
+        parents = {}
+        for line in lines:
+            hash_, parent_hashes, timestamp, utc_offset, author, subject = line.strip().split('|', 5)
+            commits[hash_] = CommitRecord.from_git(hash_, timestamp, utc_offset, author, subject)
+            parents[hash_] = parent_hashes.split()
+        return commits, parents
+
+
+class CatFileGitBackend(SubprocessGitBackend):
+    """
+    walks history in process, reading commit objects from a long-lived git cat-file --batch per repo
+
+    once a repo's reader runs, a walk costs no git process (a scan with --no-batch no longer spawns one per branch),
+    and commits read for one target are not read again for the next. the walk is git's limited walk (newest
+    committer date first, until only excluded commits are left for SLOP commits), so it lists the same commits in the
+    same order as git log. repos with a mailmap are walked by git log, which maps the author emails.
+    the pipe is read blocking, in the default executor when scanning on an event loop.
+    """
+    name = 'cat-file'
+    SLOP = 5
+
+    def __init__(self):
+        self.readers = {}  # repo_dir: CommitReader, None for repos which need the git CLI
+        self.readers_lock = threading.Lock()
+
+    @staticmethod
+    def new_reader(repo_dir):
+        return CatFileReader(repo_dir)
+
+    def open_reader(self, repo_dir):
+        repo_dir = os.path.abspath(repo_dir)
+        with self.readers_lock:
+            if repo_dir not in self.readers:
+                try:
+                    self.readers[repo_dir] = self.new_reader(repo_dir)
+                except UnsupportedRepository:
+                    self.readers[repo_dir] = None
+            return self.readers[repo_dir]
+
+    def read_steps(self, repo_dir, read, fallback_steps):
+        """read(reader) in process (a BlockingCall), or the fallback steps if the repo needs the git CLI"""
+        def read_in_process():
+            reader = self.open_reader(repo_dir)
+            if reader is not None:
+                with reader.lock:
+                    try:
+                        return True, read(reader)
+                    except UnsupportedRepository:
+                        pass  # met on the way (e.g. an object missing from a partial clone), git knows what to do
+            return False, None
+
+        done, result = yield BlockingCall(read_in_process)
+        if done:
+            return result
+        return (yield from fallback_steps)
+
+    def log_steps(self, source, target, repo_dir, **kwargs):
+        commits, parents = yield from self.walk_steps([source, '^{}'.format(target)], repo_dir, **kwargs)
+        return list(commits.values())
+
+    summary_walk_steps = GitBackend.summary_walk_steps  # commits are read in process anyway
+
+    def walk_steps(self, revisions, repo_dir, **kwargs):
+        return (yield from self.read_steps(repo_dir, lambda reader: self.walk(reader, revisions),
+                                           super().walk_steps(revisions, repo_dir, **kwargs)))
+
+    def walk(self, reader, revisions):
+        """the commits of git log revisions (excluded revisions start with ^), read from reader"""
+        uninteresting = {}  # hash: whether an excluded revision reaches it, for each commit queued so far
+        queue = []  # (-committer date, insertion), so commits with the same date are walked in insertion order
+        queued = set()
+        interesting_queued = 0
+        insertions = itertools.count()
+        walked = []
+        generation_queue = [] if reader.graph is not None else None  # (-generation, hash), popped lazily
+
+        def push(commit, excluded):
+            nonlocal interesting_queued
+            uninteresting[commit.hash] = excluded
+            heapq.heappush(queue, (-commit.commit_timestamp, next(insertions), commit.hash))
+            queued.add(commit.hash)
+            interesting_queued += not excluded
+            if generation_queue is not None:
+                heapq.heappush(generation_queue, (-commit.generation, commit.hash))
+
+        def max_queued_generation():
+            while generation_queue[0][1] not in queued:
+                heapq.heappop(generation_queue)
+            return -generation_queue[0][0]
+
+        def exclude(hash_):
+            # an excluded commit excludes its ancestors, including those walked already
+            nonlocal interesting_queued
+            pending = [hash_]
+            while pending:
+                hash_ = pending.pop()
+                if uninteresting[hash_]:
+                    continue
+                uninteresting[hash_] = True
+                if hash_ in queued:
+                    interesting_queued -= 1
+                else:
+                    pending.extend(p for p in reader.commits[hash_].parents if p in uninteresting)
+
+        for revision in revisions:
+            excluded = revision.startswith('^')
+            commit = reader.read_commit(revision.lstrip('^'))
+            if commit is None:
+                return {}, {}  # git log fails on an unknown revision
+            if commit.hash not in uninteresting:
+                push(commit, excluded)
+            elif excluded:
+                exclude(commit.hash)
+        last_timestamp = float('inf')  # committer date of the last commit walked which is not excluded
+        min_generation = CommitGraph.INFINITY  # lowest generation of the commits walked which are not excluded
+        slop = self.SLOP
+        while queue:
+            hash_ = heapq.heappop(queue)[2]
+            queued.remove(hash_)
+            excluded = uninteresting[hash_]
+            interesting_queued -= not excluded
+            commit = reader.commits[hash_]
+            for parent_hash in commit.parents:
+                if parent_hash not in uninteresting:
+                    parent = reader.read_commit(parent_hash)
+                    if parent is not None:  # missing from a shallow clone
+                        push(parent, excluded)
+                elif excluded:
+                    exclude(parent_hash)
+            if not excluded:
+                walked.append(hash_)
+                last_timestamp = commit.commit_timestamp
+                min_generation = min(min_generation, commit.generation)
+            if not queue:
+                break
+            elif generation_queue is not None:
+                # a commit only reaches commits of lower generations (and a commit in the graph only reaches commits
+                # in the graph): once only excluded commits are queued and none of them has a higher generation than
+                # the commits walked, nothing walked can be excluded any more
+                if not interesting_queued and max_queued_generation() <= min_generation:
+                    if max_queued_generation() != CommitGraph.INFINITY:
+                        break
+            elif not excluded:
+                continue
+            elif interesting_queued or last_timestamp <= -queue[0][0]:
+                slop = self.SLOP
+            else:
+                slop -= 1
+                if not slop:
+                    break
+        commits = {h: reader.read_record(h) for h in walked if not uninteresting[h]}
+        parents = {h: list(reader.commits[h].parents) for h in commits}
+        return commits, parents
+
+    def close(self):
+        with self.readers_lock:
+            for reader in self.readers.values():
+                if reader is not None:
+                    reader.close()
+            self.readers.clear()
+
+
+class OdbGitBackend(CatFileGitBackend):
+    """
+    like the cat-file backend without any git process: branches, tips and commits are read from the files of the
+    repo by an OdbReader, so a scan without fetch runs no git at all. repos with a feature OdbReader does not read
+    are scanned with the git CLI. whether a branch is merged is decided exactly, where git branch --no-merged (a walk
+    with date slop) may take a branch merged behind commits dated far ahead for unmerged.
+    """
+    name = 'odb'
+
+    @staticmethod
+    def new_reader(repo_dir):
+        return OdbReader(repo_dir)
+
+    def refs_steps(self, repo_dir, **kwargs):
+        return (yield from self.read_steps(repo_dir, self.read_refs, super().refs_steps(repo_dir, **kwargs)))
+
+    def branches_steps(self, target, repo_dir, **kwargs):
+        return (yield from self.read_steps(repo_dir, lambda reader: self.unmerged_branches(reader, target),
+                                           super().branches_steps(target, repo_dir, **kwargs)))
+
+    def read_refs(self, reader):
+        refs = {}
+        for name, hash_ in reader.read_remote_refs().items():
+            commit = reader.read_commit(hash_)
+            if commit is None:
+                raise UnsupportedRepository('ref:{} is not a commit'.format(name))
+            refs[name] = self.BRANCH_REF(commit.hash, reader.read_record(commit.hash).timestamp)
+        return refs
+
+    def unmerged_branches(self, reader, target):
+        target_commit = reader.read_commit(target)
+        if target_commit is None:
+            return []  # git branch fails on an unknown commit
+        tips = reader.read_remote_refs()
+        # like git branch --no-merged, a branch is unmerged if its tip is not reachable from the target
+        merged = self.reachable(reader, target_commit, set(tips.values()))
+        return [name for name, tip in tips.items() if tip not in merged]
+
+    @staticmethod
+    def reachable(reader, start, hashes) -> set:
+        """
+        the hashes which start reaches, decided exactly (not with the date slop of the log walk): the whole history of
+        start is walked, except below the generation of the hashes when they are in the commit-graph
+        """
+        hashes = {hash_.lower() for hash_ in hashes}
+        # a commit in the graph only reaches commits of lower generations, and only commits in the graph
+        min_generation = min((commit.generation for commit in map(reader.read_commit, hashes)
+                              if commit is not None), default=CommitGraph.INFINITY)
+        found = set()
+        seen = {start.hash}
+        pending = [start]
+        while pending and len(found) < len(hashes):
+            commit = pending.pop()
+            if commit.hash in hashes:
+                found.add(commit.hash)
+            if commit.generation != CommitGraph.INFINITY and commit.generation <= min_generation:
+                continue
+            for parent_hash in commit.parents:
+                if parent_hash not in seen:
+                    seen.add(parent_hash)
+                    parent = reader.read_commit(parent_hash)
+                    if parent is not None:  # missing from a shallow clone
+                        pending.append(parent)
+        return found
+
+
+class CommitReader(object):
+    """
+    reads the commits of one repo for the in-process walk, from read_object of a subclass
+
+    commits in the commit-graph of the repo are read from the graph, and only inflated (read_record) when they are
+    listed as unmerged.
+    """
+    PARSED_COMMIT = namedtuple('PARSED_COMMIT', ['hash', 'parents', 'commit_timestamp', 'generation', 'record'])
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.lock = threading.Lock()  # one walk at a time per reader
+        self.commits = {}  # hash: PARSED_COMMIT (the record is None until read_record)
+        self.graph = None  # CommitGraph, set by subclasses which find one
+
+    @staticmethod
+    def is_hash(name):
+        return len(name) == 40 and all(c in string.hexdigits for c in name)
+
+    def read_object(self, name):
+        """(hash, type, content) of an object, None if it is missing"""
+        raise NotImplementedError
+
+    def read_commit(self, name):
+        """PARSED_COMMIT of a commit (annotated tags are peeled), None if there is no such commit"""
+        if name in self.commits:
+            return self.commits[name]
+        if self.graph is not None and self.is_hash(name):
+            commit = self.graph.read_commit(name.lower())
+            if commit is not None:
+                commit = self.commits[commit[0]] = self.PARSED_COMMIT(*commit, None)
+                return commit
+        obj = self.read_object(name)
+        while obj is not None and obj[1] == 'tag':
+            obj = self.read_object(obj[2].split(b'\n', 1)[0].split()[1].decode())
+        if obj is None or obj[1] != 'commit':
+            return None
+        commit = self.parse_commit(obj[0], obj[2])
+        if self.graph is not None:
+            graph_commit = self.graph.read_commit(commit.hash)
+            if graph_commit is not None:
+                commit = commit._replace(generation=graph_commit[3])
+        self.commits[commit.hash] = commit
+        return commit
+
+    def read_record(self, hash_) -> CommitRecord:
+        """the CommitRecord of a commit read by read_commit"""
+        commit = self.commits[hash_]
+        if commit.record is None:
+            obj = self.read_object(hash_)
+            if obj is None or obj[1] != 'commit':
+                raise UnsupportedRepository('commit-graph commit:{} is missing'.format(hash_))
+            commit = self.commits[hash_] = commit._replace(record=self.parse_commit(hash_, obj[2]).record)
+        return commit.record
+
+    @classmethod
+    def parse_commit(cls, hash_, content):
+        headers, _, message = content.partition(b'\n\n')
+        parents = []
+        author = committer = b''
+        for line in headers.split(b'\n'):
+            key, _, value = line.partition(b' ')
+            if key == b'parent':
+                parents.append(value.decode())
+            elif key == b'author':
+                author = value
+            elif key == b'committer':
+                committer = value
+        # identities are "name <email> epoch utc_offset"
+        email, _, author_date = author.rpartition(b'<')[2].partition(b'> ')
+        timestamp, _, utc_offset = author_date.partition(b' ')
+        commit_timestamp = int(committer.rpartition(b'> ')[2].split()[0])
+        # like %s, the subject is the first paragraph of the message on one line
+        subject_lines = []
+        for line in message.split(b'\n'):
+            line = line.rstrip()
+            if line:
+                subject_lines.append(line)
+            elif subject_lines:
+                break
+        record = CommitRecord.from_git(hash_, timestamp.decode(), utc_offset.decode(),
+                                       email.decode(errors='replace'),
+                                       b' '.join(subject_lines).decode(errors='replace').strip())
+        return cls.PARSED_COMMIT(hash_, tuple(parents), commit_timestamp, CommitGraph.INFINITY, record)
+
+    def close(self):
+        if self.graph is not None:
+            self.graph.close()
+            self.graph = None
+
+
+class CatFileReader(CommitReader):
+    """a git cat-file --batch process of one repo"""
+
+    def __init__(self, repo_dir):
+        super().__init__(repo_dir)
+        self.proc = Popen(['git', 'cat-file', '--batch'], cwd=repo_dir, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        if (os.path.isfile(os.path.join(repo_dir, '.mailmap')) or self.read_object('HEAD:.mailmap') is not None
+                or git_exec('git config --get-regexp "^mailmap\\."', cwd=repo_dir).rc == 0):
+            self.close()
+            raise UnsupportedRepository('mailmap')
+        res = git_exec('git rev-parse --git-path objects', cwd=repo_dir)
+        if res.rc == 0 and res.stdout:
+            self.graph = CommitGraph.open(os.path.join(repo_dir, res.stdout[0].strip()))
+
+    def read_object(self, name):
+        self.proc.stdin.write(name.encode() + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:  # "<name> missing"
+            return None
+        hash_, type_, size = header
+        content = self.proc.stdout.read(int(size) + 1)[:-1]
+        return hash_.decode(), type_.decode(), content
+
+    def close(self):
+        super().close()
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class OdbReader(CommitReader):
+    """
+    reads refs and objects straight from the files of a repo: loose refs and packed-refs, loose objects, and packs
+    (memory mapped, through their v2 index, only the objects asked for are inflated and their deltas applied)
+
+    what it does not read raises UnsupportedRepository: repository extensions (sha256, reftable, partial clones),
+    grafts, shallow clones, replace refs, mailmaps, config includes and config from the environment, v1 pack indexes
+    and revision syntax other than names and hashes.
+    """
+    REVISION_SYNTAX = ('^', '~', ':', '@{', '..', '?', '*', '[', '\\')
+
+    def __init__(self, repo_dir):
+        super().__init__(repo_dir)
+        self.git_dir, self.common_dir, self.work_tree = self.find_git_dirs(repo_dir)
+        self.packed_refs = (None, {})  # (stat of packed-refs, {refname: hash}) as last read
+        self.packs = {}  # idx path: PackFile
+        self.object_dirs = self.find_object_dirs(os.path.join(self.common_dir, 'objects'))
+        try:
+            self.refresh_packs()
+            self.check_supported()
+        except UnsupportedRepository:
+            self.close()
+            raise
+        self.graph = CommitGraph.open(self.object_dirs[0])
+
+    @staticmethod
+    def find_git_dirs(repo_dir):
+        """(git dir, common dir, work tree or None) of the repo which contains repo_dir"""
+        path = os.path.abspath(repo_dir)
+        while True:
+            dot_git = os.path.join(path, '.git')
+            if os.path.isdir(dot_git):
+                git_dir, work_tree = dot_git, path
+                break
+            if os.path.isfile(dot_git):
+                # a linked worktree or a submodule
+                with open(dot_git) as f:
+                    content = f.read().strip()
+                if not content.startswith('gitdir:'):
+                    raise UnsupportedRepository('.git file:{}'.format(dot_git))
+                git_dir, work_tree = os.path.join(path, content[len('gitdir:'):].strip()), path
+                break
+            if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+                git_dir, work_tree = path, None  # bare
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise UnsupportedRepository('not a git repository:{}'.format(repo_dir))
+            path = parent
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir')) as f:
+                common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        return git_dir, common_dir, work_tree
+
+    @classmethod
+    def find_object_dirs(cls, objects_dir, seen=None) -> list:
+        """objects_dir and its alternates"""
+        seen = set() if seen is None else seen
+        objects_dir = os.path.normpath(objects_dir)
+        if objects_dir in seen or not os.path.isdir(objects_dir):
+            return []
+        seen.add(objects_dir)
+        object_dirs = [objects_dir]
+        try:
+            with open(os.path.join(objects_dir, 'info', 'alternates')) as f:
+                alternates = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        except FileNotFoundError:
+            alternates = []
+        for alternate in alternates:
+            object_dirs += cls.find_object_dirs(os.path.join(objects_dir, alternate), seen)
+        return object_dirs
+
+    def check_supported(self):
+        config_paths = [os.path.join(self.common_dir, 'config'), os.path.join(self.git_dir, 'config.worktree'),
+                        os.path.expanduser('~/.gitconfig'), '/etc/gitconfig',
+                        os.path.join(os.getenv('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'git', 'config')]
+        # config from the environment (git -c, GIT_CONFIG_GLOBAL and the like) is not read
+        for name in os.environ:
+            if name.startswith('GIT_CONFIG'):
+                raise UnsupportedRepository('env:{}'.format(name))
+        for key in set().union(*(self.read_config_keys(path) for path in config_paths)):
+            if key.startswith('mailmap.') or (key.startswith('extensions.') and key != 'extensions.worktreeconfig'):
+                raise UnsupportedRepository('config:{}'.format(key))
+            if key.startswith(('include.', 'includeif.')):
+                raise UnsupportedRepository('config:{}'.format(key))  # included files are not read
+        for name in ('shallow', os.path.join('info', 'grafts')):
+            if os.path.exists(os.path.join(self.common_dir, name)):
+                raise UnsupportedRepository(name)
+        if any(refname.startswith('refs/replace/') for refname in self.read_refs('refs/replace/')):
+            raise UnsupportedRepository('replace refs')
+        # %aE maps author emails with the .mailmap of the work tree (or of HEAD in a bare repo)
+        if self.work_tree is not None:
+            if os.path.exists(os.path.join(self.work_tree, '.mailmap')):
+                raise UnsupportedRepository('mailmap')
+        elif self.read_tree_entry('HEAD', b'.mailmap') is not None:
+            raise UnsupportedRepository('mailmap')
+
+    @staticmethod
+    def read_config_keys(path) -> set:
+        """section.key of the keys set in a git config file (subsection names left out)"""
+        keys = set()
+        section = ''
+        try:
+            f = open(path, errors='replace')
+        except OSError:
+            return keys
+        with f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('['):
+                    section = line[1:].split(']')[0].split()[0].split('.')[0].lower() if line[1:].strip() else ''
+                elif line and line[0] not in '#;':
+                    keys.add('{}.{}'.format(section, line.split('=')[0].strip().lower()))
+        return keys
+
+    def read_tree_entry(self, name, entry_name):
+        """hash of an entry of the root tree of a commit, None if there is no such entry"""
+        commit = self.read_object(name)
+        if commit is None or commit[1] != 'commit':
+            return None
+        tree = self.read_object(commit[2].split(b'\n', 1)[0].split()[1].decode())
+        content = tree[2] if tree is not None else b''
+        pos = 0
+        while pos < len(content):
+            # "mode name\0" and the 20 bytes of the hash
+            end = content.index(b'\0', pos)
+            if content[pos:end].split(b' ', 1)[1] == entry_name:
+                return content[end + 1:end + 21].hex()
+            pos = end + 21
+        return None
+
+    def read_packed_refs(self) -> dict:
+        path = os.path.join(self.common_dir, 'packed-refs')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        if self.packed_refs[0] != (stat.st_mtime_ns, stat.st_size):
+            refs = {}
+            with open(path, errors='replace') as f:
+                for line in f:
+                    if line.startswith(('#', '^')):
+                        continue  # the header, and peeled tags
+                    hash_, _, refname = line.strip().partition(' ')
+                    refs[refname] = hash_
+            self.packed_refs = ((stat.st_mtime_ns, stat.st_size), refs)
+        return self.packed_refs[1]
+
+    def read_loose_ref(self, refname):
+        """content of a loose ref file (a hash or "ref: <refname>"), None if there is no such file"""
+        # HEAD and the like are per worktree, refs/ are shared by all worktrees
+        ref_dir = self.common_dir if refname.startswith('refs/') else self.git_dir
+        try:
+            with open(os.path.join(ref_dir, refname), errors='replace') as f:
+                return f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+
+    def read_refs(self, prefix) -> dict:
+        """{refname: loose ref content or packed hash} of the refs under prefix (e.g. refs/remotes/), sorted"""
+        refs = {refname: hash_ for refname, hash_ in self.read_packed_refs().items() if refname.startswith(prefix)}
+        root = os.path.join(self.common_dir, prefix)
+        for dir_path, dir_names, file_names in os.walk(root):
+            for file_name in file_names:
+                if file_name.endswith('.lock'):
+                    continue
+                refname = prefix + os.path.relpath(os.path.join(dir_path, file_name), root).replace(os.sep, '/')
+                content = self.read_loose_ref(refname)
+                if content is not None:
+                    refs[refname] = content
+        return {refname: refs[refname] for refname in sorted(refs)}
+
+    def read_remote_refs(self) -> dict:
+        """{name: hash} of the remote branches, like git branch -r (symbolic refs such as origin/HEAD left out)"""
+        return {refname[len('refs/remotes/'):]: content for refname, content in self.read_refs('refs/remotes/').items()
+                if not content.startswith('ref:')}
+
+    def resolve_ref(self, refname):
+        for _ in range(10):  # symbolic refs to symbolic refs
+            content = self.read_loose_ref(refname)
+            if content is None:
+                return self.read_packed_refs().get(refname)
+            if not content.startswith('ref:'):
+                return content
+            refname = content[len('ref:'):].strip()
+        return None
+
+    def resolve(self, name):
+        """the hash a full hash or ref name points at, searched like git rev-parse, None if there is no such ref"""
+        if self.is_hash(name):
+            return name.lower()
+        if any(syntax in name for syntax in self.REVISION_SYNTAX):
+            raise UnsupportedRepository('revision:{}'.format(name))
+        for refname in (name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name, 'refs/remotes/' + name,
+                        'refs/remotes/{}/HEAD'.format(name)):
+            hash_ = self.resolve_ref(refname)
+            if hash_:
+                return hash_
+        return None
+
+    def read_object(self, name):
+        hash_ = self.resolve(name)
+        if hash_ is None:
+            return None
+        obj = self.read_hash(hash_)
+        return None if obj is None else (hash_, obj[0], obj[1])
+
+    def read_hash(self, hash_):
+        """(type, content) of an object, None if it is missing"""
+        obj = self.read_packed_object(hash_) or self.read_loose_object(hash_)
+        if obj is None and self.refresh_packs():
+            obj = self.read_packed_object(hash_)  # in a pack added since (e.g. by a fetch or a repack)
+        return obj
+
+    def read_loose_object(self, hash_):
+        for objects_dir in self.object_dirs:
+            try:
+                with open(os.path.join(objects_dir, hash_[:2], hash_[2:]), 'rb') as f:
+                    data = zlib.decompress(f.read())
+            except FileNotFoundError:
+                continue
+            header, _, content = data.partition(b'\0')
+            return header.split()[0].decode(), content
+        return None
+
+    def read_packed_object(self, hash_):
+        hash_bytes = bytes.fromhex(hash_)
+        for pack in list(self.packs.values()):  # a ref delta may refresh the packs while a pack is read
+            offset = pack.find(hash_bytes)
+            if offset is not None:
+                return pack.read(offset, self.read_hash)
+        return None
+
+    def refresh_packs(self) -> bool:
+        """
+        re-scan the pack dirs: close the packs which are gone (e.g. after a repack or gc) and open the packs not opened
+        yet, return whether there were any new ones
+        """
+        idx_paths = []
+        for objects_dir in self.object_dirs:
+            pack_dir = os.path.join(objects_dir, 'pack')
+            idx_paths += [os.path.join(pack_dir, file_name)
+                          for file_name in (sorted(os.listdir(pack_dir)) if os.path.isdir(pack_dir) else [])
+                          if file_name.endswith('.idx')]
+        for idx_path in set(self.packs) - set(idx_paths):
+            self.packs.pop(idx_path).close()
+        opened = False
+        for idx_path in idx_paths:
+            if idx_path not in self.packs:
+                self.packs[idx_path] = PackFile(idx_path)
+                opened = True
+        return opened
+
+    def close(self):
+        super().close()
+        for pack in self.packs.values():
+            pack.close()
+        self.packs.clear()
+
+
+class PackFile(object):
+    """a pack and its v2 index, memory mapped"""
+    IDX_V2_HEADER = b'\377tOc\0\0\0\2'
+    OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+    OFS_DELTA = 6
+    REF_DELTA = 7
+    MAX_CACHED_OBJECTS = 256  # recently read objects, delta chains share their bases
+
+    def __init__(self, idx_path):
+        self.idx = self.map_file(idx_path)
+        if self.idx[:8] != self.IDX_V2_HEADER:
+            self.idx.close()
+            raise UnsupportedRepository('pack index version:{}'.format(idx_path))
+        self.pack = self.map_file(idx_path[:-len('.idx')] + '.pack')
+        self.pack_view = memoryview(self.pack)
+        # 256 cumulative counts by first hash byte, hashes (sorted), crc32s, offsets, large offsets
+        self.fanout = struct.unpack_from('>256I', self.idx, 8)
+        self.hashes_start = 8 + 256 * 4
+        self.offsets_start = self.hashes_start + 24 * self.fanout[255]
+        self.large_offsets_start = self.offsets_start + 4 * self.fanout[255]
+        self.cached_objects = {}  # offset: (type, content)
+
+    @staticmethod
+    def map_file(path):
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find(self, hash_bytes):
+        """offset of an object in the pack, None if it is not in the pack"""
+        low = self.fanout[hash_bytes[0] - 1] if hash_bytes[0] else 0
+        high = self.fanout[hash_bytes[0]]
+        while low < high:
+            middle = (low + high) // 2
+            start = self.hashes_start + 20 * middle
+            middle_hash = self.idx[start:start + 20]
+            if middle_hash < hash_bytes:
+                low = middle + 1
+            elif middle_hash > hash_bytes:
+                high = middle
+            else:
+                offset, = struct.unpack_from('>I', self.idx, self.offsets_start + 4 * middle)
+                if offset & 0x80000000:
+                    offset, = struct.unpack_from('>Q', self.idx, self.large_offsets_start + 8 * (offset & 0x7fffffff))
+                return offset
+        return None
+
+    def read(self, offset, read_hash):
+        """(type, content) of the object at offset, read_hash reads the bases of REF_DELTA objects by hash"""
+        deltas = []  # (offset, delta) from the object down to its base
+        while True:
+            if offset in self.cached_objects:
+                type_name, content = self.cached_objects[offset]
+                break
+            type_, size, pos = self.read_object_header(offset)
+            if type_ == self.OFS_DELTA:
+                base_distance, pos = self.read_base_distance(pos)
+                deltas.append((offset, self.inflate(pos, size)))
+                offset -= base_distance
+            elif type_ == self.REF_DELTA:
+                deltas.append((offset, self.inflate(pos + 20, size)))
+                base = read_hash(self.pack[pos:pos + 20].hex())
+                if base is None:
+                    raise UnsupportedRepository('missing delta base')  # e.g. a thin pack
+                type_name, content = base
+                break
+            elif type_ in self.OBJECT_TYPES:
+                type_name, content = self.OBJECT_TYPES[type_], self.inflate(pos, size)
+                self.cache_object(offset, type_name, content)
+                break
+            else:
+                raise UnsupportedRepository('pack object type:{}'.format(type_))
+        for offset, delta in reversed(deltas):
+            content = self.apply_delta(content, delta)
+            self.cache_object(offset, type_name, content)
+        return type_name, content
+
+    def cache_object(self, offset, type_name, content):
+        if len(self.cached_objects) >= self.MAX_CACHED_OBJECTS:
+            del self.cached_objects[next(iter(self.cached_objects))]
+        self.cached_objects[offset] = (type_name, content)
+
+    def read_object_header(self, pos):
+        """type, inflated size and start of the data of the object at pos"""
+        byte = self.pack[pos]
+        type_, size, shift = (byte >> 4) & 7, byte & 15, 4
+        pos += 1
+        while byte & 0x80:
+            byte = self.pack[pos]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+        return type_, size, pos
+
+    def read_base_distance(self, pos):
+        byte = self.pack[pos]
+        distance = byte & 0x7f
+        pos += 1
+        while byte & 0x80:
+            byte = self.pack[pos]
+            distance = ((distance + 1) << 7) | (byte & 0x7f)
+            pos += 1
+        return distance, pos
+
+    def inflate(self, pos, size):
+        # fed in chunks, so what follows the object in the pack is not copied
+        decompressor = zlib.decompressobj()
+        chunks = []
+        chunk_size = max(size + 64, 4096)
+        while not decompressor.eof and pos < len(self.pack):
+            chunks.append(decompressor.decompress(self.pack_view[pos:pos + chunk_size]))
+            pos += chunk_size
+        return b''.join(chunks)
+
+    @staticmethod
+    def apply_delta(base, delta):
+        def read_size(pos):
+            size = shift = 0
+            while True:
+                byte = delta[pos]
+                size |= (byte & 0x7f) << shift
+                shift += 7
+                pos += 1
+                if not byte & 0x80:
+                    return size, pos
+
+        # the sizes of the base and the result, then instructions to copy from the base or insert new data
+        base_size, pos = read_size(0)
+        result_size, pos = read_size(pos)
+        result = bytearray()
+        while pos < len(delta):
+            instruction = delta[pos]
+            pos += 1
+            if instruction & 0x80:
+                offset = size = 0
+                for i in range(4):
+                    if instruction & (1 << i):
+                        offset |= delta[pos] << (8 * i)
+                        pos += 1
+                for i in range(3):
+                    if instruction & (0x10 << i):
+                        size |= delta[pos] << (8 * i)
+                        pos += 1
+                result += base[offset:offset + (size or 0x10000)]
+            elif instruction:
+                result += delta[pos:pos + instruction]
+                pos += instruction
+            else:
+                raise UnsupportedRepository('delta instruction 0')
+        if len(result) != result_size:
+            raise UnsupportedRepository('delta result size')
+        return bytes(result)
+
+    def close(self):
+        self.cached_objects.clear()
+        self.pack_view.release()
+        self.pack.close()
+        self.idx.close()
+
+
+class CommitGraph(object):
+    """
+    the commit-graph of a repo (a single file, or a chain of split layers), which git writes so history can be walked
+    without inflating commits: for each commit its parents, commit date and generation number (topological level)
+    """
+    SIGNATURE = b'CGPH'
+    NO_PARENT = 0x70000000
+    EXTRA_EDGES = 0x80000000  # a second parent with this bit is an index into the extra edges of octopus merges
+    INFINITY = float('inf')  # the generation of commits which are not in the graph (newer than the graph)
+    LAYER = namedtuple('LAYER', ['data', 'fanout', 'hashes_start', 'commits_start', 'edges_start', 'first'])
+
+    def __init__(self, paths):
+        self.layers = []  # base layer first, positions of commits count from the base layer
+        try:
+            for path in paths:
+                self.layers.append(self.open_layer(path, sum(layer.fanout[255] for layer in self.layers)))
+        except BaseException:
+            self.close()
+            raise
+
+    @classmethod
+    def open(cls, objects_dir):
+        """the commit-graph of objects_dir, None if it has none that can be read"""
+        info_dir = os.path.join(objects_dir, 'info')
+        chain_path = os.path.join(info_dir, 'commit-graphs', 'commit-graph-chain')
+        try:
+            if os.path.isfile(os.path.join(info_dir, 'commit-graph')):
+                return cls([os.path.join(info_dir, 'commit-graph')])
+            if os.path.isfile(chain_path):
+                with open(chain_path) as f:
+                    return cls([os.path.join(info_dir, 'commit-graphs', 'graph-{}.graph'.format(line.strip()))
+                                for line in f if line.strip()])
+        except (OSError, ValueError, KeyError, struct.error):
+            pass  # walked without it
+        return None
+
+    def open_layer(self, path, first):
+        data = PackFile.map_file(path)
+        try:
+            # signature, version 1, hash version 1 (sha1), number of chunks, then the table of chunk offsets
+            if data[:4] != self.SIGNATURE or data[4] != 1 or data[5] != 1:
+                raise ValueError('commit-graph format:{}'.format(path))
+            chunks = dict(struct.unpack_from('>4sQ', data, 8 + 12 * i) for i in range(data[6]))
+            fanout = struct.unpack_from('>256I', data, chunks[b'OIDF'])
+            layer = self.LAYER(data, fanout, chunks[b'OIDL'], chunks[b'CDAT'], chunks.get(b'EDGE'), first)
+            if fanout[255] and self.read_generation(layer, 0) == 0:
+                raise ValueError('commit-graph without generation numbers:{}'.format(path))
+        except BaseException:
+            data.close()
+            raise
+        return layer
+
+    def find(self, hash_bytes):
+        """position of a commit in the graph, None if it is not in the graph"""
+        for layer in self.layers:
+            low = layer.fanout[hash_bytes[0] - 1] if hash_bytes[0] else 0
+            high = layer.fanout[hash_bytes[0]]
+            while low < high:
+                middle = (low + high) // 2
+                start = layer.hashes_start + 20 * middle
+                middle_hash = layer.data[start:start + 20]
+                if middle_hash < hash_bytes:
+                    low = middle + 1
+                elif middle_hash > hash_bytes:
+                    high = middle
+                else:
+                    return layer.first + middle
+        return None
+
+    def layer_of(self, position):
+        for layer in reversed(self.layers):
+            if position >= layer.first:
+                return layer, position - layer.first
+        raise ValueError('commit-graph position:{}'.format(position))
+
+    def hash_at(self, position):
+        layer, index = self.layer_of(position)
+        start = layer.hashes_start + 20 * index
+        return layer.data[start:start + 20].hex()
+
+    @staticmethod
+    def read_generation(layer, index):
+        return struct.unpack_from('>Q', layer.data, layer.commits_start + 36 * index + 28)[0] >> 34
+
+    def read_commit(self, hash_):
+        """(hash, parent hashes, commit timestamp, generation) of a commit, None if it is not in the graph"""
+        position = self.find(bytes.fromhex(hash_))
+        if position is None:
+            return None
+        layer, index = self.layer_of(position)
+        # the tree hash, two parent positions, then 30 bits of generation and 34 bits of commit date
+        first_parent, second_parent, generation_and_date = struct.unpack_from(
+            '>IIQ', layer.data, layer.commits_start + 36 * index + 20)
+        parents = []
+        if first_parent != self.NO_PARENT:
+            parents.append(self.hash_at(first_parent))
+        if second_parent & self.EXTRA_EDGES:
+            edge = second_parent & ~self.EXTRA_EDGES
+            while True:
+                parent, = struct.unpack_from('>I', layer.data, layer.edges_start + 4 * edge)
+                parents.append(self.hash_at(parent & ~self.EXTRA_EDGES))
+                if parent & self.EXTRA_EDGES:
+                    break  # the last parent
+                edge += 1
+        elif second_parent != self.NO_PARENT:
+            parents.append(self.hash_at(second_parent))
+        return hash_, tuple(parents), generation_and_date & ((1 << 34) - 1), generation_and_date >> 34
+
+    def close(self):
+        for layer in self.layers:
+            layer.data.close()
+        self.layers = []
+
+
+GIT_BACKENDS = {backend.name: backend for backend in (SubprocessGitBackend, CatFileGitBackend, OdbGitBackend)}
+
+
+class RefWatcher(object):
+    """
+    waits for the remote refs of repos to change (refs/remotes and packed-refs, as written by fetch)
+
+    uses inotify (through ctypes) where the platform has it, otherwise polls the mtime and size of the ref files.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000  # events were dropped, reported with wd -1
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    REF_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+    SETTLE_SECONDS = 0.2  # a fetch updates many refs, they are reported as one change
+    POLL_INTERVAL_DEFAULT = 2
+
+    def __init__(self, repo_dirs, use_inotify=True, poll_interval=POLL_INTERVAL_DEFAULT):
+        self.common_dirs = {repo_dir: OdbReader.find_git_dirs(repo_dir)[1] for repo_dir in repo_dirs}
+        self.poll_interval = poll_interval
+        self.libc, self.fd = self.init_inotify() if use_inotify else (None, None)
+        self.watches = {}  # watch descriptor: (repo_dir, watched dir)
+        self.signatures = {}  # repo_dir: signature of its ref files (when polling)
+        for repo_dir, common_dir in self.common_dirs.items():
+            if self.fd is not None:
+                self.add_watches(repo_dir)
+            else:
+                self.signatures[repo_dir] = self.ref_files_signature(common_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def init_inotify(cls):
+        """(libc, inotify file descriptor), (None, None) where inotify is not available"""
+        library = ctypes.util.find_library('c') if sys.platform.startswith('linux') else None
+        if library is None:
+            return None, None
+        libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None, None
+        fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        if fd < 0:
+            return None, None
+        return libc, fd
+
+    def add_watches(self, repo_dir):
+        common_dir = self.common_dirs[repo_dir]
+        self.add_watch(repo_dir, common_dir)
+        self.add_watch(repo_dir, os.path.join(common_dir, 'refs'))  # refs/remotes may not exist yet
+        for dir_path, dir_names, names in os.walk(os.path.join(common_dir, 'refs', 'remotes')):
+            self.add_watch(repo_dir, dir_path)
+
+    def add_watch(self, repo_dir, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.REF_EVENTS)
+        if wd >= 0:
+            self.watches[wd] = (repo_dir, path)
+
+    @staticmethod
+    def ref_files_signature(common_dir):
+        signature = []
+        paths = [os.path.join(common_dir, 'packed-refs')]
+        for dir_path, dir_names, names in os.walk(os.path.join(common_dir, 'refs', 'remotes')):
+            paths.extend(os.path.join(dir_path, name) for name in names)
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    def wait(self, timeout) -> set:
+        """wait up to timeout seconds for changes, and return the repo dirs whose refs changed (maybe none)"""
+        if self.fd is None:
+            return self.poll(timeout)
+        changed = self.read_events(timeout)
+        if changed:
+            while True:
+                more = self.read_events(self.SETTLE_SECONDS)
+                if not more:
+                    break
+                changed |= more
+        return changed
+
+    def read_events(self, timeout) -> set:
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + self.EVENT_HEADER.size:pos + self.EVENT_HEADER.size + length].rstrip(b'\0'))
+            pos += self.EVENT_HEADER.size + length
+            if wd == -1 and mask & self.IN_Q_OVERFLOW:
+                # the events which did not fit the queue are lost, any repo may have changed (and have new dirs)
+                for repo_dir in self.common_dirs:
+                    self.add_watches(repo_dir)
+                changed.update(self.common_dirs)
+                continue
+            if wd not in self.watches:
+                continue
+            repo_dir, path = self.watches[wd]
+            if path == self.common_dirs[repo_dir]:
+                if name == 'packed-refs':
+                    changed.add(repo_dir)
+                continue
+            if path == os.path.join(self.common_dirs[repo_dir], 'refs') and name != 'remotes':
+                continue
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # a new namespace of branches (feature/...), its refs may be written before the watch is added
+                for dir_path, dir_names, names in os.walk(os.path.join(path, name)):
+                    self.add_watch(repo_dir, dir_path)
+            if not name.endswith('.lock'):
+                changed.add(repo_dir)
+        return changed
+
+    def poll(self, timeout) -> set:
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = set()
+            for repo_dir, common_dir in self.common_dirs.items():
+                signature = self.ref_files_signature(common_dir)
+                if signature != self.signatures[repo_dir]:
+                    self.signatures[repo_dir] = signature
+                    changed.add(repo_dir)
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ScanFacts(object):
+    """
+    the results of a multi-scan indexed once into a flat table, to group them in any way without walking them again
+
+    a fact per (scan, branch, author) in the order of the results, with the author's unmerged commits and the epoch
+    of the newest one. the table is kept as columns (a list per field), each grouping (by repo, by email, by age, the
+    pipeline report) is one pass over them, in the same order and with the same output as walking the results.
+    """
+    FACT = namedtuple('FACT', ['scan', 'repo_dir', 'target', 'branch', 'author', 'commits', 'newest_timestamp'])
+    AGE_BUCKETS = (0, 30, 60, 90, 180, 365)  # the lower bound (days) of each bucket
+
+    def __init__(self, results_by_branch):
+        self.results = list(results_by_branch)
+        self.fact_ranges = []  # the (start, end) of the facts of each scan
+        self.branches = []
+        self.authors = []
+        self.commits = []
+        for result in self.results:
+            start = len(self.authors)
+            for branch, commits_by_author in (result['report'] or {}).items():
+                self.branches.extend([branch] * len(commits_by_author))
+                self.authors.extend(commits_by_author)
+                self.commits.extend(commits_by_author.values())
+            self.fact_ranges.append((start, len(self.authors)))
+        self.newest_timestamps = self.newest_timestamps_of(self.commits)
+
+    @classmethod
+    def of(cls, results_by_branch):
+        """the facts of results, which may be indexed already"""
+        return results_by_branch if isinstance(results_by_branch, cls) else cls(results_by_branch)
+
+    @staticmethod
+    def newest_timestamps_of(commits_lists) -> list:
+        try:
+            get_timestamp = operator.attrgetter('timestamp')
+            return [max(map(get_timestamp, commits)) for commits in commits_lists]
+        except AttributeError:
+            # commit dicts of a written report
+            return [max(map(StaleBranchIndex.commit_timestamp, commits)) for commits in commits_lists]
+
+    def facts_of(self, scan):
+        """the facts of a scan (FACT tuples)"""
+        result = self.results[scan]
+        for i in range(*self.fact_ranges[scan]):
+            yield self.FACT(scan, result['repo_dir'], result['branch'], self.branches[i], self.authors[i],
+                            self.commits[i], self.newest_timestamps[i])
+
+    def __iter__(self):
+        for scan in range(len(self.results)):
+            yield from self.facts_of(scan)
+
+    def __len__(self):
+        return len(self.authors)
+
+    def by_repo(self) -> dict:
+        """{repo_dir: {target: report}}"""
+        return self.group_by_repo(self.results)
+
+    @staticmethod
+    def group_by_repo(results_by_branch) -> dict:
+        """by_repo of results which are not indexed (it only needs the reports)"""
+        results_by_repo = {}
+        for result in results_by_branch:
+            results_by_repo.setdefault(result['repo_dir'], {})[result['branch']] = result['report']
+        return results_by_repo
+
+    def by_email(self) -> dict:
+        """{author: {repo_dir: {target: commits}}}, when several branches of a target have commits of an author the
+        commits of the last one are kept"""
+        results_by_email = {}
+        for result, (start, end) in zip(self.results, self.fact_ranges):
+            repo_dir, target = result['repo_dir'], result['branch']
+            for author, commits in zip(self.authors[start:end], self.commits[start:end]):
+                results_by_email.setdefault(author, {}).setdefault(repo_dir, {})[target] = commits
+        return results_by_email
+
+    def by_age(self, now, buckets=AGE_BUCKETS) -> dict:
+        """
+        {bucket: [...]} of the facts by the age (days) of their newest commit at now, oldest first in each bucket
+
+        buckets are named by their days, like '30-59' and '365+', every bucket is listed even when empty.
+        """
+        names = ['{}-{}'.format(low, high - 1) for low, high in zip(buckets, buckets[1:])] + ['{}+'.format(buckets[-1])]
+        results_by_age = {name: [] for name in names}
+        for fact in sorted(self, key=lambda fact_: fact_.newest_timestamp):
+            days = ScanUnmergedBranches.days_between(fact.newest_timestamp, now)
+            bucket = bisect.bisect_right(buckets, days) - 1
+            if bucket < 0:
+                continue  # newer than the first bucket (a commit from the future)
+            results_by_age[names[bucket]].append({
+                'repo_dir': fact.repo_dir, 'target': fact.target, 'branch': fact.branch, 'author': fact.author,
+                'commits': len(fact.commits), 'days': days})
+        return results_by_age
+
+    def pipeline_report(self, now) -> dict:
+        """{'scans': {scan_id: report}, 'message': ...} with the stale branches of each scan and their age"""
+        pipeline_results = {'scans': {}}
+        message_lines = []  # message for sending to slack
+        repo_names = [os.path.basename(result['repo_dir']) for result in self.results]  # we assume they are unique
+        days_between = ScanUnmergedBranches.days_between
+        days = [days_between(timestamp, now) for timestamp in self.newest_timestamps]
+        branch_line = '    * {} ({} days)'.format
+        order = sorted(range(len(self.results)), key=lambda scan_: (repo_names[scan_], self.results[scan_]['branch']))
+        for scan in order:
+            result = self.results[scan]
+            scan_id = '<{}>:{}'.format(repo_names[scan], result['branch'])
+            if not result['report']:
+                # fresh repo, add it to the message so we know it was scanned, and mark is as fresh.
+                message_lines.append(' - {} *fresh*'.format(scan_id))
+                continue
+            pipeline_results['scans'][scan_id] = result['report']
+            message_lines.append(' - {}'.format(scan_id))
+            # how stale each branch is, by the most recent commit of each of its authors
+            start, end = self.fact_ranges[scan]
+            message_lines.extend(map(branch_line, self.branches[start:end], days[start:end]))
+        pipeline_results['message'] = '\n'.join(message_lines)
+        return pipeline_results
+
+
+class StaleBranchIndex(object):
+    """
+    the stale branches of scan_multiple results, indexed for queries by author, repo, target branch and age
+
+    a row per (repo_dir, target, branch, author), with the number and newest date of the author's unmerged commits.
+    each field maps its values to row ids, and rows are also kept sorted by their newest commit, so "older than n
+    days" is a bisect. an index is not changed once built, newer results build a new index.
+    """
+    ROW = namedtuple('ROW', ['repo_dir', 'target', 'branch', 'author', 'commits', 'newest_timestamp'])
+    FIELDS = ('author', 'repo', 'target', 'branch')
+
+    def __init__(self, results_by_branch, created=None):
+        self.created = int(time.time()) if created is None else created
+        self.rows = []
+        self.ids_by_field = {field: {} for field in self.FIELDS}
+        facts = ScanFacts.of(results_by_branch)
+        for fact in facts:
+            self.add_row(self.ROW(fact.repo_dir, fact.target, fact.branch, fact.author, len(fact.commits),
+                                  fact.newest_timestamp))
+        self.ids_by_age = sorted(range(len(self.rows)), key=lambda id_: self.rows[id_].newest_timestamp)
+        self.timestamps_by_age = [self.rows[id_].newest_timestamp for id_ in self.ids_by_age]
+
+    @staticmethod
+    def commit_timestamp(commit):
+        """a CommitRecord, or a commit dict of a written report"""
+        if isinstance(commit, CommitRecord):
+            return commit.timestamp
+        return int(datetime.datetime.fromisoformat(commit['date']).timestamp())
+
+    def add_row(self, row):
+        id_ = len(self.rows)
+        self.rows.append(row)
+        # a repo is found by its repo_dir (or url) and by its name
+        keys = {'author': [row.author], 'repo': {row.repo_dir, os.path.basename(row.repo_dir.rstrip('/'))},
+                'target': [row.target], 'branch': [row.branch]}
+        for field, values in keys.items():
+            for value in values:
+                self.ids_by_field[field].setdefault(value, []).append(id_)
+
+    def query(self, older_than=None, now=None, **filters) -> list:
+        """
+        the rows (as dicts, oldest first) which match every filter (field=value) and whose newest commit is at least
+        older_than days old at now
+        """
+        assert set(filters) <= set(self.FIELDS), 'unknown filters:{}'.format(sorted(set(filters) - set(self.FIELDS)))
+        now = int(time.time()) if now is None else now
+        # intersect the row ids of the filters, smallest first
+        id_lists = sorted((self.ids_by_field[field].get(value, []) for field, value in filters.items()), key=len)
+        if id_lists:
+            ids = set(id_lists[0])
+            for id_list in id_lists[1:]:
+                ids.intersection_update(id_list)
+            ids = sorted(ids, key=lambda id_: self.rows[id_].newest_timestamp)
+        else:
+            ids = self.ids_by_age
+        if older_than is not None:
+            newest_allowed = now - older_than * 86400
+            if id_lists:
+                ids = [id_ for id_ in ids if self.rows[id_].newest_timestamp <= newest_allowed]
+            else:
+                ids = ids[:bisect.bisect_right(self.timestamps_by_age, newest_allowed)]
+        return [self.row_dict(self.rows[id_], now) for id_ in ids]
+
+    @staticmethod
+    def row_dict(row, now):
+        row_dict = row._asdict()
+        row_dict['days'] = ScanUnmergedBranches.days_between(row.newest_timestamp, now)
+        return row_dict
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ScanQueryServer(ThreadingHTTPServer):
+    """
+    http server answering queries from a StaleBranchIndex
+
+    update swaps in the index of new results, requests being answered keep the index they started with.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, index=None):
+        super().__init__(server_address, ScanQueryHandler)
+        self.index = index if index is not None else StaleBranchIndex([])
+
+    def update(self, results_by_branch):
+        self.index = StaleBranchIndex(results_by_branch)
+
+
+class ScanQueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /branches?author=&repo=&target=&branch=&older_than= (all optional) lists the matching stale branches,
+    GET /health tells when the index was built
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        index = self.server.index
+        if url.path == '/health':
+            self.send_json(200, {'created': index.created, 'rows': len(index)})
+        elif url.path == '/branches':
+            params = dict(urllib.parse.parse_qsl(url.query))
+            older_than = params.pop('older_than', None)
+            unknown = set(params) - set(StaleBranchIndex.FIELDS)
+            if unknown or (older_than is not None and not older_than.isdigit()):
+                self.send_json(400, {'error': 'unknown parameters:{} or bad older_than:{}'.format(
+                    sorted(unknown), older_than)})
+                return
+            older_than = int(older_than) if older_than is not None else None
+            self.send_json(200, {'created': index.created, 'branches': index.query(older_than, **params)})
+        else:
+            self.send_json(404, {'error': 'not found:{}'.format(url.path)})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
 class ScanUnmergedBranches(object):
+    BRANCH_REF = GitBackend.BRANCH_REF
     COMMIT_DETAILS = namedtuple('COMMIT_DETAILS', ['hash', 'date', 'author', 'subject'])
     DATE_FRMT = '%Y-%m-%dT%H:%M:%S%z'
+    FETCH_RESULT = namedtuple('FETCH_RESULT', ['res', 'duration'])
+    SCAN_OPTIONS = namedtuple('SCAN_OPTIONS', ['return_report', 'include_main', 'fetch_first', 'save_scan', 'stale',
+                                               'batch', 'pushdown', 'cache', 'now', 'metrics', 'metrics_file',
+                                               'backend', 'write_commit_graph', 'skip_unchanged', 'summary'])
+    BRANCH_SUMMARY = namedtuple('BRANCH_SUMMARY', ['commits', 'newest', 'oldest', 'authors'])
+    UNSHALLOW_COMPLETE_ERROR = '--unshallow on a complete repository does not make sense'
     STALE_DAYS_DEFAULT = '7'
     default_main_branch = DEFAULT_MAIN_BRANCH
 
@@ -45,96 +2301,536 @@ class ScanUnmergedBranches(object):
         self.save_scans = kwargs.pop('save_scans', False)
         self.scans = []
         self.main_branch_name = kwargs.pop('main_branch_name', self.default_main_branch)
+        self.caches = {}
+        self.caches_lock = threading.Lock()
+        self.memory_cache = MemoryScanCache()  # for scans with memory_cache, which last as long as the scanner
+        self.mirror_caches = {}  # cache_dir: MirrorCache
+        self.histories = {}  # path: ScanHistory
+        self.mirror_dirs = {}  # url: dir of its mirror, locked for the duration of a multi-scan
+        self.backends = {}  # name: GitBackend
+        self.backends_lock = threading.Lock()
+        self.shallow_repos = {}  # repo_dir: whether it is shallow, as learned from fetching it
+        self.fetch_results = {}  # repo_dir: FETCH_RESULT of the last fetch stage of a multi-scan
+        self.fetch_metrics = {}  # repo_dir: ScanMetrics of its fetch in the fetch stage
+        self.remote_fingerprints = {}  # repo_dir: fingerprint of its remote refs as of its last fetch (skip_unchanged)
+        self.last_scan_metrics = None  # ScanMetrics.as_dict() of the last scan with metrics, saved or not
         super().__init__()
 
+    def open_cache(self, cache_dir, **kwargs) -> ScanCache:
+        """open (once per scanner) the scan cache in cache_dir, evicting old entries when it is first opened"""
+        cache_dir = os.path.abspath(cache_dir)
+        with self.caches_lock:
+            if cache_dir not in self.caches:
+                cache = ScanCache(cache_dir, **kwargs)
+                cache.evict()
+                self.caches[cache_dir] = cache
+            return self.caches[cache_dir]
+
+    def open_history(self, path) -> ScanHistory:
+        """open (once per scanner) the scan history in path"""
+        path = os.path.abspath(path)
+        with self.caches_lock:
+            if path not in self.histories:
+                self.histories[path] = ScanHistory(path)
+            return self.histories[path]
+
+    def open_mirror_cache(self, cache_dir=None, **kwargs) -> MirrorCache:
+        """open (once per scanner) the mirror cache in cache_dir, evicting mirrors when it is first opened"""
+        cache_dir = os.path.abspath(cache_dir or MirrorCache.default_cache_dir())
+        with self.caches_lock:
+            if cache_dir not in self.mirror_caches:
+                mirrors = MirrorCache(cache_dir, **kwargs)
+                mirrors.evict()
+                self.mirror_caches[cache_dir] = mirrors
+            return self.mirror_caches[cache_dir]
+
+    def open_backend(self, name=DEFAULT_GIT_BACKEND) -> GitBackend:
+        """the git backend of this scanner by name (see GIT_BACKENDS), kept open until close"""
+        assert name in GIT_BACKENDS, 'backend:{} (expected one of {})'.format(name, ', '.join(GIT_BACKENDS))
+        with self.backends_lock:
+            if name not in self.backends:
+                self.backends[name] = GIT_BACKENDS[name]()
+            return self.backends[name]
+
+    def close(self):
+        """
+        stop the processes of the git backends and close the scan caches and histories,
+        they are started / opened again by the next scan which needs them
+        """
+        with self.backends_lock:
+            for backend in self.backends.values():
+                backend.close()
+            self.backends.clear()
+        with self.caches_lock:
+            for db in list(self.caches.values()) + list(self.histories.values()):
+                db.close()
+            self.caches.clear()
+            self.histories.clear()
+
+    @staticmethod
+    def to_remote_ref(branch):
+        return branch if branch.startswith('origin/') else 'origin/{}'.format(branch)
+
     def scan(self, branch=None, repo_dir='.', **kwargs):
+        with ScanTracer.tracing(kwargs.pop('trace', None)):
+            return self.materialize_report(run_git_steps(self.scan_steps(branch, repo_dir, **kwargs)))
+
+    async def scan_async(self, branch=None, repo_dir='.', **kwargs):
+        """same as scan, git commands run as asyncio subprocesses (optionally bounded by a semaphore)"""
+        semaphore = kwargs.pop('semaphore', None)
+        with ScanTracer.tracing(kwargs.pop('trace', None)):
+            return self.materialize_report(
+                await run_git_steps_async(self.scan_steps(branch, repo_dir, **kwargs), semaphore))
+
+    def scan_steps(self, branch=None, repo_dir='.', **kwargs):
         branch = branch or self.main_branch_name
         # verify args
         self.assert_no_whitespace(branch, 'branch:{}'.format(branch))
         self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
+        if MirrorCache.is_url(repo_dir):
+            return (yield from self.mirror_scan_steps(branch, repo_dir, **kwargs))
+        return (yield from self.local_scan_steps(branch, repo_dir, repo_dir, kwargs))
+
+    def local_scan_steps(self, branch, repo_dir, reported_repo_dir, kwargs):
+        """scan the repo in repo_dir, reported (and saved) as reported_repo_dir, the url of a mirror"""
         # extract kwargs
         scan_kwargs = kwargs.copy()
+        options = self.pop_scan_options(kwargs)
+        steps = self.scan_repo_steps(branch, repo_dir, reported_repo_dir, options, scan_kwargs, kwargs)
+        if ScanTracer.active is not None:
+            steps = ScanTracer.active.trace_steps('scan', steps, 'scan', branch=branch, repo_dir=reported_repo_dir)
+        return (yield from steps)
+
+    def scan_repo_steps(self, branch, repo_dir, reported_repo_dir, options, scan_kwargs, kwargs):
+        metrics = options.metrics
+        # perform git fetch if needed
+        if options.fetch_first:
+            yield from self.measure_steps(metrics, 'fetch', self.git_fetch_steps(
+                repo_dir, write_commit_graph=options.write_commit_graph,
+                cache=options.cache if options.skip_unchanged else None))
+        # while the remote refs are unchanged, so are the branches listed the last time
+        fingerprint = self.remote_fingerprints.get(os.path.abspath(repo_dir)) if options.skip_unchanged else None
+        listing = None
+        if fingerprint is not None:
+            listing = options.cache.get_listing(os.path.abspath(repo_dir), branch, options.include_main, fingerprint)
+        if listing is not None:
+            unmerged_branches = listing['branches']
+            refs = {name: self.BRANCH_REF(*ref) for name, ref in listing['refs'].items()}
+        else:
+            # scan unmerged branches
+            unmerged_branches = yield from self.measure_steps(metrics, 'list_branches', self.unmerged_branches_steps(
+                branch, repo_dir, include_main=options.include_main, backend=options.backend))
+            refs = None
+            if (options.pushdown and unmerged_branches) or fingerprint is not None:
+                refs = yield from self.measure_steps(metrics, 'branch_refs', self.remote_branch_refs_steps(
+                    repo_dir, backend=options.backend))
+            if fingerprint is not None:
+                options.cache.put_listing(os.path.abspath(repo_dir), branch, options.include_main, fingerprint,
+                                          {'branches': unmerged_branches, 'refs': refs})
+        tips = None
+        if refs is not None:
+            tips = {name: ref.hash for name, ref in refs.items()}
+        # drop branches which are fresh according to their tip alone, before walking any history
+        if options.pushdown and unmerged_branches:
+            unmerged_branches = self.drop_fresh_branches(unmerged_branches, refs, options.stale, options.now)
+        # fetch unmerged commits for branches
+        if options.summary:
+            unmerged_commits_by_branch = yield from self.measure_steps(
+                metrics, 'collect_commits', self.summaries_by_branch_steps(
+                    unmerged_branches, branch, repo_dir, batch=options.batch, tips=tips, backend=options.backend))
+        else:
+            unmerged_commits_by_branch = yield from self.measure_steps(
+                metrics, 'collect_commits', self.unmerged_commits_by_branch_steps(
+                    unmerged_branches, branch, repo_dir, batch=options.batch, cache=options.cache, tips=tips,
+                    backend=options.backend))
+        return self.finish_scan(branch, reported_repo_dir, unmerged_commits_by_branch, options, scan_kwargs, kwargs)
+
+    def mirror_scan_steps(self, branch, url, **kwargs):
+        """scan the remote repo at url from its mirror (see MirrorCache)"""
+        mirror_options = self.pop_mirror_options(kwargs)
+        if url in self.mirror_dirs:
+            # locked and fetched by the multi-scan
+            return (yield from self.local_scan_steps(branch, self.mirror_dirs[url], url, kwargs))
+        mirrors = self.open_mirror_cache(**mirror_options)
+        # waiting for the lock blocks, on an event loop it is waited for in an executor
+        lock_file = yield BlockingCall(lambda: mirrors.lock(url))
+        with lock_file:
+            mirror_dir = mirrors.mirror_dir(url)
+            if not mirrors.is_fetched(mirror_dir):
+                yield from mirrors.create_steps(url, mirror_dir)
+                kwargs['fetch_first'] = True
+            return (yield from self.local_scan_steps(branch, mirror_dir, url, kwargs))
+
+    @staticmethod
+    def pop_mirror_options(kwargs) -> dict:
+        return {'cache_dir': kwargs.pop('mirror_dir', None),
+                'max_mb': int(kwargs.pop('mirror_max_mb', None) or MirrorCache.MAX_MB_DEFAULT)}
+
+    @contextlib.contextmanager
+    def mirrored(self, scan_calls):
+        """
+        lock the mirrors of the urls among scan_calls (creating missing ones) for the duration of a multi-scan
+
+        yields the same scan calls, those of mirrors which were never fetched with fetch_first
+        """
+        mirrors_by_url = {}
+        for branch, repo_dir, scan_kwargs in scan_calls:
+            if MirrorCache.is_url(repo_dir) and repo_dir not in mirrors_by_url:
+                mirrors_by_url[repo_dir] = self.open_mirror_cache(**self.pop_mirror_options(dict(scan_kwargs)))
+        created = set()
+        with contextlib.ExitStack() as stack:
+            # always lock in the same order, so two multi-scans of the same urls can not wait for each other
+            for url, mirrors in sorted(mirrors_by_url.items(), key=lambda item: item[1].mirror_dir(item[0])):
+                mirror_dir = stack.enter_context(mirrors.locked(url))
+                if not mirrors.is_fetched(mirror_dir):
+                    run_git_steps(mirrors.create_steps(url, mirror_dir))
+                    created.add(url)
+                self.mirror_dirs[url] = mirror_dir
+                stack.callback(self.mirror_dirs.pop, url)
+            yield [(branch, repo_dir, dict(scan_kwargs, fetch_first=True) if repo_dir in created else scan_kwargs)
+                   for branch, repo_dir, scan_kwargs in scan_calls]
+
+    def pop_scan_options(self, kwargs):
+        """pop the options of a single scan from its kwargs, what is left is for write_report"""
         return_report = kwargs.pop('return_report', False)
         include_main = kwargs.pop('include_main', False)
         fetch_first = kwargs.pop('fetch_first', True)
         save_scan = kwargs.pop('save_scan', self.save_scans)
         stale = int(kwargs.pop('stale', self.STALE_DAYS_DEFAULT))
-        # perform git fetch if needed
-        if fetch_first:
-            self.execute_git_fetch(repo_dir)
-        # scan unmerged branches
-        unmerged_branches = self.get_list_of_unmerged_branches(branch, repo_dir, include_main=include_main)
-        # fetch unmerged commits for branches
-        unmerged_commits_by_branch = self.fetch_unmerged_commits_by_branch(unmerged_branches, branch, repo_dir)
+        batch = kwargs.pop('batch', True)
+        pushdown = kwargs.pop('pushdown', True)
+        backend = self.open_backend(kwargs.pop('backend', None) or DEFAULT_GIT_BACKEND)
+        write_commit_graph = kwargs.pop('write_commit_graph', False)
+        self.pop_mirror_options(kwargs)  # only used to scan urls, see mirror_scan_steps
+        now = kwargs.pop('now', None)  # epoch seconds, all dates of the scan are compared to this moment
+        if now is None:
+            now = self.get_timestamp_now()
+        cache = self.pop_cache(kwargs)
+        skip_unchanged = kwargs.pop('skip_unchanged', False)
+        assert not skip_unchanged or isinstance(cache, ScanCache), 'skip_unchanged needs a cache_dir'
+        metrics_file = kwargs.pop('metrics_file', None)
+        metrics = kwargs.pop('metrics', None)  # True, or a ScanMetrics to record into
+        if not isinstance(metrics, ScanMetrics):
+            metrics = ScanMetrics() if metrics or metrics_file else None
+        # report a summary of each branch, see summarize_commits (a report-changing option, part of journal keys)
+        summary = kwargs.pop('summary', False)
+        return self.SCAN_OPTIONS(return_report, include_main, fetch_first, save_scan, stale, batch, pushdown, cache,
+                                 int(now), metrics, metrics_file, backend, write_commit_graph, skip_unchanged, summary)
+
+    def pop_cache(self, kwargs):
+        """
+        pop the cache options from kwargs, and open the ScanCache they describe
+
+        without a cache_dir, the cache is the memory cache of the scanner with memory_cache, otherwise None
+        """
+        cache_dir = kwargs.pop('cache_dir', None)
+        cache_max_age_days = int(kwargs.pop('cache_max_age_days', ScanCache.MAX_AGE_DAYS_DEFAULT))
+        cache_max_entries = int(kwargs.pop('cache_max_entries', ScanCache.MAX_ENTRIES_DEFAULT))
+        memory_cache = kwargs.pop('memory_cache', False)
+        if not cache_dir:
+            return self.memory_cache if memory_cache else None
+        return self.open_cache(cache_dir, max_age_days=cache_max_age_days, max_entries=cache_max_entries)
+
+    @staticmethod
+    def measure_steps(metrics, name, steps):
+        if ScanTracer.active is not None:
+            steps = ScanTracer.active.trace_steps(name, steps)
+        return steps if metrics is None else metrics.measure_steps(name, steps)
+
+    @classmethod
+    def measure_phase(cls, metrics, name):
+        if ScanTracer.active is not None:
+            return cls.trace_phase(ScanTracer.active, metrics, name)
+        return contextlib.nullcontext() if metrics is None else metrics.phase(name)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def trace_phase(tracer, metrics, name):
+        span = tracer.begin(name, 'phase')
+        try:
+            with contextlib.nullcontext() if metrics is None else metrics.phase(name):
+                yield
+        finally:
+            span.end()
+
+    def finish_scan(self, branch, repo_dir, unmerged_commits_by_branch, options, scan_kwargs, kwargs):
+        metrics = options.metrics
         # get staleness
-        stale_branches_with_commits = self.extract_stale_branches(unmerged_commits_by_branch, stale)
+        with self.measure_phase(metrics, 'staleness'):
+            if options.summary:
+                stale_branches_with_commits = self.extract_stale_summaries(unmerged_commits_by_branch, options.stale,
+                                                                           options.now)
+            else:
+                stale_branches_with_commits = self.extract_stale_branches(unmerged_commits_by_branch, options.stale,
+                                                                          options.now)
         # create report
-        report_by_branch = self.create_report_by_branch(stale_branches_with_commits)
+        with self.measure_phase(metrics, 'report'):
+            if options.summary:
+                report_by_branch = self.create_summary_report_by_branch(stale_branches_with_commits)
+            else:
+                report_by_branch = self.create_report_by_branch(stale_branches_with_commits)
+        # write
+        format_ = kwargs.pop('format', 'json')
+        assert not (options.summary and format_ == 'ndjson'), 'ndjson records are commits by author, not summaries'
+        if options.return_report:
+            result = report_by_branch
+        else:
+            with self.measure_phase(metrics, 'write'):
+                if format_ == 'ndjson':
+                    result = self.write_ndjson_report([(branch, repo_dir, report_by_branch)], **kwargs)
+                else:
+                    result = self.write_report(report_by_branch, **kwargs)
+        if metrics is not None:
+            self.last_scan_metrics = metrics.as_dict()
         # save scan
-        if save_scan:
-            self.scans.append(
-                {'branch': branch, 'repo_dir': repo_dir, 'report': report_by_branch, 'kwargs': scan_kwargs})
+        if options.save_scan:
+            scan = {'branch': branch, 'repo_dir': repo_dir,
+                    'report': self.materialize_report(report_by_branch), 'kwargs': scan_kwargs}
+            if metrics is not None:
+                scan['metrics'] = self.last_scan_metrics
+            self.scans.append(scan)
+        if options.metrics_file:
+            repo = repo_dir if MirrorCache.is_url(repo_dir) else os.path.abspath(repo_dir)
+            ScanMetrics.write_prometheus_textfile(options.metrics_file, {repo: metrics})
         # return
-        if return_report:
-            return report_by_branch
-        else:
-            return self.write_report(report_by_branch, **kwargs)
+        return result
+
+    def scan_group_steps(self, scan_calls, multi_target=False):
+        """
+        run scan calls which all point at the same repo and return their reports
+
+        with multi_target, a group with several target branches is scanned from one shared history walk
+        """
+        targets = set(branch or self.main_branch_name for branch, repo_dir, scan_kwargs in scan_calls)
+        summary = any(scan_kwargs.get('summary') for branch, repo_dir, scan_kwargs in scan_calls)
+        if multi_target and len(targets) > 1 and not summary:  # summaries walk their own slim history per target
+            return (yield from self.scan_multi_target_steps(scan_calls))
+        reports = []
+        for branch, repo_dir, scan_kwargs in scan_calls:
+            reports.append((yield from self.scan_steps(branch, repo_dir, **scan_kwargs)))
+        return reports
+
+    def scan_multi_target_steps(self, scan_calls):
+        """same reports as scan_steps for each call (all for the same repo), with one history walk for all targets"""
+        repo_dir = self.local_repo_dir(scan_calls[0][1])
+        scans = []
+        for branch, call_repo_dir, kwargs in scan_calls:
+            branch = branch or self.main_branch_name
+            # verify args
+            self.assert_no_whitespace(branch, 'branch:{}'.format(branch))
+            self.assert_no_whitespace(call_repo_dir, 'repo_dir:{}'.format(call_repo_dir))
+            # extract kwargs
+            kwargs = kwargs.copy()
+            scan_kwargs = kwargs.copy()
+            options = self.pop_scan_options(kwargs)
+            assert options.batch, 'multi_target walks all branches at once, it can not be combined with batch=False'
+            scans.append((branch, call_repo_dir, options, scan_kwargs, kwargs))
+        steps = self.shared_walk_scans_steps(repo_dir, scans)
+        tracer = ScanTracer.active
+        if tracer is not None:
+            targets = [branch for branch, call_repo_dir, options, scan_kwargs, kwargs in scans]
+            steps = tracer.trace_steps('scan_multi_target', steps, 'scan', branches=targets, repo_dir=repo_dir)
+        return (yield from steps)
+
+    def shared_walk_scans_steps(self, repo_dir, scans):
+        # the shared git work is measured as part of the first scan that has metrics
+        metrics = next((options.metrics for branch, call_repo_dir, options, scan_kwargs, kwargs in scans
+                        if options.metrics is not None), None)
+        # perform git fetch if needed
+        if any(options.fetch_first for branch, call_repo_dir, options, scan_kwargs, kwargs in scans):
+            write_commit_graph = any(options.write_commit_graph for branch, call_repo_dir, options, scan_kwargs, kwargs
+                                     in scans)
+            cache = next((options.cache for branch, call_repo_dir, options, scan_kwargs, kwargs in scans
+                          if options.skip_unchanged), None)
+            yield from self.measure_steps(metrics, 'fetch', self.git_fetch_steps(
+                repo_dir, write_commit_graph=write_commit_graph, cache=cache))
+        backend = scans[0][2].backend  # the walk is shared, so is its backend
+        # every remote branch is a candidate, except those which are fresh for all scans
+        refs = yield from self.measure_steps(metrics, 'branch_refs', self.remote_branch_refs_steps(
+            repo_dir, backend=backend))
+        candidates = list(refs)
+        if all(options.pushdown for branch, call_repo_dir, options, scan_kwargs, kwargs in scans):
+            stale = min(options.stale for branch, call_repo_dir, options, scan_kwargs, kwargs in scans)
+            now = max(options.now for branch, call_repo_dir, options, scan_kwargs, kwargs in scans)
+            candidates = self.drop_fresh_branches(candidates, refs, stale, now)
+        targets = list(dict.fromkeys(branch for branch, call_repo_dir, options, scan_kwargs, kwargs in scans))
+        tips = {name: ref.hash for name, ref in refs.items()}
+        # take what we can from the caches, the branches cached for every target are not walked
+        caches = {}  # target: cache of the first scan of the target with one
+        for branch, call_repo_dir, options, scan_kwargs, kwargs in scans:
+            if options.cache is not None:
+                caches.setdefault(branch, options.cache)
+        cached_by_target = {target: self.read_cached_unmerged_commits(cache, candidates, target, repo_dir, tips)
+                            for target, cache in caches.items()}
+        walked_targets = [target for target in targets if self.to_remote_ref(target) in tips]  # others have none
+        if all(target in cached_by_target for target in walked_targets):
+            candidates = [b for b in candidates if not all(b in cached_by_target[target] for target in walked_targets)]
+        unmerged_commits_by_target = yield from self.measure_steps(
+            metrics, 'collect_commits', self.dict_of_unmerged_commits_by_target_steps(
+                candidates, targets, repo_dir, tips=tips, backend=backend))
+        for target, cache in caches.items():
+            self.write_cached_unmerged_commits(cache, unmerged_commits_by_target[target], target, repo_dir, tips)
+            for b, commits in cached_by_target[target].items():
+                unmerged_commits_by_target[target].setdefault(b, commits)
+        # finish each scan from the shared result
+        reports = []
+        main_branch = 'origin/{}'.format(self.main_branch_name)
+        for branch, call_repo_dir, options, scan_kwargs, kwargs in scans:
+            unmerged_commits_by_branch = {b: commits for b, commits in unmerged_commits_by_target[branch].items()
+                                          if options.include_main or b != main_branch}
+            reports.append(
+                self.finish_scan(branch, call_repo_dir, unmerged_commits_by_branch, options, scan_kwargs, kwargs))
+        return reports
 
-    def fetch_unmerged_commits_by_branch(self, unmerged_branches, branch=None, repo_dir='.'):
+    def fetch_unmerged_commits_by_branch(self, unmerged_branches, branch=None, repo_dir='.', batch=True, cache=None,
+                                         backend=None):
+        return run_git_steps(
+            self.unmerged_commits_by_branch_steps(unmerged_branches, branch, repo_dir, batch, cache, backend=backend))
+
+    def unmerged_commits_by_branch_steps(self, unmerged_branches, branch=None, repo_dir='.', batch=True, cache=None,
+                                         tips=None, backend=None):
         branch = branch or self.main_branch_name
         # verify args
         self.assert_no_whitespace(branch, 'branch:{}'.format(branch))
         self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
-        # create report
-        unmerged_commits_by_branch = {}
-        for unmerged_branch in unmerged_branches:
-            unmerged_branch_commits = self.get_list_of_unmerged_commits(unmerged_branch, branch, repo_dir)
-            unmerged_commits_by_branch[unmerged_branch] = unmerged_branch_commits
+        # take what we can from the cache, only branches whose tip (or target tip) moved need git
+        cached = {}
+        if cache is not None:
+            if tips is None:
+                tips = yield from self.remote_branch_tips_steps(repo_dir, backend=backend)
+            cached = self.read_cached_unmerged_commits(cache, unmerged_branches, branch, repo_dir, tips)
+            unmerged_branches = [b for b in unmerged_branches if b not in cached]
+        # a single history walk for all branches, unless explicitly asked to run git once per branch
+        if batch:
+            unmerged_commits_by_branch = yield from self.dict_of_unmerged_commits_by_branch_steps(
+                unmerged_branches, branch, repo_dir, tips=tips, backend=backend)
+        else:
+            unmerged_commits_by_branch = {}
+            for unmerged_branch in unmerged_branches:
+                unmerged_branch_commits = yield from self.unmerged_commits_steps(
+                    unmerged_branch, branch, repo_dir, backend=backend)
+                unmerged_commits_by_branch[unmerged_branch] = unmerged_branch_commits
+        if cache is not None:
+            self.write_cached_unmerged_commits(cache, unmerged_commits_by_branch, branch, repo_dir, tips)
+            unmerged_commits_by_branch.update(cached)
         return unmerged_commits_by_branch
 
+    def read_cached_unmerged_commits(self, cache, branches, target_branch, repo_dir, tips) -> dict:
+        target_tip = tips.get(self.to_remote_ref(target_branch))
+        source_tips = {b: tips[self.to_remote_ref(b)] for b in branches if self.to_remote_ref(b) in tips}
+        if target_tip is None or not source_tips:
+            return {}
+        found = cache.get_many(os.path.abspath(repo_dir), target_tip, set(source_tips.values()))
+        return {b: [CommitRecord.from_list(commit) for commit in found[tip]]
+                for b, tip in source_tips.items() if tip in found}
+
+    def write_cached_unmerged_commits(self, cache, unmerged_commits_by_branch, target_branch, repo_dir, tips):
+        target_tip = tips.get(self.to_remote_ref(target_branch))
+        if target_tip is None:
+            return
+        commits_by_source_tip = {tips[self.to_remote_ref(b)]: [commit.to_list() for commit in commits]
+                                 for b, commits in unmerged_commits_by_branch.items() if self.to_remote_ref(b) in tips}
+        cache.put_many(os.path.abspath(repo_dir), target_tip, commits_by_source_tip)
+
     def create_report_by_branch(self, stale_branches_with_commits):
         report_by_branch = {}
         for branch, commits in stale_branches_with_commits.items():
-            commits_by_author = self.convert_commits_list_to_dict_by_author(commits)
+            commits_by_author = self.group_commits_by_author(commits)
             report_by_branch[branch] = commits_by_author
         return report_by_branch
 
-    def extract_stale_branches(self, unmerged_commits_by_branch, stale):
+    def drop_fresh_branches(self, branches, refs, stale, now) -> list:
+        """
+        keep only branches whose tip commit is older than stale days
+
+        the tip of an unmerged branch is always one of its unmerged commits, so a fresh tip means the branch
+        can not be stale, no need to look at its other commits.
+        """
+        candidates = []
+        for branch in branches:
+            ref = refs.get(self.to_remote_ref(branch))
+            if ref is None or self.timestamp_is_older_than_n_days(ref.timestamp, stale, now):
+                candidates.append(branch)
+        return candidates
+
+    def extract_stale_summaries(self, summaries_by_branch, stale, now):
+        """the summaries of the stale branches, a branch is stale when its newest unmerged commit is"""
+        return {branch: summary for branch, summary in summaries_by_branch.items()
+                if summary.newest is None or self.timestamp_is_older_than_n_days(summary.newest, stale, now)}
+
+    @staticmethod
+    def create_summary_report_by_branch(stale_summaries):
+        def iso_date(timestamp):
+            return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+        return {branch: {'commits': summary.commits,
+                         'newest': iso_date(summary.newest) if summary.newest is not None else None,
+                         'oldest': iso_date(summary.oldest) if summary.oldest is not None else None,
+                         'authors': summary.authors}
+                for branch, summary in stale_summaries.items()}
+
+    def extract_stale_branches(self, unmerged_commits_by_branch, stale, now):
         stale_branches_with_commits = {}
         for branch, commits in unmerged_commits_by_branch.items():
-            dates = [commit.date for commit in commits]
-            if not all(self.date_is_older_than_n_days(d, stale) for d in dates):
+            if not all(self.timestamp_is_older_than_n_days(commit.timestamp, stale, now) for commit in commits):
                 continue  # not stale do not add to stale branches list
             stale_branches_with_commits[branch] = commits
         return stale_branches_with_commits
 
+    @staticmethod
+    def extract_latest_timestamp_from_commits(commits):
+        return max(commit.timestamp for commit in commits)
+
     @classmethod
     def extract_latest_date_from_commits(cls, commits):
-        return max([datetime.datetime.strptime(commit['date'], cls.DATE_FRMT) for commit in commits])
+        """deprecated, use extract_latest_timestamp_from_commits. takes commit dicts or records"""
+        warnings.warn('extract_latest_date_from_commits is deprecated, use extract_latest_timestamp_from_commits',
+                      DeprecationWarning, stacklevel=2)
+        return max(commit.datetime if isinstance(commit, CommitRecord)
+                   else datetime.datetime.strptime(commit['date'], cls.DATE_FRMT) for commit in commits)
 
     @classmethod
     def date_is_older_than_n_days(cls, date_, n_days, raise_exceptions=False):
+        """deprecated, use timestamp_is_older_than_n_days"""
+        warnings.warn('date_is_older_than_n_days is deprecated, use timestamp_is_older_than_n_days',
+                      DeprecationWarning, stacklevel=2)
         try:
-            dt = datetime.datetime.strptime(date_, cls.DATE_FRMT)
-        except ValueError as exc:
+            timestamp = int(datetime.datetime.strptime(date_, cls.DATE_FRMT).timestamp())
+        except ValueError:
             if raise_exceptions:
-                raise exc
+                raise
             return False
-        else:
-            return bool((cls.get_datetime_now_with_tz() - dt).days >= n_days)
+        return cls.timestamp_is_older_than_n_days(timestamp, n_days, cls.get_timestamp_now())
 
     @classmethod
-    def get_datetime_now_with_tz(cls):
+    def timestamp_is_older_than_n_days(cls, timestamp, n_days, now):
+        return cls.days_between(timestamp, now) >= n_days
+
+    @staticmethod
+    def days_between(timestamp, now):
+        """whole days (24 hours) from timestamp to now, both epoch seconds"""
+        return (now - timestamp) // 86400
+
+    @staticmethod
+    def get_timestamp_now():
+        return int(time.time())
+
+    @staticmethod
+    def get_datetime_now_with_tz():
+        """deprecated, use get_timestamp_now"""
+        warnings.warn('get_datetime_now_with_tz is deprecated, use get_timestamp_now', DeprecationWarning, stacklevel=2)
         return datetime.datetime.now().astimezone()
 
     @staticmethod
     def print_json_to_stdout(json_data, **json_kwargs):
+        json_kwargs.setdefault('default', CommitRecord.json_default)
         print(json.dumps(json_data, **json_kwargs))
 
     @staticmethod
     def save_json_to_file(json_data, file_path, **json_kwargs):
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w') as f:
+        json_kwargs.setdefault('default', CommitRecord.json_default)
+        # readers of file_path see the previous report or this one, never a partly written one
+        with atomic_write(file_path) as f:
             json.dump(json_data, f, **json_kwargs)
         print('report saved to file: {}'.format(file_path))
 
@@ -156,14 +2852,16 @@ class ScanUnmergedBranches(object):
         else:
             return 0
 
-    def write_pipeline_report(self, report, output, **kwargs):
+    @staticmethod
+    def write_ndjson_report(scan_reports, **kwargs):
+        """write (branch, repo_dir, report_by_branch) items one by one, scan_reports can be a lazy iterable"""
         raise_exceptions = kwargs.pop('raise_exceptions', True)
-        indent_ = kwargs.pop('indent', 4)
-
-        pipeline_report = self.create_pipeline_report(report)
+        output = kwargs.pop('output', None) or None
 
         try:
-            self.save_json_to_file(pipeline_report, output, indent=indent_)
+            with NdjsonReportWriter(output) as writer:
+                for branch, repo_dir, report_by_branch in scan_reports:
+                    writer.write_scan(branch, repo_dir, report_by_branch)
         except Exception as exc:
             print('exception saving report: {}'.format(exc))
             if raise_exceptions:
@@ -172,36 +2870,309 @@ class ScanUnmergedBranches(object):
         else:
             return 0
 
+    def write_pipeline_report(self, report, output, **kwargs):
+        raise_exceptions = kwargs.pop('raise_exceptions', True)
+        indent_ = kwargs.pop('indent', 4)
+        metrics = kwargs.pop('metrics', None)  # see pipeline_metrics
+        changes = kwargs.pop('changes', None)  # ScanHistory delta of this run
+        now = kwargs.pop('now', None)
+
+        pipeline_report = self.create_pipeline_report(report, now)
+        if changes is not None:
+            pipeline_report['changes'] = changes
+            pipeline_report['changes_message'] = self.create_changes_message(changes)
+        if metrics is not None:
+            pipeline_report['metrics'] = metrics
+
+        return self.write_report(pipeline_report, output=output, indent=indent_, raise_exceptions=raise_exceptions)
+
+    @staticmethod
+    def pipeline_metrics(metrics_by_repo):
+        # repos are named like in the pipeline input
+        return {os.path.basename(repo_dir): metrics.as_dict() for repo_dir, metrics in sorted(metrics_by_repo.items())}
+
+    def write_pipeline_shard(self, results_by_branch, output, shard, **kwargs):
+        """
+        write the results of one shard of a pipeline scan, to be merged with the other shards by
+        merge_pipeline_shards into the report of a pipeline scan of all the configs
+        """
+        raise_exceptions = kwargs.pop('raise_exceptions', True)
+        indent_ = kwargs.pop('indent', 4)
+        metrics = kwargs.pop('metrics', None)
+        now = kwargs.pop('now', None)
+
+        index, count = shard
+        pipeline_shard = {
+            'shard': {'index': index, 'count': count},
+            'now': self.get_timestamp_now() if now is None else now,
+            'results': [{'branch': result['branch'], 'repo_dir': result['repo_dir'], 'report': result['report']}
+                        for result in results_by_branch],
+        }
+        if metrics is not None:
+            pipeline_shard['metrics'] = metrics
+
+        return self.write_report(pipeline_shard, output=output, indent=indent_, raise_exceptions=raise_exceptions)
+
+    def merge_pipeline_shards(self, pipeline_shards, pipeline_output, **kwargs):
+        """
+        write the pipeline report of the written shards (see write_pipeline_shard) of a sharded pipeline scan,
+        the same report a pipeline scan of all the configs on one node writes
+
+        every shard of the scan must be given once. the age of stale branches is counted at the time the last shard
+        was written (unless now is given), and the merged results are recorded to history_db if given.
+        """
+        history_db = kwargs.pop('history_db', None)
+        now = kwargs.pop('now', None)
+        assert pipeline_shards, 'no shards to merge'
+        counts = set(pipeline_shard['shard']['count'] for pipeline_shard in pipeline_shards)
+        assert len(counts) == 1, 'shards of different shard counts: {}'.format(sorted(counts))
+        indexes = sorted(pipeline_shard['shard']['index'] for pipeline_shard in pipeline_shards)
+        assert indexes == list(range(counts.pop())), 'missing or repeated shards: {}'.format(indexes)
+
+        results_by_branch = [result for pipeline_shard in pipeline_shards for result in pipeline_shard['results']]
+        metrics = None
+        if any('metrics' in pipeline_shard for pipeline_shard in pipeline_shards):
+            metrics = dict(sorted(itertools.chain.from_iterable(
+                pipeline_shard.get('metrics', {}).items() for pipeline_shard in pipeline_shards)))
+        now = max(pipeline_shard['now'] for pipeline_shard in pipeline_shards) if now is None else now
+
+        facts = ScanFacts(results_by_branch)
+        changes = None
+        if history_db:
+            history = self.open_history(history_db)
+            changes = history.delta(history.record(facts, now))
+        return self.write_pipeline_report(facts, pipeline_output, metrics=metrics, changes=changes, now=now, **kwargs)
+
+    @staticmethod
+    def shard_of(repo_name, count) -> int:
+        """the shard (of count) which scans repo_name, the same on every node (unlike hash)"""
+        return int(hashlib.sha1(repo_name.encode()).hexdigest(), 16) % count
+
+    @staticmethod
+    def parse_shard(value) -> tuple:
+        """(index, count) from 'INDEX/COUNT' like '0/4'"""
+        index, count = (int(part) for part in value.split('/'))
+        if not 0 <= index < count:
+            raise ValueError('shard index must be between 0 and count - 1: {}'.format(value))
+        return index, count
+
     def execute_git_fetch(self, repo_dir='.', **kwargs):
+        return run_git_steps(self.git_fetch_steps(repo_dir, **kwargs))
+
+    def git_fetch_steps(self, repo_dir='.', write_commit_graph=False, cache=None, **kwargs):
+        """
+        fetch repo_dir from origin
+
+        with a cache, the fetch is skipped when the refs the remote advertises are the same as at the last fetch
+        """
         self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
         repo_dir = os.path.abspath(repo_dir)
         kwargs.setdefault('cwd', repo_dir)
-        # build command
-        options = ['--prune', '--prune-tags', '--no-tags', '--no-recurse-submodules', '--unshallow']
+        fingerprint = None
+        if cache is not None:
+            fingerprint = yield from self.remote_fingerprint_steps(**kwargs)
+            if fingerprint is not None and fingerprint == cache.get_fingerprint(repo_dir):
+                cache.put_fingerprint(repo_dir, fingerprint)  # still in use
+                self.remote_fingerprints[repo_dir] = fingerprint
+                return ExecRes(0, [], ['remote refs unchanged, fetch skipped'])
+        # build command (only unshallow repos which are, or might be, shallow)
+        options = ['--prune', '--prune-tags', '--no-tags', '--no-recurse-submodules']
+        shallow = self.shallow_repos.get(repo_dir)
+        if shallow is None:  # not fetched by this scanner yet
+            shallow = self.is_shallow_repo(repo_dir)
+        if shallow is not False:
+            options.append('--unshallow')
         cmd = 'git -P fetch {options}'.format(options=' '.join(options))
         # executed
-        res = git_exec(cmd, **kwargs)
-        if '--unshallow on a complete repository does not make sense' in res.stderr:
+        res = yield GitCmd(cmd, kwargs)
+        if '--unshallow' in options and any(self.UNSHALLOW_COMPLETE_ERROR in line for line in res.stderr):
             options.remove('--unshallow')
             cmd = 'git -P fetch {options}'.format(options=' '.join(options))
-            res = git_exec(cmd, **kwargs)
+            res = yield GitCmd(cmd, kwargs)
+        if res.rc == 0:
+            self.shallow_repos[repo_dir] = False  # after a successful fetch the repo is complete either way
+            if fingerprint is not None:
+                # taken before fetching, if the remote moved in between the next fetch is not skipped
+                cache.put_fingerprint(repo_dir, fingerprint)
+                self.remote_fingerprints[repo_dir] = fingerprint
+            if write_commit_graph:
+                # a layer for the fetched commits, for the walks of the cat-file and odb backends
+                yield GitCmd('git -P commit-graph write --reachable --split', kwargs)
         return res
 
+    @staticmethod
+    def remote_fingerprint_steps(**kwargs):
+        """a hash of the branches (and their tips) which origin advertises, None if git ls-remote failed"""
+        res = yield GitCmd('git -P ls-remote --heads origin', kwargs)
+        if res.rc != 0:
+            return None
+        return hashlib.sha1('\n'.join(sorted(res.stdout)).encode()).hexdigest()
+
+    @staticmethod
+    def repo_tips_steps(**kwargs):
+        """a hash of the refs of the repo (and their tips), None if git for-each-ref failed"""
+        res = yield GitCmd('git -P for-each-ref --format="%(objectname) %(refname)"', kwargs)
+        if res.rc != 0:
+            return None
+        return hashlib.sha1('\n'.join(sorted(res.stdout)).encode()).hexdigest()
+
+    def read_repo_tips(self, repo_dirs, jobs=DEFAULT_FETCH_JOBS) -> dict:
+        """{repo_dir: hash of its refs} of every distinct repo"""
+        repo_dirs = list(dict.fromkeys(self.local_repo_dir(repo_dir) for repo_dir in repo_dirs))
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return dict(zip(repo_dirs, executor.map(
+                lambda repo_dir: run_git_steps(self.repo_tips_steps(cwd=repo_dir)), repo_dirs)))
+
+    async def read_repo_tips_async(self, repo_dirs, jobs=DEFAULT_FETCH_JOBS) -> dict:
+        """same as read_repo_tips, on the event loop"""
+        repo_dirs = list(dict.fromkeys(self.local_repo_dir(repo_dir) for repo_dir in repo_dirs))
+        semaphore = asyncio.Semaphore(max(1, jobs))
+        tips = await asyncio.gather(
+            *(run_git_steps_async(self.repo_tips_steps(cwd=repo_dir), semaphore) for repo_dir in repo_dirs))
+        return dict(zip(repo_dirs, tips))
+
+    def resume_from_journal(self, journal, scan_calls, tips):
+        """
+        the reports of the scan calls which the journal has for the current tips of their repos ({index: report}),
+        the indexes of the other scan calls, and on_done(position, report) which journals the report of the scan
+        call at that position in the other scan calls
+
+        :param tips: {repo_dir: hash of its refs} (see read_repo_tips)
+        """
+        keys = [journal.scan_key(branch, repo_dir, scan_kwargs) for branch, repo_dir, scan_kwargs in scan_calls]
+        repo_tips = [tips.get(self.local_repo_dir(repo_dir)) for branch, repo_dir, scan_kwargs in scan_calls]
+        resumed = {}
+        if journal.resume:
+            for index, (key, tips_) in enumerate(zip(keys, repo_tips)):
+                report = journal.get(key, tips_)
+                if report is not None:
+                    resumed[index] = report
+            print('resumed {} of {} scans from the journal'.format(len(resumed), len(scan_calls)), file=sys.stderr)
+        pending = [index for index in range(len(scan_calls)) if index not in resumed]
+
+        def on_done(position, report):
+            journal.record(keys[pending[position]], repo_tips[pending[position]], report)
+
+        return resumed, pending, on_done
+
+    @staticmethod
+    def merge_resumed_reports(resumed, pending_reports, count):
+        """yield the resumed reports and the reports of the pending scans, in the order of the scan calls"""
+        pending_reports = iter(pending_reports)
+        for index in range(count):
+            yield resumed[index] if index in resumed else next(pending_reports)
+
+    @contextlib.contextmanager
+    def journaling(self, options):
+        """the ScanJournal of a multi-scan, None when it has none"""
+        if not options['journal']:
+            yield None
+            return
+        with ScanJournal(options['journal'], options['resume']) as journal:
+            yield journal
+
+    @staticmethod
+    def is_shallow_repo(repo_dir):
+        """whether git keeps a shallow file for repo_dir, None if the git dir is not where we expect it"""
+        for git_dir in (os.path.join(repo_dir, '.git'), repo_dir):
+            if os.path.isdir(os.path.join(git_dir, 'objects')):
+                return os.path.exists(os.path.join(git_dir, 'shallow'))
+        return None
+
+    def fetch_repos(self, repo_dirs, fetch_jobs=DEFAULT_FETCH_JOBS, commit_graph_repos=(), caches=None) -> dict:
+        """
+        fetch every distinct repo once, fetch_jobs repos at a time, and return {repo_dir: FETCH_RESULT}
+
+        a commit-graph is written after fetching the repos in commit_graph_repos, and the fetch of the repos in
+        caches ({repo_dir: ScanCache}) is skipped while their remote refs are unchanged
+        """
+        repo_dirs = list(dict.fromkeys(self.local_repo_dir(repo_dir) for repo_dir in repo_dirs))
+        commit_graph_repos = set(self.local_repo_dir(repo_dir) for repo_dir in commit_graph_repos)
+        caches = caches or {}
+        self.fetch_metrics = {}
+
+        def fetch(repo_dir):
+            start = time.monotonic()
+            res = run_git_steps(
+                self.fetch_metrics_steps(repo_dir, repo_dir in commit_graph_repos, caches.get(repo_dir)))
+            return self.FETCH_RESULT(res, time.monotonic() - start)
+
+        with ThreadPoolExecutor(max_workers=max(1, fetch_jobs)) as executor:
+            fetch_results = dict(zip(repo_dirs, executor.map(fetch, repo_dirs)))
+        self.report_fetch_results(fetch_results)
+        return fetch_results
+
+    async def fetch_repos_async(self, repo_dirs, fetch_jobs=DEFAULT_FETCH_JOBS, commit_graph_repos=(),
+                                caches=None) -> dict:
+        """same as fetch_repos, on the event loop"""
+        repo_dirs = list(dict.fromkeys(self.local_repo_dir(repo_dir) for repo_dir in repo_dirs))
+        commit_graph_repos = set(self.local_repo_dir(repo_dir) for repo_dir in commit_graph_repos)
+        caches = caches or {}
+        semaphore = asyncio.Semaphore(max(1, fetch_jobs))
+        self.fetch_metrics = {}
+
+        async def fetch(repo_dir):
+            start = time.monotonic()
+            res = await run_git_steps_async(
+                self.fetch_metrics_steps(repo_dir, repo_dir in commit_graph_repos, caches.get(repo_dir)), semaphore)
+            return self.FETCH_RESULT(res, time.monotonic() - start)
+
+        fetch_results = dict(zip(repo_dirs, await asyncio.gather(*[fetch(repo_dir) for repo_dir in repo_dirs])))
+        self.report_fetch_results(fetch_results)
+        return fetch_results
+
+    def fetch_metrics_steps(self, repo_dir, write_commit_graph=False, cache=None):
+        metrics = self.fetch_metrics[repo_dir] = ScanMetrics()
+        return self.measure_steps(metrics, 'fetch', self.git_fetch_steps(repo_dir, write_commit_graph, cache))
+
+    def report_fetch_results(self, fetch_results):
+        self.fetch_results = fetch_results
+        for repo_dir, fetch_result in fetch_results.items():
+            print('fetched {} in {:.2f}s (rc={})'.format(repo_dir, fetch_result.duration, fetch_result.res.rc),
+                  file=sys.stderr)
+
+    def local_repo_dir(self, repo_dir):
+        """the absolute path of repo_dir, of its mirror when it is a url locked by the multi-scan"""
+        return self.mirror_dirs.get(repo_dir) or os.path.abspath(repo_dir)
+
+    @staticmethod
+    def get_repos_to_fetch(scan_calls) -> list:
+        return [repo_dir for branch, repo_dir, scan_kwargs in scan_calls if scan_kwargs.get('fetch_first', True)]
+
+    @staticmethod
+    def get_repos_to_write_commit_graph(scan_calls) -> list:
+        return [repo_dir for branch, repo_dir, scan_kwargs in scan_calls if scan_kwargs.get('write_commit_graph')]
+
+    def get_fetch_caches(self, scan_calls) -> dict:
+        """{repo_dir: ScanCache} of the repos whose fetch is skipped while their remote refs are unchanged"""
+        caches = {}
+        for branch, repo_dir, scan_kwargs in scan_calls:
+            if scan_kwargs.get('skip_unchanged'):
+                cache = self.pop_cache(dict(scan_kwargs))
+                assert isinstance(cache, ScanCache), 'skip_unchanged needs a cache_dir'
+                caches[self.local_repo_dir(repo_dir)] = cache
+        return caches
+
+    @staticmethod
+    def without_fetch(scan_calls) -> list:
+        """the same scan calls, for after the fetch stage already fetched their repos"""
+        return [(branch, repo_dir, dict(scan_kwargs, fetch_first=False))
+                for branch, repo_dir, scan_kwargs in scan_calls]
+
     def get_list_of_unmerged_branches(self, branch=None, repo_dir='.', **kwargs) -> list:
+        return run_git_steps(self.unmerged_branches_steps(branch, repo_dir, **kwargs))
+
+    def unmerged_branches_steps(self, branch=None, repo_dir='.', **kwargs):
         branch = branch or self.main_branch_name
         self.assert_no_whitespace(branch, 'target_branch:{}'.format(branch))
         self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
         repo_dir = os.path.abspath(repo_dir)
         include_main = kwargs.pop('include_main', False)
+        backend = kwargs.pop('backend', None) or self.open_backend()
         kwargs.setdefault('cwd', repo_dir)
         if not branch.startswith('origin/'):
             branch = 'origin/{}'.format(branch)
-        # build command
-        cmd = 'git -P branch -r --no-merged {}'.format(branch)
-        # executed
-        res = git_exec(cmd, **kwargs)
-        # make list of branches
-        branches = [branch.strip() for branch in res.stdout]
+        branches = yield from backend.branches_steps(branch, repo_dir, **kwargs)
 
         def branch_filter(b):
             if any(c in string.whitespace for c in b):
@@ -213,7 +3184,193 @@ class ScanUnmergedBranches(object):
         branches = list(filter(branch_filter, branches))
         return branches
 
+    def get_remote_branch_tips(self, repo_dir='.', **kwargs) -> dict:
+        """map remote branch names (as listed by `git branch -r`) to the hash of their tip commit"""
+        return run_git_steps(self.remote_branch_tips_steps(repo_dir, **kwargs))
+
+    def remote_branch_tips_steps(self, repo_dir='.', **kwargs):
+        refs = yield from self.remote_branch_refs_steps(repo_dir, **kwargs)
+        return {name: ref.hash for name, ref in refs.items()}
+
+    def get_remote_branch_refs(self, repo_dir='.', **kwargs) -> dict:
+        """map remote branch names (as listed by `git branch -r`) to BRANCH_REF of their tip commit"""
+        return run_git_steps(self.remote_branch_refs_steps(repo_dir, **kwargs))
+
+    def remote_branch_refs_steps(self, repo_dir='.', backend=None, **kwargs):
+        self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
+        repo_dir = os.path.abspath(repo_dir)
+        kwargs.setdefault('cwd', repo_dir)
+        backend = backend or self.open_backend()
+        return (yield from backend.refs_steps(repo_dir, **kwargs))
+
+    def get_dict_of_unmerged_commits_by_branch(self, source_branches, target_branch, repo_dir='.', **kwargs) -> dict:
+        """
+        collect the unmerged commits of many source branches with a single history walk
+
+        same result as calling get_list_of_unmerged_commits for each source branch, but git walks the union of
+        all source branches (excluding the target) once, and commits are attributed to the branches which
+        reach them by following parent links in memory.
+        """
+        return run_git_steps(
+            self.dict_of_unmerged_commits_by_branch_steps(source_branches, target_branch, repo_dir, **kwargs))
+
+    def dict_of_unmerged_commits_by_branch_steps(self, source_branches, target_branch, repo_dir='.', tips=None,
+                                                 backend=None, **kwargs):
+        self.assert_no_whitespace(target_branch, 'target_branch:{}'.format(target_branch))
+        self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
+        if not source_branches:
+            return {}
+        repo_dir = os.path.abspath(repo_dir)
+        kwargs.setdefault('cwd', repo_dir)
+        backend = backend or self.open_backend()
+        target_branch = self.to_remote_ref(target_branch)
+        for source_branch in source_branches:
+            self.assert_no_whitespace(source_branch, 'source_branch:{}'.format(source_branch))
+        if tips is None:
+            tips = yield from self.remote_branch_tips_steps(repo_dir, backend=backend, **kwargs)
+        source_tips = {b: tips[self.to_remote_ref(b)] for b in source_branches if self.to_remote_ref(b) in tips}
+        unmerged_commits_by_branch = {}
+        if source_tips:
+            # tip hashes are used rather than names, so the commits match the tips even if a fetch moves a ref
+            revisions = list(source_tips.values()) + ['^{}'.format(tips.get(target_branch, target_branch))]
+            commits, parents = yield from backend.walk_steps(revisions, repo_dir, **kwargs)
+            unmerged_commits_by_branch = self.attribute_commits_to_branches(source_tips, commits, parents)
+        for source_branch in source_branches:
+            if source_branch not in source_tips:
+                # not a plain remote branch (e.g. ambiguous name), ask git about this one separately
+                unmerged_commits_by_branch[source_branch] = yield from self.unmerged_commits_steps(
+                    source_branch, target_branch, repo_dir, backend=backend, **kwargs)
+        return {source_branch: unmerged_commits_by_branch[source_branch] for source_branch in source_branches}
+
+    def summaries_by_branch_steps(self, source_branches, target_branch, repo_dir='.', batch=True, tips=None,
+                                  backend=None, **kwargs):
+        """
+        {branch: BRANCH_SUMMARY} of the unmerged commits of each source branch
+
+        like unmerged_commits_by_branch_steps, but only the date and author of each commit are read (no subjects
+        are listed or kept), and commits are counted rather than collected.
+        """
+        self.assert_no_whitespace(target_branch, 'target_branch:{}'.format(target_branch))
+        self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
+        if not source_branches:
+            return {}
+        repo_dir = os.path.abspath(repo_dir)
+        kwargs.setdefault('cwd', repo_dir)
+        backend = backend or self.open_backend()
+        target_branch = self.to_remote_ref(target_branch)
+        for source_branch in source_branches:
+            self.assert_no_whitespace(source_branch, 'source_branch:{}'.format(source_branch))
+        if tips is None:
+            tips = yield from self.remote_branch_tips_steps(repo_dir, backend=backend, **kwargs)
+        exclude = '^{}'.format(tips.get(target_branch, target_branch))
+        source_tips = {b: tips[self.to_remote_ref(b)] for b in source_branches if self.to_remote_ref(b) in tips}
+        summaries_by_branch = {}
+        if batch and source_tips:
+            # a single walk for all branches, split per branch like attribute_commits_to_branches
+            commits, parents = yield from backend.summary_walk_steps(
+                list(source_tips.values()) + [exclude], repo_dir, **kwargs)
+            for source_branch, tip in source_tips.items():
+                summaries_by_branch[source_branch] = self.summarize_commits(
+                    commits[hash_] for hash_ in self.walk_parents(tip, parents))
+        for source_branch in source_branches:
+            if source_branch not in summaries_by_branch:
+                source = source_tips.get(source_branch, self.to_remote_ref(source_branch))
+                commits, parents = yield from backend.summary_walk_steps([source, exclude], repo_dir, **kwargs)
+                summaries_by_branch[source_branch] = self.summarize_commits(commits.values())
+        return {source_branch: summaries_by_branch[source_branch] for source_branch in source_branches}
+
+    @classmethod
+    def summarize_commits(cls, commits):
+        """BRANCH_SUMMARY of (timestamp, author) commits: their number, newest and oldest date and count by author"""
+        count = 0
+        newest = oldest = None
+        authors = {}
+        for timestamp, author in commits:
+            count += 1
+            newest = timestamp if newest is None else max(newest, timestamp)
+            oldest = timestamp if oldest is None else min(oldest, timestamp)
+            authors[author] = authors.get(author, 0) + 1
+        return cls.BRANCH_SUMMARY(count, newest, oldest, dict(sorted(authors.items())))
+
+    @classmethod
+    def attribute_commits_to_branches(cls, tips_by_branch, commits, parents) -> dict:
+        """
+        split the commits of a batched walk per branch, keeping the walk order
+
+        a parent which is not one of the walked commits is reachable from the target (it was excluded by the walk),
+        so following parent links from each branch tip within the walked commits finds exactly its unmerged commits.
+        """
+        order = {hash_: index for index, hash_ in enumerate(commits)}
+        commits_by_branch = {}
+        for branch, tip in tips_by_branch.items():
+            reachable = cls.walk_parents(tip, parents)
+            commits_by_branch[branch] = [commits[h] for h in sorted(reachable, key=order.get)]
+        return commits_by_branch
+
+    @staticmethod
+    def walk_parents(tip, parents, excluded=None) -> set:
+        """the commits reachable from tip, following parents only within the walked commits (and not excluded)"""
+        reachable = set()
+        pending = [tip]
+        while pending:
+            hash_ = pending.pop()
+            if hash_ in reachable or hash_ not in parents or (excluded is not None and excluded(hash_)):
+                continue
+            reachable.add(hash_)
+            pending.extend(parents[hash_])
+        return reachable
+
+    def get_dict_of_unmerged_commits_by_target(self, source_branches, target_branches, repo_dir='.', **kwargs) -> dict:
+        """
+        {target: {branch: unmerged commits}} for each source branch which is not merged to each target
+
+        same as get_list_of_unmerged_branches + get_dict_of_unmerged_commits_by_branch for every target, from a single
+        history walk: all tips are walked down to the merge bases of the targets (below those every commit is merged
+        everywhere), each walked commit gets a bit for every target which contains it, and the unmerged commits of a
+        branch for a target are those reachable from its tip without that target's bit.
+        """
+        return run_git_steps(
+            self.dict_of_unmerged_commits_by_target_steps(source_branches, target_branches, repo_dir, **kwargs))
+
+    def dict_of_unmerged_commits_by_target_steps(self, source_branches, target_branches, repo_dir='.', tips=None,
+                                                 backend=None, **kwargs):
+        self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
+        repo_dir = os.path.abspath(repo_dir)
+        kwargs.setdefault('cwd', repo_dir)
+        backend = backend or self.open_backend()
+        unmerged_commits_by_target = {target: {} for target in target_branches}
+        if tips is None:
+            tips = yield from self.remote_branch_tips_steps(repo_dir, backend=backend, **kwargs)
+        target_tips = {t: tips[self.to_remote_ref(t)] for t in target_branches if self.to_remote_ref(t) in tips}
+        source_tips = {b: tips[self.to_remote_ref(b)] for b in source_branches if self.to_remote_ref(b) in tips}
+        if not target_tips or not source_tips:
+            return unmerged_commits_by_target
+        # build command
+        cmd = 'git -P merge-base --all --octopus {}'.format(' '.join(dict.fromkeys(target_tips.values())))
+        res = yield GitCmd(cmd, kwargs)
+        merge_bases = [line.strip() for line in res.stdout if line.strip()] if res.rc == 0 else []
+        revisions = list(dict.fromkeys(list(source_tips.values()) + list(target_tips.values())))
+        revisions += ['^{}'.format(merge_base) for merge_base in merge_bases]
+        commits, parents = yield from backend.walk_steps(revisions, repo_dir, **kwargs)
+        order = {hash_: index for index, hash_ in enumerate(commits)}
+        # mark which targets contain each walked commit, one bit per target
+        contained_in = {}
+        for bit, target_tip in enumerate(target_tips.values()):
+            for hash_ in self.walk_parents(target_tip, parents):
+                contained_in[hash_] = contained_in.get(hash_, 0) | (1 << bit)
+        # a branch is unmerged to a target if its tip was walked and the target does not contain it
+        for bit, (target, target_tip) in enumerate(target_tips.items()):
+            for branch, tip in source_tips.items():
+                if tip not in commits or contained_in.get(tip, 0) & (1 << bit):
+                    continue
+                reachable = self.walk_parents(tip, parents, lambda h: contained_in.get(h, 0) & (1 << bit))
+                unmerged_commits_by_target[target][branch] = [commits[h] for h in sorted(reachable, key=order.get)]
+        return unmerged_commits_by_target
+
     def get_list_of_unmerged_commits(self, source_branch, target_branch, repo_dir='.', **kwargs) -> list:
+        return run_git_steps(self.unmerged_commits_steps(source_branch, target_branch, repo_dir, **kwargs))
+
+    def unmerged_commits_steps(self, source_branch, target_branch, repo_dir='.', backend=None, **kwargs):
         self.assert_no_whitespace(source_branch, 'source_branch:{}'.format(source_branch))
         self.assert_no_whitespace(target_branch, 'target_branch:{}'.format(target_branch))
         self.assert_no_whitespace(repo_dir, 'repo_dir:{}'.format(repo_dir))
@@ -223,16 +3380,26 @@ class ScanUnmergedBranches(object):
             target_branch = 'origin/{}'.format(target_branch)
         if not source_branch.startswith('origin/'):
             source_branch = 'origin/{}'.format(source_branch)
-        # build command
-        cmd = 'git -P log {} --not {} --format="%H|%aI|%aE|%s"'.format(source_branch, target_branch)
-        # executed
-        res = git_exec(cmd, **kwargs)
-        # make list of commit author:hash:subject:date
-        commits = [self.COMMIT_DETAILS(*commit.strip().split('|')) for commit in res.stdout]
-        return commits
+        backend = backend or self.open_backend()
+        return (yield from backend.log_steps(source_branch, target_branch, repo_dir, **kwargs))
+
+    def parse_batch_log(self, lines):
+        """make dict of hash:commit in the order git listed them, and dict of hash:parent hashes (see the backends)"""
+        return SubprocessGitBackend.parse_batch_log(lines)
+
+    @staticmethod
+    def group_commits_by_author(commits) -> dict:
+        # group commits from list [CommitRecord, ...]
+        #                 to   dict {author: [CommitRecord, ...], ...}
+        # (written as {author: [{hash: hash, date:date, subject:subject}, ...], ...}, see materialize_report)
+        dict_by_author = {}
+        for commit in commits:
+            author_commit_list = dict_by_author.setdefault(commit.author, list())
+            author_commit_list.append(commit)
+        return dict_by_author
 
     def convert_commits_list_to_dict_by_author(self, commits) -> dict:
-        # convert commits from list [(hash, date, author, subject), ...]
+        # convert commits from list [(hash, date, author, subject), ...] (COMMIT_DETAILS or CommitRecord)
         #                 to   dict {author: [{hash: hash, date:date, subject:subject}, ...], ...}
         dict_by_author = {}
         for commit in commits:
@@ -243,17 +3410,41 @@ class ScanUnmergedBranches(object):
         return dict_by_author
 
     @staticmethod
-    def convert_commit_to_dict(commit: COMMIT_DETAILS):
-        commit_dict = dict(commit._asdict())
+    def convert_commit_to_dict(commit):
+        if not isinstance(commit, CommitRecord):
+            return dict(commit._asdict())
+        commit_dict = {'hash': commit.hash, 'date': commit.date, 'author': commit.author, 'subject': commit.subject}
         return commit_dict
 
+    @classmethod
+    def materialize_report(cls, report):
+        """copy of a (possibly aggregated) report with the commit records replaced by commit dicts"""
+        if isinstance(report, CommitRecord):
+            return report.to_report_dict()
+        elif isinstance(report, dict):
+            return {key: cls.materialize_report(value) for key, value in report.items()}
+        elif isinstance(report, list):
+            return [cls.materialize_report(value) for value in report]
+        return report
+
     def scan_multiple_pipeline(self, configs, pipeline_output, **kwargs):
         # handle kwargs before sending to scan (some of them should not be sent, or we want to ensure certain kwargs)
         kwargs['return_report'] = True  # override in order to always get scan report from self.scan
         workspace = kwargs.pop('workspace', os.getenv('WORKSPACE'))  # jenkins default uses "WORKSPACE"
+        jobs = int(kwargs.pop('jobs', 1))
+        fetch_jobs = int(kwargs.pop('fetch_jobs', DEFAULT_FETCH_JOBS))
+        multi_target = kwargs.pop('multi_target', False)
+        metrics_options = {'metrics': kwargs.pop('metrics', False), 'metrics_file': kwargs.pop('metrics_file', None)}
+        trace = kwargs.pop('trace', None)
+        history_db = kwargs.pop('history_db', None)
+        shard = kwargs.pop('shard', None)  # (index, count) to scan only the repos of one shard, see shard_of
+        assert not kwargs.get('summary'), 'pipeline reports list the age of the commits of each author, not summaries'
+        assert not (shard and history_db), 'shards are recorded to the history when they are merged'
 
-        results_by_branch = []
+        scan_calls = []
         for config in configs:
+            if shard is not None and self.shard_of(config['REPO_NAME'], shard[1]) != shard[0]:
+                continue  # another shard scans this repo (and all its targets)
             # each config MUST have TARGET_BRANCH & REPO_NAME
             branch = config.pop('TARGET_BRANCH')
             repo_name = config.pop('REPO_NAME')  # we assume all repos are in the same root dir so name will suffice
@@ -261,23 +3452,263 @@ class ScanUnmergedBranches(object):
             # then we take the rest of config as kwargs, and **kwargs overwrite
             scan_kwargs = config
             scan_kwargs.update(kwargs)
-            report_by_branch = self.scan(branch, repo_dir, **scan_kwargs)
-            results_by_branch.append(
-                {'branch': branch, 'repo_dir': repo_dir, 'report': report_by_branch, 'kwargs': scan_kwargs})
+            scan_calls.append((branch, repo_dir, scan_kwargs))
+
+        metrics = self.new_scan_metrics(scan_calls, metrics_options)
+        with ScanTracer.tracing(trace):
+            # fetch each repo once, then scan
+            self.fetch_repos(self.get_repos_to_fetch(scan_calls), fetch_jobs,
+                             self.get_repos_to_write_commit_graph(scan_calls), self.get_fetch_caches(scan_calls))
+            reports = self.run_scans(self.with_metrics(self.without_fetch(scan_calls), metrics), jobs, multi_target)
+
+            results_by_branch = []
+            for (branch, repo_dir, scan_kwargs), report_by_branch in zip(scan_calls, reports):
+                results_by_branch.append(
+                    {'branch': branch, 'repo_dir': repo_dir, 'report': report_by_branch, 'kwargs': scan_kwargs})
 
-        self.write_pipeline_report(results_by_branch, pipeline_output)
+            pipeline_metrics = None
+            if metrics is not None:
+                metrics_by_repo = self.aggregate_metrics_by_repo(scan_calls, metrics)
+                self.write_metrics_file(metrics_options['metrics_file'], metrics_by_repo)
+                if metrics_options['metrics']:
+                    pipeline_metrics = self.pipeline_metrics(metrics_by_repo)
+            if shard is not None:
+                self.write_pipeline_shard(results_by_branch, pipeline_output, shard, metrics=pipeline_metrics,
+                                          now=kwargs.get('now'))
+                return 0
+            facts = ScanFacts(results_by_branch)  # indexed once for the history and the report
+            changes = None
+            if history_db:
+                history = self.open_history(history_db)
+                changes = history.delta(history.record(facts, kwargs.get('now')))
+            self.write_pipeline_report(facts, pipeline_output, metrics=pipeline_metrics, changes=changes,
+                                       now=kwargs.get('now'))
 
         return 0
 
     def scan_multiple(self, configs, **kwargs):
+        jobs = int(kwargs.pop('jobs', 1))
+        fetch_jobs = int(kwargs.pop('fetch_jobs', DEFAULT_FETCH_JOBS))
+        multi_target = kwargs.pop('multi_target', False)
+        options = self.pop_scan_multiple_options(kwargs)
+        scan_calls = self.get_scan_calls(configs, kwargs)
+        metrics = self.new_scan_metrics(scan_calls, options)
+        with ScanTracer.tracing(options['trace']), self.mirrored(scan_calls) as scan_calls, \
+                self.journaling(options) as journal:
+            # fetch each repo once, then scan
+            self.fetch_repos(self.get_repos_to_fetch(scan_calls), fetch_jobs,
+                             self.get_repos_to_write_commit_graph(scan_calls), self.get_fetch_caches(scan_calls))
+            calls = self.with_metrics(self.without_fetch(scan_calls), metrics)
+            if journal is None:
+                reports = self.run_scans(calls, jobs, multi_target)
+            else:
+                # scan only what the journal does not have yet, and journal each scan once it is done
+                tips = self.read_repo_tips([repo_dir for branch, repo_dir, scan_kwargs in scan_calls], fetch_jobs)
+                resumed, pending, on_done = self.resume_from_journal(journal, scan_calls, tips)
+                reports = self.merge_resumed_reports(
+                    resumed, self.run_scans([calls[index] for index in pending], jobs, multi_target, on_done),
+                    len(calls))
+            return self.report_scan_multiple(scan_calls, reports, options, kwargs, metrics)
+
+    async def scan_multiple_async(self, configs, **kwargs):
+        """same as scan_multiple, all scans share one event loop with at most max_concurrent_git git processes"""
+        max_concurrent_git = int(kwargs.pop('max_concurrent_git', DEFAULT_MAX_CONCURRENT_GIT))
+        fetch_jobs = int(kwargs.pop('fetch_jobs', DEFAULT_FETCH_JOBS))
+        multi_target = kwargs.pop('multi_target', False)
+        options = self.pop_scan_multiple_options(kwargs)
+        assert not (options['journal'] and self.is_streaming(options)), \
+            'streamed async scans are not journaled, journal them without async or as a json report'
+        scan_calls = self.get_scan_calls(configs, kwargs)
+        metrics = self.new_scan_metrics(scan_calls, options)
+        with ScanTracer.tracing(options['trace']), self.mirrored(scan_calls) as scan_calls, \
+                self.journaling(options) as journal:
+            # fetch each repo once, then scan
+            await self.fetch_repos_async(self.get_repos_to_fetch(scan_calls), fetch_jobs,
+                                         self.get_repos_to_write_commit_graph(scan_calls),
+                                         self.get_fetch_caches(scan_calls))
+            if self.is_streaming(options):
+                return await self.stream_scans_async(scan_calls, max_concurrent_git, multi_target, options, metrics)
+            calls = self.with_metrics(self.without_fetch(scan_calls), metrics)
+            if journal is None:
+                reports = await self.run_scans_async(calls, max_concurrent_git, multi_target)
+            else:
+                # scan only what the journal does not have yet, and journal each scan once it is done
+                tips = await self.read_repo_tips_async(
+                    [repo_dir for branch, repo_dir, scan_kwargs in scan_calls], fetch_jobs)
+                resumed, pending, on_done = self.resume_from_journal(journal, scan_calls, tips)
+                pending_reports = await self.run_scans_async(
+                    [calls[index] for index in pending], max_concurrent_git, multi_target, on_done=on_done)
+                reports = list(self.merge_resumed_reports(resumed, pending_reports, len(calls)))
+            return self.report_scan_multiple(scan_calls, reports, options, kwargs, metrics)
+
+    def watch(self, configs, **kwargs):
+        """
+        keep the report of scan_multiple(configs) in output up to date, until interrupted (or for cycles fetches)
+
+        every fetch_interval seconds the repos are fetched and every scan runs again, as staleness moves with time.
+        in between, the repos whose remote refs change (fetched by anyone) are scanned again as soon as they do.
+        the unmerged commits of each branch tip are kept in memory (unless there is a cache_dir), so scans only walk
+        the branches which moved. the report is replaced atomically after every change. a cycle which fails (e.g. a
+        repo which cannot be read for a moment) is logged, and the last good report is kept.
+        """
+        fetch_interval = float(kwargs.pop('fetch_interval', DEFAULT_FETCH_INTERVAL))
+        fetch_jobs = int(kwargs.pop('fetch_jobs', DEFAULT_FETCH_JOBS))
+        jobs = int(kwargs.pop('jobs', 1))
+        multi_target = kwargs.pop('multi_target', False)
+        use_inotify = kwargs.pop('use_inotify', True)
+        poll_interval = float(kwargs.pop('poll_interval', RefWatcher.POLL_INTERVAL_DEFAULT))
+        cycles = kwargs.pop('cycles', None)
+        on_results = kwargs.pop('on_results', None)  # called with the results after every change
+        options = self.pop_scan_multiple_options(kwargs)
+        assert options['output'] or on_results is not None, 'watch keeps a report in an output file, or on_results'
+        assert options['format'] == 'json' and not options['return_report'], 'watch keeps a json report'
+        assert not options['journal'], 'watch scans all the time, its scans are not journaled'
+        kwargs.setdefault('memory_cache', True)
+        scan_calls = self.get_scan_calls(configs, kwargs)
+        reports = [None] * len(scan_calls)
+        cycle = 0
+        with self.mirrored(scan_calls) as scan_calls:
+            groups = self.group_scan_calls_by_repo(scan_calls)
+            with RefWatcher(list(groups), use_inotify, poll_interval) as watcher:
+                while cycles is None or cycle < cycles:
+                    cycle += 1
+                    next_fetch = time.monotonic() + fetch_interval
+                    try:
+                        self.fetch_repos(self.get_repos_to_fetch(scan_calls), fetch_jobs,
+                                         self.get_repos_to_write_commit_graph(scan_calls),
+                                         self.get_fetch_caches(scan_calls))
+                    except Exception as exc:
+                        print('exception fetching repos, scanning what was fetched: {}'.format(exc), file=sys.stderr)
+                    watcher.wait(0)  # the changes made by the fetch, every repo is scanned again anyway
+                    changed = set(groups)
+                    while True:
+                        if changed:
+                            # a failed rescan keeps the last good report, until the next change or fetch
+                            new_reports = list(reports)
+                            indexes = sorted(index for repo_dir in changed for index in groups[repo_dir])
+                            changed_calls = self.without_fetch([scan_calls[index] for index in indexes])
+                            try:
+                                for index, report in zip(indexes, self.run_scans(changed_calls, jobs, multi_target)):
+                                    new_reports[index] = report
+                                print('rescanned {} repos'.format(len(changed)), file=sys.stderr)
+                                if on_results is not None:
+                                    on_results([{'branch': branch, 'repo_dir': repo_dir, 'report': report}
+                                                for (branch, repo_dir, scan_kwargs), report
+                                                in zip(scan_calls, new_reports)])
+                                if options['output']:
+                                    self.report_scan_multiple(scan_calls, new_reports, options, kwargs)
+                            except Exception as exc:
+                                print('exception rescanning {} repos, keeping the last report: {}'.format(
+                                    len(changed), exc), file=sys.stderr)
+                            else:
+                                reports = new_reports
+                        remaining = next_fetch - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        changed = watcher.wait(remaining)
+        return 0
+
+    def serve(self, configs, **kwargs):
+        """
+        answer http queries for the stale branches of configs (see ScanQueryHandler) until interrupted
+
+        the results are kept up to date like with watch, each change swaps in a new index without downtime
+        """
+        host = kwargs.pop('host', DEFAULT_SERVE_HOST)
+        port = int(kwargs.pop('port'))
+        assert not kwargs.get('summary'), 'the query index is built of commits by author, not summaries'
+        server = ScanQueryServer((host, port))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        print('serving on http://{}:{}/branches'.format(*server.server_address[:2]), file=sys.stderr)
+        try:
+            return self.watch(configs, on_results=server.update, **kwargs)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    async def stream_scans_async(self, scan_calls, max_concurrent_git, multi_target, options, metrics=None):
+        """write each report as ndjson once it and all reports before it are done, without keeping it"""
+        with NdjsonReportWriter(options['output']) as writer:
+            def on_report(index, report_by_branch):
+                branch, repo_dir, scan_kwargs = scan_calls[index]
+                writer.write_scan(branch, repo_dir, report_by_branch)
+
+            await self.run_scans_async(
+                self.with_metrics(self.without_fetch(scan_calls), metrics), max_concurrent_git, multi_target,
+                on_report)
+        if metrics is not None:
+            self.write_metrics_file(options['metrics_file'], self.aggregate_metrics_by_repo(scan_calls, metrics))
+        return 0
+
+    @staticmethod
+    def pop_scan_multiple_options(kwargs):
         # handle kwargs before sending to scan (some of them should not be sent, or we want to ensure certain kwargs)
-        return_report = kwargs.pop('return_report', False)
+        options = {
+            'return_report': kwargs.pop('return_report', False),
+            'report_by_email': kwargs.pop('report_by_email', False),
+            'report_by_repo': kwargs.pop('report_by_repo', False),
+            'report_by_age': kwargs.pop('report_by_age', False),
+            'output': kwargs.pop('output', None),
+            'format': kwargs.pop('format', 'json'),
+            'metrics': kwargs.pop('metrics', False),
+            'metrics_file': kwargs.pop('metrics_file', None),
+            'trace': kwargs.pop('trace', None),
+            'history_db': kwargs.pop('history_db', None),
+            'journal': kwargs.pop('journal', None),
+            'resume': kwargs.pop('resume', False),
+            'summary': kwargs.get('summary', False),  # also a scan option
+        }
+        assert options['journal'] or not options['resume'], 'resume needs a journal'
+        assert not (options['summary'] and (options['report_by_email'] or options['report_by_age'])), \
+            'summaries have no commits by author, they can not be aggregated by email or age'
+        assert not (options['summary'] and options['history_db']), \
+            'summaries have no commits by author, they can not be recorded to a history'
+
+        if options['format'] == 'ndjson':
+            assert not (options['report_by_email'] or options['report_by_repo'] or options['report_by_age']), \
+                'ndjson reports are written per scan, they can not be aggregated by email, repo or age'
+            assert not options['history_db'], 'ndjson reports are not kept, they can not be recorded to a history'
         kwargs['return_report'] = True  # override in order to always get scan report from self.scan
-        report_by_email = kwargs.pop('report_by_email', False)
-        report_by_repo = kwargs.pop('report_by_repo', False)
-        output = kwargs.pop('output', None)
+        return options
 
-        results_by_branch = []
+    @staticmethod
+    def new_scan_metrics(scan_calls, options):
+        """a ScanMetrics for each scan call when metrics are asked for, otherwise None"""
+        if options['metrics'] or options['metrics_file']:
+            return [ScanMetrics() for _ in scan_calls]
+        return None
+
+    @staticmethod
+    def with_metrics(scan_calls, metrics) -> list:
+        """the same scan calls, each recording into its ScanMetrics"""
+        if metrics is None:
+            return scan_calls
+        return [(branch, repo_dir, dict(scan_kwargs, metrics=scan_metrics))
+                for (branch, repo_dir, scan_kwargs), scan_metrics in zip(scan_calls, metrics)]
+
+    def aggregate_metrics_by_repo(self, scan_calls, metrics) -> dict:
+        """sum the metrics of the scans (and the fetch stage) of each repo into {repo_dir: ScanMetrics}"""
+        metrics_by_repo = {}
+        for (branch, repo_dir, scan_kwargs), scan_metrics in zip(scan_calls, metrics):
+            metrics_by_repo.setdefault(self.local_repo_dir(repo_dir), ScanMetrics()).add(scan_metrics)
+        for repo_dir, fetch_metrics in self.fetch_metrics.items():
+            if repo_dir in metrics_by_repo:
+                metrics_by_repo[repo_dir].add(fetch_metrics)
+        return metrics_by_repo
+
+    @staticmethod
+    def write_metrics_file(metrics_file, metrics_by_repo):
+        if metrics_file:
+            ScanMetrics.write_prometheus_textfile(metrics_file, metrics_by_repo)
+
+    @staticmethod
+    def is_streaming(options):
+        return options['format'] == 'ndjson' and not options['return_report']
+
+    @staticmethod
+    def get_scan_calls(configs, kwargs):
+        scan_calls = []
         for config in configs:
             # each config MUST have branch & repo_dir
             branch = config.pop('branch')
@@ -285,22 +3716,156 @@ class ScanUnmergedBranches(object):
             # then we take the rest of config as kwargs, and **kwargs overwrite
             scan_kwargs = config
             scan_kwargs.update(kwargs)
-            report_by_branch = self.scan(branch, repo_dir, **scan_kwargs)
+            scan_calls.append((branch, repo_dir, scan_kwargs))
+        return scan_calls
+
+    def report_scan_multiple(self, scan_calls, reports, options, kwargs, metrics=None):
+        return_report = options['return_report']
+        report_by_email = options['report_by_email']
+        report_by_repo = options['report_by_repo']
+        report_by_age = options['report_by_age']
+        output = options['output']
+
+        if self.is_streaming(options):
+            scan_reports = ((branch, repo_dir, report_by_branch)
+                            for (branch, repo_dir, scan_kwargs), report_by_branch in zip(scan_calls, reports))
+            rc = self.write_ndjson_report(scan_reports, output=output, **kwargs)
+            if metrics is not None:
+                self.write_metrics_file(options['metrics_file'], self.aggregate_metrics_by_repo(scan_calls, metrics))
+            return rc
+
+        results_by_branch = []
+        for index, ((branch, repo_dir, scan_kwargs), report_by_branch) in enumerate(zip(scan_calls, reports)):
             results_by_branch.append(
                 {'branch': branch, 'repo_dir': repo_dir, 'report': report_by_branch, 'kwargs': scan_kwargs})
+            if options['metrics']:
+                results_by_branch[-1]['metrics'] = metrics[index].as_dict()
+        # indexed once for the history and the aggregation, only when one of them needs it (summaries have no
+        # commits to index)
+        needs_facts = options['history_db'] or (not report_by_repo and (report_by_email or report_by_age))
+        facts = ScanFacts(results_by_branch) if needs_facts and not options['summary'] else None
+        if options['history_db']:
+            self.open_history(options['history_db']).record(facts, kwargs.get('now'))
+        if metrics is not None:
+            self.write_metrics_file(options['metrics_file'], self.aggregate_metrics_by_repo(scan_calls, metrics))
 
         if report_by_repo:
-            report = self.aggregate_scan_results_by_repo(results_by_branch)
+            report = ScanFacts.group_by_repo(results_by_branch)
         elif report_by_email:
-            report = self.aggregate_scan_results_by_email(results_by_branch)
+            report = facts.by_email()
+        elif report_by_age:
+            report = facts.by_age(self.get_timestamp_now() if kwargs.get('now') is None else kwargs['now'])
         else:
             report = results_by_branch
 
         if return_report:
-            return report
+            return self.materialize_report(report)
         else:
             return self.write_report(report, output=output, **kwargs)
 
+    def run_scans(self, scan_calls, jobs=1, multi_target=False, on_done=None):
+        """
+        run scans and yield their reports in the same order as scan_calls
+
+        with jobs, the reports of a group are yielded as soon as the group and all the scans before it are done, only
+        the reports done ahead of an earlier scan are kept until it is done
+
+        :param scan_calls: list of (branch, repo_dir, scan_kwargs)
+        :param jobs: number of worker threads, scans of the same repo_dir never run at the same time
+        :param multi_target: scan all the target branches of a repo from one shared history walk
+        :param on_done: on_done(index, report) is called as soon as a scan is done (in any order, from the worker
+            threads with jobs)
+        """
+        if jobs <= 1 and not multi_target:
+            for index, (branch, repo_dir, scan_kwargs) in enumerate(scan_calls):
+                report = run_git_steps(self.scan_steps(branch, repo_dir, **scan_kwargs))
+                if on_done is not None:
+                    on_done(index, report)
+                yield report
+            return
+
+        # each group of scans runs serially in one worker so git never works on a repo concurrently
+        groups = self.group_scan_calls_by_repo(scan_calls)
+
+        def run_group(indexes):
+            reports = run_git_steps(self.scan_group_steps([scan_calls[index] for index in indexes], multi_target))
+            if on_done is not None:
+                for index, report in zip(indexes, reports):
+                    on_done(index, report)
+            return dict(zip(indexes, reports))
+
+        if jobs <= 1:
+            reports = {}
+            group_of_index = {index: indexes for indexes in groups.values() for index in indexes}
+            for index in range(len(scan_calls)):
+                if index not in reports:
+                    reports.update(run_group(group_of_index[index]))
+                yield reports.pop(index)
+            return
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # as_completed drops each future (and its reports) once it is yielded
+            done = as_completed([executor.submit(run_group, indexes) for indexes in groups.values()])
+            reports = {}
+            next_index = 0
+            for future in done:
+                reports.update(future.result())
+                del future  # the reports of the group are only held by reports
+                while next_index in reports:
+                    yield reports.pop(next_index)
+                    next_index += 1
+
+    async def run_scans_async(self, scan_calls, max_concurrent_git=DEFAULT_MAX_CONCURRENT_GIT, multi_target=False,
+                              on_report=None, on_done=None):
+        """
+        run scans concurrently on the event loop and return their reports in the same order as scan_calls
+
+        with on_report, on_report(index, report) is called in the order of scan_calls as soon as a report and all
+        reports before it are done, and the reports are not kept (the returned list is all None). with on_done,
+        on_done(index, report) is called as soon as each scan is done, in any order.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent_git)
+        reports = [None] * len(scan_calls)
+        done = [False] * len(scan_calls)
+        next_index = [0]
+
+        def report_done():
+            while next_index[0] < len(scan_calls) and done[next_index[0]]:
+                on_report(next_index[0], reports[next_index[0]])
+                reports[next_index[0]] = None
+                next_index[0] += 1
+
+        async def run_group(indexes):
+            # scans of the same repo_dir run one after the other
+            steps = self.scan_group_steps([scan_calls[index] for index in indexes], multi_target)
+            group_reports = await run_git_steps_async(steps, semaphore)
+            for index, report in zip(indexes, group_reports):
+                reports[index] = report
+                done[index] = True
+                if on_done is not None:
+                    on_done(index, report)
+            if on_report is not None:
+                report_done()
+
+        groups = self.group_scan_calls_by_repo(scan_calls)
+        tasks = [asyncio.ensure_future(run_group(indexes)) for indexes in groups.values()]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # a failed (or cancelled) scan cancels the others, which kills their git processes
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return reports
+
+    def group_scan_calls_by_repo(self, scan_calls) -> dict:
+        """map each repo (absolute path) to the indexes of its scan calls"""
+        groups = {}
+        for index, (branch, repo_dir, scan_kwargs) in enumerate(scan_calls):
+            groups.setdefault(self.local_repo_dir(repo_dir), []).append(index)
+        return groups
+
     @staticmethod
     def read_configs(configs_path):
         """read configs from file for multiple scanning"""
@@ -328,83 +3893,145 @@ class ScanUnmergedBranches(object):
         return configs
 
     @classmethod
-    def create_pipeline_report(cls, results_by_branch):
-        pipeline_results = {'scans': {}}
-        message_lines = []  # message for sending to slack
-        for result_by_branch in sorted(results_by_branch, key=lambda r: (os.path.basename(r['repo_dir']), r['branch'])):
-            repo_dir = result_by_branch['repo_dir']
-            repo_name = os.path.basename(repo_dir)  # we assume the repo name is unique
-            target_branch = result_by_branch['branch']
-            scan_id = '<{}>:{}'.format(repo_name, target_branch)
-
-            if not result_by_branch['report']:
-                # fresh repo, add it to the message so we know it was scanned, and mark is as fresh.
-                message_lines.append(' - {} *fresh*'.format(scan_id))
-                continue  # if it is fresh, we don't need to collect branches or add it to the list of stale results
-
-            # for stale repo we should collect branches etc.
-            pipeline_results['scans'][scan_id] = result_by_branch['report']
-            message_lines.append(' - {}'.format(scan_id))
-            for branch, commits_by_author in result_by_branch['report'].items():
-                for author, commits_list in commits_by_author.items():
-                    # we want to add how stale the branch is by getting the staleness of the most recent commit
-                    latest_date = cls.extract_latest_date_from_commits(commits_list)
-                    staleness = (cls.get_datetime_now_with_tz() - latest_date).days
-                    message_lines.append('    * {} ({} days)'.format(branch, staleness))
+    def create_pipeline_report(cls, results_by_branch, now=None):
+        now = cls.get_timestamp_now() if now is None else now
+        facts = ScanFacts.of(results_by_branch)
+        return facts.pipeline_report(now)
 
-        pipeline_results['message'] = '\n'.join(message_lines)
-        return pipeline_results
+    @staticmethod
+    def create_changes_message(changes):
+        """message (for sending to slack) of the branches which became stale, and stopped being stale, in a run"""
+        message_lines = []
+        for key, title in (('new', 'new stale branches'), ('gone', 'no longer stale')):
+            if changes[key]:
+                message_lines.append('{}:'.format(title))
+            for change in changes[key]:
+                message_lines.append(' - <{}>:{} {} ({})'.format(
+                    os.path.basename(change['repo_dir']), change['target'], change['branch'],
+                    ', '.join(change['authors'])))
+        return '\n'.join(message_lines) or 'no changes'
 
     @staticmethod
     def aggregate_scan_results_by_repo(results_by_branch):
-        results_by_repo = {}
-        for result_by_branch in results_by_branch:
-            repo_dir = result_by_branch['repo_dir']
-            target_branch = result_by_branch['branch']
-            repo_dict = results_by_repo.setdefault(repo_dir, {})
-            repo_dict[target_branch] = result_by_branch['report']
-        return results_by_repo
+        return ScanFacts.group_by_repo(results_by_branch)
 
     @staticmethod
     def aggregate_scan_results_by_email(results_by_branch):
-        results_by_email = {}
-        for result_by_branch in results_by_branch:
-            repo_dir = result_by_branch['repo_dir']
-            target_branch = result_by_branch['branch']
-            for branch, commits_by_author in result_by_branch['report'].items():
-                for author, commits_list in commits_by_author.items():
-                    author_dict = results_by_email.setdefault(author, {})
-                    repo_dict = author_dict.setdefault(repo_dir, {})
-                    repo_dict[target_branch] = commits_list
-        return results_by_email
+        return ScanFacts(results_by_branch).by_email()
+
+    @classmethod
+    def aggregate_scan_results_by_age(cls, results_by_branch, now=None):
+        now = cls.get_timestamp_now() if now is None else now
+        return ScanFacts(results_by_branch).by_age(now)
 
 
 def scan(branch, repo_dir='.', **kwargs):
     sub = ScanUnmergedBranches()
-    return sub.scan(branch, repo_dir, **kwargs)
+    try:
+        return sub.scan(branch, repo_dir, **kwargs)
+    finally:
+        sub.close()
 
 
 def scan_multiple(configs, **kwargs):
     sub = ScanUnmergedBranches()
-    return sub.scan_multiple(configs, **kwargs)
+    try:
+        return sub.scan_multiple(configs, **kwargs)
+    finally:
+        sub.close()
 
 
 def scan_multiple_from_input_file(input_file, **kwargs):
     sub = ScanUnmergedBranches()
     configs = sub.read_configs(input_file)
-    return sub.scan_multiple(configs, **kwargs)
+    try:
+        return sub.scan_multiple(configs, **kwargs)
+    finally:
+        sub.close()
+
+
+def watch_from_input_file(input_file, **kwargs):
+    sub = ScanUnmergedBranches()
+    configs = sub.read_configs(input_file)
+    try:
+        return sub.watch(configs, **kwargs)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        sub.close()
+
+
+def merge_pipeline_shards(pipeline_shard_files, pipeline_output_file, **kwargs):
+    sub = ScanUnmergedBranches()
+    pipeline_shards = []
+    for pipeline_shard_file in pipeline_shard_files:
+        with open(pipeline_shard_file) as f:
+            pipeline_shards.append(json.load(f))
+    try:
+        return sub.merge_pipeline_shards(pipeline_shards, pipeline_output_file, **kwargs)
+    finally:
+        sub.close()
+
+
+def history_delta(history_db, run_id=None):
+    """the changes recorded in history_db by a run (default the latest), see ScanHistory.delta"""
+    history = ScanHistory(history_db)
+    try:
+        return history.delta(run_id)
+    finally:
+        history.close()
+
+
+def serve_from_input_file(input_file, **kwargs):
+    sub = ScanUnmergedBranches()
+    configs = sub.read_configs(input_file)
+    try:
+        return sub.serve(configs, **kwargs)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        sub.close()
+
+
+async def scan_async(branch, repo_dir='.', **kwargs):
+    sub = ScanUnmergedBranches()
+    try:
+        return await sub.scan_async(branch, repo_dir, **kwargs)
+    finally:
+        sub.close()
+
+
+async def scan_multiple_async(configs, **kwargs):
+    sub = ScanUnmergedBranches()
+    try:
+        return await sub.scan_multiple_async(configs, **kwargs)
+    finally:
+        sub.close()
+
+
+async def scan_multiple_from_input_file_async(input_file, **kwargs):
+    sub = ScanUnmergedBranches()
+    configs = sub.read_configs(input_file)
+    try:
+        return await sub.scan_multiple_async(configs, **kwargs)
+    finally:
+        sub.close()
 
 
 def scan_multiple_pipeline(pipeline_input_file, pipeline_output_file, **kwargs):
     sub = ScanUnmergedBranches()
     configs = sub.read_configs_pipeline(pipeline_input_file)
-    return sub.scan_multiple_pipeline(configs, pipeline_output_file, **kwargs)
+    try:
+        return sub.scan_multiple_pipeline(configs, pipeline_output_file, **kwargs)
+    finally:
+        sub.close()
 
 
 usage = """%prog [options] [BRANCH] [REPO_DIR]
 
 if no BRANCH is provided, uses the default main branch (main)
 if no REPO_DIR is provided, uses .
+REPO_DIR can be the url of a remote repo, it is scanned from a local mirror (see --mirror-dir)
 
 if not --output path is provided, print to STDOUT
 
@@ -422,7 +4049,21 @@ Input file Modes:
         file is a txt file. each line is a a config
         config is BRANCH and REPO_DIR separated by whitespace, can define no additional options
         
-    supported options (json and csv mode only): include_main, stale, fetch_first
+    supported options (json and csv mode only): include_main, stale, fetch_first, batch, pushdown,
+                                                  cache_dir, backend, write_commit_graph, mirror_dir,
+                                                  mirror_max_mb, skip_unchanged
+
+pipeline scans can be split across nodes: with --shard INDEX/COUNT a node scans only the repos of its shard
+(each REPO_NAME, with all its targets, belongs to one shard) and --pipeline-output is a partial result.
+--merge --pipeline-output report.json SHARD_FILE... then writes the report of all the shards, the same report a
+single node scanning every config writes.
+
+with --journal path each finished scan of an input file is appended to path. when a run dies, running it again
+with --resume skips the configs already journaled whose repo refs (after fetching) did not change.
+
+with --summary each stale branch is reported as the number of its unmerged commits, the dates (utc) of the newest
+and oldest of them and the number of commits of each author, like:
+    {"origin/feature/x": {"commits": 3, "newest": "...", "oldest": "...", "authors": {"alice@example.com": 3}}}
 
 """
 
@@ -432,38 +4073,232 @@ def main(args):
     parser.add_option('--input', dest='input_file', default='',
                       help='(optional) the path for the input file (MUST be one of [.json, .csv or .txt])')
     parser.add_option('--output', dest='output', default='',
-                      help='(optional) the path for the output file (MUST be a .json file)')
+                      help='(optional) the path for the output file (MUST be a .json file, .ndjson or .jsonl '
+                           'with --format ndjson)')
+    parser.add_option('--format', dest='format', default='json', type='choice', choices=['json', 'ndjson'],
+                      help='json writes one report at the end, ndjson writes a line per stale branch as soon as '
+                           'its scan is done (default json)')
     parser.add_option('--pipeline-input', dest='pipeline_input', default='',
                       help='(for pipeline only) read pipeline format input from path (MUST be a .json file)')
     parser.add_option('--pipeline-output', dest='pipeline_output', default='',
                       help='(for pipeline only) write pipeline format output to path (MUST be a .json file)')
+    parser.add_option('--shard', dest='shard', default='',
+                      help='(for pipeline only) scan only the repos of shard INDEX of COUNT (e.g. 0/4), and write '
+                           'a partial result to --pipeline-output, for --merge')
+    parser.add_option('--merge', dest='merge', default=False, action="store_true",
+                      help='(for pipeline only) merge the partial results of all the shards (given as arguments) '
+                           'into the pipeline report at --pipeline-output')
     parser.add_option('--include-main', dest='include_main', default=False, action="store_true",
                       help='Include main branch when checking unmerged commits (relevant when BRANCH is not main)')
     parser.add_option('--no-fetch-first', dest='fetch_first', default=True, action="store_false",
                       help='Do not perform git fetch before scanning (usually you want to fetch first)')
+    parser.add_option('--no-batch', dest='batch', default=True, action="store_false",
+                      help='Run git log once per unmerged branch instead of a single walk for all branches')
+    parser.add_option('--no-pushdown', dest='pushdown', default=True, action="store_false",
+                      help='Do not skip branches with a fresh tip commit before reading their unmerged commits')
     parser.add_option('--stale', dest='stale', default=ScanUnmergedBranches.STALE_DAYS_DEFAULT,
                       help='How many days without changes to consider a branch stale (default 7)')
+    parser.add_option('--summary', dest='summary', default=False, action="store_true",
+                      help='Report a summary of each stale branch (how many unmerged commits, their newest and oldest '
+                           'date and how many by each author) instead of every commit, git lists less about commits')
     parser.add_option('--report-by-email', dest='report_by_email', default=False, action="store_true",
                       help='(with input file only) report will be aggregated by author email (default: none)')
     parser.add_option('--report-by-repo', dest='report_by_repo', default=False, action="store_true",
                       help='(with input file only) report will be aggregated by repo (default: none)')
+    parser.add_option('--report-by-age', dest='report_by_age', default=False, action="store_true",
+                      help='(with input file only) report will be aggregated by the age (days) of the stale branches '
+                           '(default: none)')
+    parser.add_option('--jobs', dest='jobs', default=1, type='int',
+                      help='(with input file only) how many repos to scan in parallel (default 1)')
+    parser.add_option('--fetch-jobs', dest='fetch_jobs', default=DEFAULT_FETCH_JOBS, type='int',
+                      help='(with input file only) how many repos to fetch in parallel (default {})'.format(
+                          DEFAULT_FETCH_JOBS))
+    parser.add_option('--multi-target', dest='multi_target', default=False, action="store_true",
+                      help='(with input file only) scan all target branches of a repo from one shared history walk')
+    parser.add_option('--backend', dest='backend', default=DEFAULT_GIT_BACKEND, type='choice',
+                      choices=list(GIT_BACKENDS),
+                      help='how unmerged commits are read: subprocess runs git per query, cat-file walks history '
+                           'in process from a long-lived git cat-file --batch per repo, odb also reads refs and '
+                           'objects from the repo files without git (default {})'.format(
+                          DEFAULT_GIT_BACKEND))
+    parser.add_option('--write-commit-graph', dest='write_commit_graph', default=False, action="store_true",
+                      help='Write a commit-graph after fetching each repo (git commit-graph write --reachable '
+                           '--split), the cat-file and odb backends walk history from it without reading commits')
+    parser.add_option('--cache-dir', dest='cache_dir', default='',
+                      help='(optional) directory for caching unmerged commits between scans (default: no cache)')
+    parser.add_option('--cache-max-age-days', dest='cache_max_age_days', default=ScanCache.MAX_AGE_DAYS_DEFAULT,
+                      type='int', help='evict cache entries unused for this many days (default {})'.format(
+                          ScanCache.MAX_AGE_DAYS_DEFAULT))
+    parser.add_option('--cache-max-entries', dest='cache_max_entries', default=ScanCache.MAX_ENTRIES_DEFAULT,
+                      type='int', help='evict least recently used cache entries above this count (default {})'.format(
+                          ScanCache.MAX_ENTRIES_DEFAULT))
+    parser.add_option('--skip-unchanged', dest='skip_unchanged', default=False, action="store_true",
+                      help='(with --cache-dir only) skip the fetch, and listing the branches again, of repos whose '
+                           'remote refs (git ls-remote) are the same as at their last fetch')
+    parser.add_option('--mirror-dir', dest='mirror_dir', default='',
+                      help='(optional) directory for the blobless mirrors of repos given by url, shared by '
+                           'concurrent scans (default {})'.format(MirrorCache.default_cache_dir()))
+    parser.add_option('--mirror-max-mb', dest='mirror_max_mb', default=MirrorCache.MAX_MB_DEFAULT, type='int',
+                      help='evict least recently used mirrors while the mirror dir is larger than this (default {})'
+                      .format(MirrorCache.MAX_MB_DEFAULT))
+    parser.add_option('--history-db', dest='history_db', default='',
+                      help='(with input file only) append the stale branches of every run to this sqlite file, '
+                           'pipeline reports then also list the changes since the previous run')
+    parser.add_option('--history-delta', dest='history_delta', default=False, action="store_true",
+                      help='(with --history-db only) print the branches which became stale, or stopped being stale, '
+                           'in the latest recorded run, without scanning')
+    parser.add_option('--journal', dest='journal', default='',
+                      help='(with input file only) append each finished scan to this checkpoint file, so a run which '
+                           'dies can be resumed with --resume')
+    parser.add_option('--resume', dest='resume', default=False, action="store_true",
+                      help='(with --journal only) do not scan again the configs which are in the journal and whose '
+                           'repo refs did not change since')
+    parser.add_option('--metrics', dest='metrics', default=False, action="store_true",
+                      help='(with input file only) add the duration, git processes and git output size of each '
+                           'scan phase to the results (per repo totals for pipeline scans)')
+    parser.add_option('--metrics-file', dest='metrics_file', default='',
+                      help='(optional) write per repo scan metrics to path in the prometheus text format, for the '
+                           'node exporter textfile collector (MUST be a .prom file)')
+    parser.add_option('--trace', dest='trace', default='',
+                      help='(optional) record git commands and scan phases to path as chrome trace events, '
+                           'to open in chrome://tracing or perfetto (MUST be a .json file)')
+    parser.add_option('--watch', dest='watch', default=False, action="store_true",
+                      help='(with input file and output only) keep running, fetch every --fetch-interval seconds and '
+                           'rescan repos as soon as their remote refs change, replacing the output report each time')
+    parser.add_option('--serve', dest='serve', default=0, type='int',
+                      help='(with input file only) keep scanning like --watch and answer http queries on this port, '
+                           'e.g. /branches?author=alice@example.com&older_than=30 (also repo, target and branch)')
+    parser.add_option('--host', dest='host', default=DEFAULT_SERVE_HOST,
+                      help='(with --serve only) address to listen on (default {})'.format(DEFAULT_SERVE_HOST))
+    parser.add_option('--fetch-interval', dest='fetch_interval', default=DEFAULT_FETCH_INTERVAL, type='int',
+                      help='(with --watch or --serve only) seconds between fetches of all repos (default {})'.format(
+                          DEFAULT_FETCH_INTERVAL))
+    parser.add_option('--async', dest='use_async', default=False, action="store_true",
+                      help='(with input file only) scan all repos concurrently on an asyncio event loop')
+    parser.add_option('--max-concurrent-git', dest='max_concurrent_git', default=DEFAULT_MAX_CONCURRENT_GIT,
+                      type='int', help='(with --async only) maximum git processes running at once (default {})'.format(
+                          DEFAULT_MAX_CONCURRENT_GIT))
     options, args = parser.parse_args(args)
 
     kwargs = {}
 
-    if options.output and not options.output.endswith('.json'):
+    if options.format == 'ndjson':
+        if options.output and not options.output.endswith(('.ndjson', '.jsonl')):
+            parser.error('output path must be a .ndjson or .jsonl file with --format ndjson')
+        if options.report_by_email or options.report_by_repo or options.report_by_age:
+            parser.error('--format ndjson can not be combined with --report-by-email, --report-by-repo or '
+                         '--report-by-age')
+        if options.pipeline_input or options.pipeline_output:
+            parser.error('--format ndjson is not supported for pipeline scans')
+    elif options.output and not options.output.endswith('.json'):
         parser.error('output path must be a .json file')
+    if options.metrics_file and not options.metrics_file.endswith('.prom'):
+        parser.error('metrics file path must be a .prom file')
+    if options.trace and not options.trace.endswith('.json'):
+        parser.error('trace path must be a .json file')
+    if options.shard:
+        if not (options.pipeline_input and options.pipeline_output):
+            parser.error('--shard needs --pipeline-input and --pipeline-output')
+        if options.history_db:
+            parser.error('--shard can not be combined with --history-db (record the history with --merge)')
+        try:
+            kwargs['shard'] = ScanUnmergedBranches.parse_shard(options.shard)
+        except ValueError:
+            parser.error('--shard must be INDEX/COUNT with 0 <= INDEX < COUNT, got {}'.format(options.shard))
+    if options.merge:
+        if not options.pipeline_output or options.pipeline_input or options.shard:
+            parser.error('--merge needs a --pipeline-output (and no --pipeline-input or --shard)')
+        if not args:
+            parser.error('--merge needs the partial results of the shards as arguments')
+    if options.summary:
+        if options.report_by_email or options.report_by_age or options.history_db:
+            parser.error('--summary can not be combined with --report-by-email, --report-by-age or --history-db')
+        if options.format == 'ndjson' or options.pipeline_input or options.merge or options.serve:
+            parser.error('--summary can not be combined with --format ndjson, pipeline scans or --serve')
+    if options.multi_target and not options.batch:
+        parser.error('--multi-target walks all branches at once, it can not be combined with --no-batch')
+    if options.resume and not options.journal:
+        parser.error('--resume needs a --journal')
+    if options.journal and not options.input_file or options.journal and (options.watch or options.serve):
+        parser.error('--journal needs an --input file (and no --watch or --serve)')
+    if options.journal and options.use_async and options.format == 'ndjson':
+        parser.error('--journal can not be combined with --async and --format ndjson')
+    if options.history_delta and not options.history_db:
+        parser.error('--history-delta needs a --history-db')
+    if options.history_db and options.format == 'ndjson':
+        parser.error('--history-db can not be combined with --format ndjson')
+    if options.skip_unchanged and not options.cache_dir:
+        parser.error('--skip-unchanged needs a --cache-dir')
+    if options.watch and not (options.input_file and options.output and options.format == 'json'):
+        parser.error('--watch needs an --input file and a json --output')
+    if options.serve and not (options.input_file and options.format == 'json'):
+        parser.error('--serve needs an --input file (and a json --output if any)')
 
     kwargs.setdefault('output', options.output)
+    kwargs.setdefault('format', options.format)
     kwargs.setdefault('include_main', options.include_main)
     kwargs.setdefault('fetch_first', options.fetch_first)
     kwargs.setdefault('stale', options.stale)
+    kwargs.setdefault('batch', options.batch)
+    kwargs.setdefault('pushdown', options.pushdown)
+    if options.summary:
+        kwargs.setdefault('summary', options.summary)
+    if options.backend != DEFAULT_GIT_BACKEND:
+        kwargs.setdefault('backend', options.backend)
+    if options.write_commit_graph:
+        kwargs.setdefault('write_commit_graph', options.write_commit_graph)
+    kwargs.setdefault('jobs', options.jobs)
+    kwargs.setdefault('fetch_jobs', options.fetch_jobs)
+    kwargs.setdefault('multi_target', options.multi_target)
+    if options.trace:
+        kwargs.setdefault('trace', options.trace)
+    if options.metrics or options.metrics_file:
+        kwargs.setdefault('metrics', options.metrics)
+        kwargs.setdefault('metrics_file', options.metrics_file)
+    if options.cache_dir:
+        kwargs.setdefault('cache_dir', options.cache_dir)
+        kwargs.setdefault('cache_max_age_days', options.cache_max_age_days)
+        kwargs.setdefault('cache_max_entries', options.cache_max_entries)
+    if options.skip_unchanged:
+        kwargs.setdefault('skip_unchanged', options.skip_unchanged)
+    if options.history_db:
+        kwargs.setdefault('history_db', options.history_db)
+    if options.journal:
+        kwargs.setdefault('journal', options.journal)
+        kwargs.setdefault('resume', options.resume)
+    if options.mirror_dir:
+        kwargs.setdefault('mirror_dir', options.mirror_dir)
+    if options.mirror_max_mb != MirrorCache.MAX_MB_DEFAULT:
+        kwargs.setdefault('mirror_max_mb', options.mirror_max_mb)
     kwargs.setdefault('report_by_email', options.report_by_email)
     kwargs.setdefault('report_by_repo', options.report_by_repo)
+    kwargs.setdefault('report_by_age', options.report_by_age)
 
-    if options.pipeline_input and options.pipeline_output:
+    if options.history_delta:
+        # from the history alone
+        ScanUnmergedBranches.print_json_to_stdout(history_delta(options.history_db), indent=4)
+        return 0
+    elif options.merge:
+        # pipeline report of the shards of a pipeline scan
+        return merge_pipeline_shards(args, options.pipeline_output, history_db=kwargs.get('history_db'))
+    elif options.pipeline_input and options.pipeline_output:
         # pipeline scan
         return scan_multiple_pipeline(options.pipeline_input, options.pipeline_output, **kwargs)
+    elif options.input_file and options.serve:
+        # keep scanning and answer queries until interrupted
+        kwargs['fetch_interval'] = options.fetch_interval
+        kwargs['port'] = options.serve
+        kwargs['host'] = options.host
+        return serve_from_input_file(options.input_file, **kwargs)
+    elif options.input_file and options.watch:
+        # keep scanning until interrupted
+        kwargs['fetch_interval'] = options.fetch_interval
+        return watch_from_input_file(options.input_file, **kwargs)
+    elif options.input_file and options.use_async:
+        # multiple scan on an event loop
+        kwargs.pop('jobs')
+        kwargs['max_concurrent_git'] = options.max_concurrent_git
+        return asyncio.run(scan_multiple_from_input_file_async(options.input_file, **kwargs))
     elif options.input_file:
         # multiple scan
         return scan_multiple_from_input_file(options.input_file, **kwargs)
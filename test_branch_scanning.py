@@ -4,8 +4,10 @@
 
 # Standard Imports
 import unittest
+import atexit
 import pprint
 import scan_unmerged_branches
+import benchmark_branch_scanning
 import re
 from email.utils import parseaddr
 from subprocess import Popen, PIPE
@@ -18,6 +20,17 @@ import os
 import sys
 import csv
 import json
+import time
+import copy
+import hashlib
+import shutil
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+from unittest import mock
+import subprocess
+import sqlite3
 
 # validation
 branch_pattern = r'((feature|hotfix|bugfix|release)/)?([A-Za-z][A-Za-z0-9-_]+)'  # supports BitBucket/GitBranchFlow 
@@ -30,8 +43,8 @@ date_frmt = '%Y-%m-%dT%H:%M:%S%z'
 python3exe = sys.executable
 this_dir = os.path.dirname(os.path.abspath(__file__))
 project_root_dir = os.path.dirname(this_dir)
-test_temp_dir = os.path.join(this_dir, 'tmp_test')
-os.makedirs(test_temp_dir, exist_ok=True)
+test_temp_dir = tempfile.mkdtemp(prefix='tmp_test.')  # outside the checkout, removed when the tests exit
+atexit.register(shutil.rmtree, test_temp_dir, ignore_errors=True)
 scanner = os.path.abspath(scan_unmerged_branches.__file__)
 ExecRes = namedtuple('ExecRes', 'rc stdout stderr')
 
@@ -46,6 +59,74 @@ def python_exec(cmd, **kwargs):
     return res
 
 
+def git_commit_env(days_ago, author):
+    date_ = datetime.datetime.now().astimezone() - datetime.timedelta(days=days_ago)
+    date_ = date_.replace(microsecond=0).isoformat()
+    env = dict(os.environ)
+    env.update({
+        'GIT_AUTHOR_NAME': author.split('@')[0], 'GIT_AUTHOR_EMAIL': author, 'GIT_AUTHOR_DATE': date_,
+        'GIT_COMMITTER_NAME': author.split('@')[0], 'GIT_COMMITTER_EMAIL': author, 'GIT_COMMITTER_DATE': date_,
+    })
+    return env
+
+
+def git_run(args, cwd, days_ago=0, author='dev@example.com'):
+    res = subprocess.run(['git'] + args, cwd=cwd, env=git_commit_env(days_ago, author),
+                         stdout=PIPE, stderr=PIPE, text=True, check=True)
+    return res.stdout.strip()
+
+
+def git_commit(repo_dir, subject, days_ago, author='dev@example.com'):
+    git_run(['commit', '--allow-empty', '-q', '-m', subject], repo_dir, days_ago, author)
+    return git_run(['rev-parse', 'HEAD'], repo_dir)
+
+
+def create_local_repo(root_dir):
+    """
+    create a bare "origin" repo and a clone of it with a known layout of branches
+
+        main:                       2 commits (120, 90 days old)
+        development:                from main, 1 commit (20 days old)
+        origin/bugfix/merged:       merged to main
+        origin/feature/old-work:    from main, 3 commits (60, 50, 40 days old)
+        origin/feature/shared:      from feature/old-work, 1 commit (35 days old)
+        origin/feature/fresh-work:  from main, 2 commits (30, 1 days old)
+        origin/feature/on-dev:      from development, 1 commit (15 days old)
+
+    :param root_dir: directory to create the repos in
+    :return: path of the clone to scan
+    """
+    origin_dir = os.path.join(root_dir, 'origin.git')
+    repo_dir = os.path.join(root_dir, 'repo')
+    os.makedirs(repo_dir)
+    git_run(['init', '-q', '--bare', origin_dir], root_dir)
+    git_run(['init', '-q'], repo_dir)
+    git_run(['checkout', '-q', '-b', 'main'], repo_dir)
+    git_commit(repo_dir, 'initial commit', 120)
+    git_run(['checkout', '-q', '-b', 'bugfix/merged'], repo_dir)
+    git_commit(repo_dir, 'fix a bug', 100, 'bob@example.com')
+    git_run(['checkout', '-q', 'main'], repo_dir)
+    git_run(['merge', '-q', '--no-ff', '-m', 'merge bugfix', 'bugfix/merged'], repo_dir, 90)
+    git_run(['checkout', '-q', '-b', 'feature/old-work'], repo_dir)
+    git_commit(repo_dir, 'old work part 1', 60, 'alice@example.com')
+    git_commit(repo_dir, 'old work part 2', 50, 'alice@example.com')
+    git_commit(repo_dir, 'old work review fixes', 40, 'bob@example.com')
+    git_run(['checkout', '-q', '-b', 'feature/shared'], repo_dir)
+    git_commit(repo_dir, 'build on old work', 35, 'carol@example.com')
+    git_run(['checkout', '-q', '-b', 'feature/fresh-work', 'main'], repo_dir)
+    git_commit(repo_dir, 'fresh work part 1', 30, 'alice@example.com')
+    git_commit(repo_dir, 'fresh work part 2', 1, 'bob@example.com')
+    git_run(['checkout', '-q', '-b', 'development', 'main'], repo_dir)
+    git_commit(repo_dir, 'development work', 20, 'carol@example.com')
+    git_run(['checkout', '-q', '-b', 'feature/on-dev'], repo_dir)
+    git_commit(repo_dir, 'work based on development', 15, 'carol@example.com')
+    git_run(['checkout', '-q', 'main'], repo_dir)
+    git_run(['remote', 'add', 'origin', origin_dir], repo_dir)
+    git_run(['push', '-q', '--all', 'origin'], repo_dir)
+    git_run(['fetch', '-q', 'origin'], repo_dir)
+    return repo_dir
+
+
 def validate_source_branch(branch):
     return bool(source_branch_regex.fullmatch(branch))
 
@@ -455,6 +536,1208 @@ class TestMultipleRepos(TestRepoBase):
         self.check_result_by_author(results)
 
 
+class TestSyntheticRepoBase(TestRepoBase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root_dir = tempfile.mkdtemp(dir=test_temp_dir, prefix='repo.')
+        cls.repo_dir = create_local_repo(cls.root_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root_dir, ignore_errors=True)
+
+
+class TestBatchCollection(TestSyntheticRepoBase):
+
+    def test_batch_matches_per_branch(self):
+        sub = self.init_scanner()
+        for target in ('main', 'development'):
+            branches = sub.get_list_of_unmerged_branches(target, self.repo_dir, include_main=True)
+            self.assertTrue(branches)
+            batched = sub.fetch_unmerged_commits_by_branch(branches, target, self.repo_dir, batch=True)
+            per_branch = sub.fetch_unmerged_commits_by_branch(branches, target, self.repo_dir, batch=False)
+            self.assertEqual(per_branch, batched)
+
+    def test_batch_attributes_shared_commits(self):
+        sub = self.init_scanner()
+        branches = ['origin/feature/old-work', 'origin/feature/shared']
+        result = sub.get_dict_of_unmerged_commits_by_branch(branches, 'main', self.repo_dir)
+        self.assertEqual(3, len(result['origin/feature/old-work']))
+        self.assertEqual(4, len(result['origin/feature/shared']))
+        self.assertEqual(result['origin/feature/old-work'], result['origin/feature/shared'][1:])
+
+    def test_parse_batch_log(self):
+        sub = self.init_scanner()
+        backend = scan_unmerged_branches.SubprocessGitBackend
+        lines = git_run(['log', '--format=' + backend.BATCH_COMMIT_FRMT, backend.COMMIT_DATE_OPTION,
+                         'origin/feature/shared'], self.repo_dir).splitlines()
+        commits, parents = sub.parse_batch_log(lines)
+        self.assertEqual((commits, parents), backend.parse_batch_log(lines))
+        self.assertEqual(len(lines), len(commits))
+
+    def test_batch_no_branches(self):
+        sub = self.init_scanner()
+        self.assertEqual({}, sub.get_dict_of_unmerged_commits_by_branch([], 'main', self.repo_dir))
+
+    def test_scan_report(self):
+        result = self.execute_code_scan('main', self.repo_dir, fetch_first=False)
+        self.check_result_by_branch(result)
+        self.assertEqual(
+            ['origin/development', 'origin/feature/old-work', 'origin/feature/on-dev', 'origin/feature/shared'],
+            sorted(result))
+        self.assertEqual(['alice@example.com', 'bob@example.com'], sorted(result['origin/feature/old-work']))
+
+    def test_commit_records(self):
+        sub = self.init_scanner()
+        result = sub.get_dict_of_unmerged_commits_by_branch(['origin/feature/old-work'], 'main', self.repo_dir)
+        commits = result['origin/feature/old-work']
+        self.assertIs(commits[1].author, commits[2].author)  # interned
+        for commit in commits:
+            self.assertIsInstance(commit, scan_unmerged_branches.CommitRecord)
+            self.assertEqual(commit, scan_unmerged_branches.CommitRecord.from_list(commit.to_list()))
+            legacy = [commit.hash, commit.date, commit.author, commit.subject]
+            self.assertEqual(commit, scan_unmerged_branches.CommitRecord.from_list(legacy))
+        report = sub.scan('main', self.repo_dir, fetch_first=False, return_report=True)
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+    def test_injected_now(self):
+        now = int(time.time()) + 10 * 86400  # ten days from now, the branch with a commit from yesterday is stale
+        result = self.execute_code_scan('main', self.repo_dir, fetch_first=False, now=now)
+        self.assertIn('origin/feature/fresh-work', result)
+        result = self.execute_code_scan('main', self.repo_dir, fetch_first=False, now=now, stale=12)
+        self.assertNotIn('origin/feature/fresh-work', result)
+        self.assertIn('origin/feature/on-dev', result)  # 15 + 10 days
+
+    def test_deprecated_date_helpers(self):
+        cls = scan_unmerged_branches.ScanUnmergedBranches
+        sub = self.init_scanner()
+        commits = sub.get_dict_of_unmerged_commits_by_branch(['origin/feature/old-work'], 'main',
+                                                            self.repo_dir)['origin/feature/old-work']
+        dicts = [cls.convert_commit_to_dict(commit) for commit in commits]
+        latest = datetime.datetime.fromtimestamp(cls.extract_latest_timestamp_from_commits(commits),
+                                                 datetime.timezone.utc)
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(latest, cls.extract_latest_date_from_commits(dicts))
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(latest, cls.extract_latest_date_from_commits(commits))
+        with self.assertWarns(DeprecationWarning):
+            self.assertTrue(cls.date_is_older_than_n_days(dicts[0]['date'], 10))
+        with self.assertWarns(DeprecationWarning):
+            self.assertFalse(cls.date_is_older_than_n_days(dicts[0]['date'], 1000))
+        with self.assertWarns(DeprecationWarning):
+            self.assertFalse(cls.date_is_older_than_n_days('not a date', 10))
+        with self.assertWarns(DeprecationWarning), self.assertRaises(ValueError):
+            cls.date_is_older_than_n_days('not a date', 10, raise_exceptions=True)
+        with self.assertWarns(DeprecationWarning):
+            self.assertIsNotNone(cls.get_datetime_now_with_tz().tzinfo)
+
+
+    def test_commits_by_author_shapes(self):
+        cls = scan_unmerged_branches.ScanUnmergedBranches
+        sub = self.init_scanner()
+        commits = sub.get_dict_of_unmerged_commits_by_branch(['origin/feature/shared'], 'main',
+                                                            self.repo_dir)['origin/feature/shared']
+        grouped = sub.group_commits_by_author(commits)
+        self.assertEqual(['alice@example.com', 'bob@example.com', 'carol@example.com'], sorted(grouped))
+        self.assertIsInstance(grouped['alice@example.com'][0], scan_unmerged_branches.CommitRecord)
+        expected = {author: [commit.to_report_dict() for commit in author_commits]
+                    for author, author_commits in grouped.items()}
+        self.assertEqual(expected, sub.convert_commits_list_to_dict_by_author(commits))
+        details = [cls.COMMIT_DETAILS(commit.hash, commit.date, commit.author, commit.subject) for commit in commits]
+        self.assertEqual(expected, sub.convert_commits_list_to_dict_by_author(details))
+
+
+class TestParallelScans(TestSyntheticRepoBase):
+
+    def configs(self):
+        # the same repo under two spellings, both must be treated as one repo
+        return [
+            {'branch': 'main', 'repo_dir': self.repo_dir, 'fetch_first': False},
+            {'branch': 'development', 'repo_dir': self.repo_dir, 'fetch_first': False},
+            {'branch': 'main', 'repo_dir': os.path.join(self.repo_dir, '.'), 'fetch_first': False, 'stale': 100},
+        ]
+
+    def test_scan_multiple_jobs_same_results(self):
+        serial = self.execute_code_scan_multiple(self.configs())
+        parallel = self.execute_code_scan_multiple(self.configs(), jobs=4)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(['main', 'development', 'main'], [result['branch'] for result in parallel])
+
+    def test_run_scans_reorders_groups_done_out_of_order(self):
+        other_dir = os.path.join(self.root_dir, 'repo-link')
+        os.symlink(self.repo_dir, other_dir)
+        scan_calls = [('main', self.repo_dir, {'fetch_first': False}),
+                      ('development', other_dir, {'fetch_first': False})]
+        sub = self.init_scanner(save_scans=False)
+        expected = list(sub.run_scans(scan_calls))
+        second_done = threading.Event()
+        scan_group_steps = sub.scan_group_steps
+
+        def first_group_waits(calls, multi_target=False):
+            if calls[0][1] == self.repo_dir:
+                self.assertTrue(second_done.wait(30))
+            return scan_group_steps(calls, multi_target)
+
+        def on_done(index, report):
+            done.append(index)
+            if index == 1:
+                second_done.set()
+
+        done = []
+        with mock.patch.object(sub, 'scan_group_steps', first_group_waits):
+            self.assertEqual(expected, list(sub.run_scans(scan_calls, jobs=2, on_done=on_done)))
+        self.assertEqual([1, 0], done)
+
+    def test_scan_multiple_pipeline_jobs_same_results(self):
+        input_ = os.path.join(self.root_dir, 'pipeline_input.json')
+        with open(input_, 'w') as f:
+            json.dump([{'TARGET_BRANCH': target, 'REPO_NAME': 'repo', 'fetch_first': False}
+                       for target in ('main', 'development')], f)
+        outputs = []
+        for jobs in (1, 4):
+            output = os.path.join(self.root_dir, 'pipeline_output.{}.json'.format(jobs))
+            self.execute_code_scan_multiple_pipeline(input_, output, workspace=self.root_dir, jobs=jobs)
+            with open(output) as f:
+                outputs.append(json.load(f))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('<repo>:main', outputs[0]['scans'])
+
+
+class TestAsyncScans(TestSyntheticRepoBase):
+
+    def test_scan_async_same_as_scan(self):
+        expected = self.execute_code_scan('main', self.repo_dir, fetch_first=False)
+        result = asyncio.run(scan_unmerged_branches.scan_async('main', self.repo_dir, fetch_first=False,
+                                                               return_report=True))
+        self.assertEqual(expected, result)
+
+    def test_scan_multiple_async_same_as_scan_multiple(self):
+        def configs():
+            return [{'branch': target, 'repo_dir': self.repo_dir, 'fetch_first': False}
+                    for target in ('main', 'development')]
+        expected = self.execute_code_scan_multiple(configs(), report_by_email=True)
+        result = asyncio.run(scan_unmerged_branches.scan_multiple_async(
+            configs(), report_by_email=True, return_report=True, max_concurrent_git=1))
+        self.assertEqual(expected, result)
+
+    def test_git_exec_async_timeout_kills_process(self):
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            asyncio.run(scan_unmerged_branches.git_exec_async('sleep 5', timeout=0.2))
+        self.assertLess(time.monotonic() - start, 4)
+
+
+class TestSyntheticRepoGitBase(TestSyntheticRepoBase):
+
+    @staticmethod
+    def record_git_commands(func, *args, **kwargs):
+        """run func and return its result and the list of (cmd, kwargs) it passed to git_exec"""
+        with mock.patch.object(scan_unmerged_branches, 'git_exec', wraps=scan_unmerged_branches.git_exec) as git:
+            result = func(*args, **kwargs)
+        return result, [(call[0][0], call[1]) for call in git.call_args_list]
+
+    def count_git_commands(self, func, *args, **kwargs):
+        result, calls = self.record_git_commands(func, *args, **kwargs)
+        return result, [cmd for cmd, cmd_kwargs in calls]
+
+
+class TestScanCache(TestSyntheticRepoGitBase):
+
+    def test_cached_scan_does_not_walk_history(self):
+        cache_dir = tempfile.mkdtemp(dir=self.root_dir, prefix='cache.')
+        sub = self.init_scanner()
+        kwargs = {'fetch_first': False, 'return_report': True, 'cache_dir': cache_dir}
+        first, first_cmds = self.count_git_commands(sub.scan, 'main', self.repo_dir, **kwargs)
+        self.assertTrue(any(' log ' in cmd for cmd in first_cmds))
+        # a new scanner, as in the next nightly run
+        sub = self.init_scanner()
+        second, second_cmds = self.count_git_commands(sub.scan, 'main', self.repo_dir, **kwargs)
+        self.assertEqual(first, second)
+        self.assertFalse(any(' log ' in cmd for cmd in second_cmds))
+
+    def test_cache_eviction(self):
+        cache = scan_unmerged_branches.ScanCache(tempfile.mkdtemp(dir=self.root_dir, prefix='cache.'), max_entries=2)
+        self.addCleanup(cache.close)
+        cache.put_many('repo', 'target', {'a': [], 'b': [['hash', 'date', 'author', 'subject']]})
+        cache.put_many('repo', 'target', {'c': []})
+        self.assertEqual({'b': [['hash', 'date', 'author', 'subject']]}, cache.get_many('repo', 'target', ['b']))
+        cache.evict()
+        self.assertEqual(2, len(cache))
+        self.assertEqual({}, cache.get_many('repo', 'target', ['a']))
+        cache.max_age_days = -1
+        cache.evict()
+        self.assertEqual(0, len(cache))
+
+    def test_close_closes_caches_and_histories(self):
+        sub = self.init_scanner()
+        cache = sub.open_cache(tempfile.mkdtemp(dir=self.root_dir, prefix='cache.'))
+        history = sub.open_history(os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='history.'), 'h.sqlite'))
+        sub.close()
+        self.assertEqual(({}, {}), (sub.caches, sub.histories))
+        for db in (cache, history):
+            with self.assertRaises(sqlite3.ProgrammingError):
+                db.connection.execute('SELECT 1')
+        # the next scan opens them again
+        sub.scan('main', self.repo_dir, fetch_first=False, cache_dir=os.path.dirname(cache.path))
+        self.assertEqual(1, len(sub.caches))
+        sub.close()
+
+
+class TestStalenessPushdown(TestSyntheticRepoGitBase):
+
+    def test_pushdown_same_report(self):
+        for stale in (0, 7, 45):
+            expected = self.execute_code_scan('main', self.repo_dir, fetch_first=False, pushdown=False, stale=stale)
+            result = self.execute_code_scan('main', self.repo_dir, fetch_first=False, pushdown=True, stale=stale)
+            self.assertEqual(expected, result)
+
+    def test_pushdown_skips_fresh_branches(self):
+        sub = self.init_scanner()
+        fresh_tip = sub.get_remote_branch_tips(self.repo_dir)['origin/feature/fresh-work']
+        _, calls = self.record_git_commands(
+            sub.scan, 'main', self.repo_dir, fetch_first=False, return_report=True, stale=7)
+        log_inputs = [cmd_kwargs['input'] for cmd, cmd_kwargs in calls if ' log ' in cmd]
+        self.assertEqual(1, len(log_inputs))
+        self.assertNotIn(fresh_tip, log_inputs[0])
+
+
+class TestFetchStage(TestSyntheticRepoGitBase):
+
+    def test_each_repo_fetched_once(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development', 'main')]
+        sub = self.init_scanner()
+        results, cmds = self.count_git_commands(sub.scan_multiple, configs, return_report=True, fetch_jobs=2)
+        self.assertEqual(3, len(results))
+        fetches = [cmd for cmd in cmds if ' fetch ' in cmd]
+        self.assertEqual(1, len(fetches))
+        self.assertNotIn('--unshallow', fetches[0])
+        self.assertEqual([os.path.abspath(self.repo_dir)], list(sub.fetch_results))
+        self.assertEqual(0, sub.fetch_results[os.path.abspath(self.repo_dir)].res.rc)
+
+    def test_shallow_repo_unshallowed_once(self):
+        shallow_dir = os.path.join(self.root_dir, 'shallow')
+        origin_url = 'file://' + os.path.join(self.root_dir, 'origin.git')
+        git_run(['clone', '-q', '--depth', '1', '--no-single-branch', origin_url, shallow_dir], self.root_dir)
+        self.assertTrue(scan_unmerged_branches.ScanUnmergedBranches.is_shallow_repo(shallow_dir))
+        sub = self.init_scanner()
+        _, cmds = self.count_git_commands(sub.execute_git_fetch, shallow_dir)
+        self.assertIn('--unshallow', cmds[0])
+        self.assertFalse(sub.is_shallow_repo(shallow_dir))
+        with mock.patch.object(sub, 'is_shallow_repo') as is_shallow_repo:
+            _, cmds = self.count_git_commands(sub.execute_git_fetch, shallow_dir)
+        is_shallow_repo.assert_not_called()  # known from the first fetch
+        self.assertEqual(1, len(cmds))
+        self.assertNotIn('--unshallow', cmds[0])
+
+
+class TestSkipUnchanged(TestSyntheticRepoGitBase):
+
+    def test_unchanged_remote_skips_fetch_and_listing(self):
+        origin_dir = os.path.join(self.root_dir, 'skip-origin.git')
+        clone_dir = os.path.join(self.root_dir, 'skip-clone')
+        git_run(['clone', '-q', '--bare', os.path.join(self.root_dir, 'origin.git'), origin_dir], self.root_dir)
+        git_run(['clone', '-q', origin_dir, clone_dir], self.root_dir)
+        kwargs = {'return_report': True, 'skip_unchanged': True,
+                  'cache_dir': tempfile.mkdtemp(dir=self.root_dir, prefix='cache.')}
+        first, cmds = self.count_git_commands(self.init_scanner().scan, 'main', clone_dir, **kwargs)
+        self.assertTrue(any(' fetch ' in cmd for cmd in cmds))
+        # as in the next nightly run, with nothing pushed in between
+        second, cmds = self.count_git_commands(self.init_scanner().scan, 'main', clone_dir, **kwargs)
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(cmds))
+        self.assertIn(' ls-remote ', cmds[0])
+        # a push changes the fingerprint
+        work_dir = os.path.join(self.root_dir, 'skip-work')
+        git_run(['clone', '-q', origin_dir, work_dir], self.root_dir)
+        git_run(['checkout', '-q', '-b', 'feature/late-work'], work_dir)
+        git_commit(work_dir, 'late work', 10, 'dave@example.com')
+        git_run(['push', '-q', 'origin', 'feature/late-work'], work_dir)
+        third, cmds = self.count_git_commands(self.init_scanner().scan, 'main', clone_dir, **kwargs)
+        self.assertTrue(any(' fetch ' in cmd for cmd in cmds))
+        self.assertIn('origin/feature/late-work', third)
+
+    def test_scan_multiple_skips_unchanged_fetch(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        kwargs = {'return_report': True, 'skip_unchanged': True,
+                  'cache_dir': tempfile.mkdtemp(dir=self.root_dir, prefix='cache.')}
+        first = self.init_scanner().scan_multiple(copy.deepcopy(configs), **kwargs)
+        sub = self.init_scanner()
+        second, cmds = self.count_git_commands(sub.scan_multiple, copy.deepcopy(configs), **kwargs)
+        self.assertEqual([result['report'] for result in first], [result['report'] for result in second])
+        self.assertEqual(['git -P ls-remote --heads origin'], cmds)
+        self.assertIn('fetch skipped', sub.fetch_results[os.path.abspath(self.repo_dir)].res.stderr[0])
+
+
+class TestScanJournal(TestSyntheticRepoGitBase):
+
+    def test_resume_skips_journaled_scans(self):
+        origin_dir = os.path.join(self.root_dir, 'journal-origin.git')
+        clone_dir = os.path.join(self.root_dir, 'journal-clone')
+        git_run(['clone', '-q', '--bare', os.path.join(self.root_dir, 'origin.git'), origin_dir], self.root_dir)
+        git_run(['clone', '-q', origin_dir, clone_dir], self.root_dir)
+        journal = os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='journal.'), 'journal.ndjson')
+        configs = [{'branch': target, 'repo_dir': clone_dir, 'stale': 10} for target in ('main', 'development')]
+        kwargs = {'return_report': True, 'fetch_first': False}
+        expected = self.init_scanner().scan_multiple(copy.deepcopy(configs), **kwargs)
+
+        # a run which died after its first scan, and a line cut short by the crash
+        self.init_scanner().scan_multiple(copy.deepcopy(configs[:1]), journal=journal, **kwargs)
+        with open(journal, 'a') as f:
+            f.write('{"key": "cut sho')
+        _, development_cmds = self.count_git_commands(
+            self.init_scanner().scan_multiple, copy.deepcopy(configs[1:]), **kwargs)
+        resumed, cmds = self.count_git_commands(
+            self.init_scanner().scan_multiple, copy.deepcopy(configs), journal=journal, resume=True, **kwargs)
+        self.assertEqual(expected, resumed)
+        self.assertEqual(len(development_cmds) + 1, len(cmds))  # reading the repo tips, then only development
+        self.assertEqual(2, len(scan_unmerged_branches.ScanJournal.read(journal)))
+
+        # every scan is journaled now, until the refs of the repo change
+        _, cmds = self.count_git_commands(
+            self.init_scanner().scan_multiple, copy.deepcopy(configs), journal=journal, resume=True, **kwargs)
+        self.assertEqual(1, len(cmds))
+        git_run(['update-ref', 'refs/remotes/origin/feature/moved', 'refs/remotes/origin/feature/old-work'],
+                clone_dir)
+        _, cmds = self.count_git_commands(
+            self.init_scanner().scan_multiple, copy.deepcopy(configs), journal=journal, resume=True, **kwargs)
+        self.assertEqual(1 + 2 * len(development_cmds), len(cmds))
+        # the key is the scan, however its repo_dir is written, and any option which changes the report
+        key = scan_unmerged_branches.ScanJournal.scan_key
+        self.assertEqual(key('main', clone_dir, {'stale': '10', 'batch': False}),
+                         key('main', os.path.relpath(clone_dir), {'stale': 10, 'cache_dir': self.root_dir}))
+        self.assertNotEqual(key('main', clone_dir, {}), key('main', clone_dir, {'include_main': True}))
+        # without resume the journal starts over
+        self.init_scanner().scan_multiple(copy.deepcopy(configs[:1]), journal=journal, **kwargs)
+        self.assertEqual(1, len(scan_unmerged_branches.ScanJournal.read(journal)))
+
+
+class TestSummary(TestSyntheticRepoGitBase):
+
+    def test_summary_matches_commits(self):
+        for stale in (0, 45):
+            full = self.init_scanner().scan('main', self.repo_dir, return_report=True, fetch_first=False, stale=stale)
+            for batch in (True, False):
+                summary, cmds = self.count_git_commands(
+                    self.init_scanner().scan, 'main', self.repo_dir, return_report=True, fetch_first=False,
+                    stale=stale, summary=True, batch=batch)
+                self.assertEqual(list(full), list(summary))
+                for branch, commits_by_author in full.items():
+                    dates = [datetime.datetime.fromisoformat(commit['date'])
+                             for commits in commits_by_author.values() for commit in commits]
+                    self.assertEqual(len(dates), summary[branch]['commits'])
+                    self.assertEqual(max(dates), datetime.datetime.fromisoformat(summary[branch]['newest']))
+                    self.assertEqual(min(dates), datetime.datetime.fromisoformat(summary[branch]['oldest']))
+                    self.assertEqual({author: len(commits) for author, commits in commits_by_author.items()},
+                                     summary[branch]['authors'])
+                log_cmds = [cmd for cmd in cmds if ' log ' in cmd]
+                self.assertEqual(bool(summary), bool(log_cmds))  # no walk when every branch has a fresh tip
+                self.assertTrue(all('%H|%P|%at|%aE"' in cmd for cmd in log_cmds))
+
+    def test_scan_multiple_summary(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        by_repo = self.init_scanner().scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False,
+                                                    stale=0, summary=True, report_by_repo=True, multi_target=True)
+        self.assertEqual({'main', 'development'}, set(by_repo[self.repo_dir]))
+        self.assertEqual({'carol@example.com': 1}, by_repo[self.repo_dir]['main']['origin/development']['authors'])
+        with self.assertRaises(AssertionError):
+            self.init_scanner().scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False,
+                                              summary=True, report_by_email=True)
+
+    def test_resume_summary_from_full_journal(self):
+        journal = os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='journal.'), 'journal.ndjson')
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        kwargs = {'return_report': True, 'fetch_first': False, 'stale': 0}
+        self.init_scanner().scan_multiple(copy.deepcopy(configs), journal=journal, **kwargs)
+        expected = self.init_scanner().scan_multiple(copy.deepcopy(configs), summary=True, **kwargs)
+        resumed = self.init_scanner().scan_multiple(copy.deepcopy(configs), journal=journal, resume=True,
+                                                    summary=True, **kwargs)
+        self.assertEqual(expected, resumed)
+        for result in resumed:
+            for summary in result['report'].values():
+                self.assertEqual({'commits', 'newest', 'oldest', 'authors'}, set(summary))
+
+
+class TestWatch(TestSyntheticRepoGitBase):
+
+    def setUp(self):
+        self.clone_dir = tempfile.mkdtemp(dir=self.root_dir, prefix='watch.')
+        git_run(['clone', '-q', os.path.join(self.root_dir, 'origin.git'), self.clone_dir], self.root_dir)
+
+    def test_ref_watcher(self):
+        for use_inotify in (True, False):
+            with scan_unmerged_branches.RefWatcher([self.clone_dir], use_inotify, poll_interval=0.05) as watcher:
+                self.assertEqual(set(), watcher.wait(0))
+                # a branch in a new namespace, then packing refs
+                ref = 'refs/remotes/origin/watched/{}'.format(use_inotify)
+                git_run(['update-ref', ref, 'origin/main'], self.clone_dir)
+                self.assertEqual({self.clone_dir}, watcher.wait(5))
+                git_run(['pack-refs', '--all'], self.clone_dir)
+                self.assertEqual({self.clone_dir}, watcher.wait(5))
+                self.assertEqual(set(), watcher.wait(0.1))
+
+    def test_ref_watcher_queue_overflow(self):
+        with scan_unmerged_branches.RefWatcher([self.clone_dir]) as watcher:
+            if watcher.fd is None:
+                self.skipTest('no inotify')
+            # the event inotify reports when events were dropped
+            read_fd, write_fd = os.pipe()
+            inotify_fd, watcher.fd = watcher.fd, read_fd
+            try:
+                os.write(write_fd, watcher.EVENT_HEADER.pack(-1, watcher.IN_Q_OVERFLOW, 0, 0))
+                self.assertEqual({self.clone_dir}, watcher.read_events(1))
+            finally:
+                watcher.fd = inotify_fd
+                os.close(read_fd)
+                os.close(write_fd)
+
+    def test_watch_keeps_last_report_on_failure(self):
+        output = os.path.join(self.clone_dir, 'report.json')
+        configs = [{'branch': 'main', 'repo_dir': self.clone_dir}]
+        sub = self.init_scanner()
+        run_scans = sub.run_scans
+        results = []
+
+        def fail_after_first(*args):
+            if results:
+                raise OSError('repo busy')
+            return run_scans(*args)
+
+        with mock.patch.object(sub, 'run_scans', side_effect=fail_after_first):
+            self.assertEqual(0, sub.watch(configs, output=output, cycles=3, fetch_interval=0,
+                                          on_results=results.append))
+        self.assertEqual(1, len(results))
+        with open(output) as f:
+            self.assertEqual(json.loads(json.dumps(results[0][0]['report'],
+                                                   default=scan_unmerged_branches.CommitRecord.json_default)),
+                             json.load(f)[0]['report'])
+
+    def test_save_json_to_file_atomic(self):
+        output = os.path.join(self.clone_dir, 'reports', 'report.json')
+        sub = self.init_scanner()
+        sub.save_json_to_file({'report': 1}, output)
+        with mock.patch.object(json, 'dump', side_effect=ValueError('not json')):
+            self.assertRaises(ValueError, sub.save_json_to_file, {'report': 2}, output)
+        self.assertEqual(['report.json'], os.listdir(os.path.dirname(output)))
+        with open(output) as f:
+            self.assertEqual({'report': 1}, json.load(f))
+
+    def test_watch_rescans_moved_branches(self):
+        output = os.path.join(self.clone_dir, 'report.json')
+        configs = [{'branch': target, 'repo_dir': self.clone_dir} for target in ('main', 'development')]
+        expected = self.init_scanner().scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False)
+        sub = self.init_scanner()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.record_git_commands(
+            sub.watch, copy.deepcopy(configs), output=output, cycles=1, fetch_interval=2)))
+        thread.start()
+        report = self.wait_for_report(output, lambda report: True)
+        self.assertEqual([result['report'] for result in expected], [result['report'] for result in report])
+        late_work = git_run(['commit-tree', 'origin/main^{tree}', '-p', 'origin/main', '-m', 'late work'],
+                            self.clone_dir, 10, 'dave@example.com')
+        git_run(['update-ref', 'refs/remotes/origin/feature/late-work', late_work], self.clone_dir)
+        report = self.wait_for_report(output, lambda report: 'origin/feature/late-work' in report[0]['report'])
+        self.assertEqual({'dave@example.com'}, set(report[0]['report']['origin/feature/late-work']))
+        thread.join()
+        _, calls = results[0]
+        # only the branch which moved was walked again
+        log_inputs = [cmd_kwargs['input'].split() for cmd, cmd_kwargs in calls if ' log ' in cmd]
+        self.assertEqual([late_work], [tip for tip in log_inputs[-1] if not tip.startswith('^')])
+
+    def wait_for_report(self, output, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(output):
+                with open(output) as f:
+                    report = json.load(f)
+                if condition(report):
+                    return report
+            time.sleep(0.05)
+        self.fail('no report in {}s'.format(timeout))
+
+
+class TestScanFacts(TestSyntheticRepoBase):
+
+    def test_report_by_age(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        sub = self.init_scanner()
+        now = int(time.time())
+        results = sub.scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False, stale=0, now=now)
+        by_age = sub.scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False, stale=0, now=now,
+                                   report_by_age=True)
+        self.assertEqual(['0-29', '30-59', '60-89', '90-179', '180-364', '365+'], list(by_age))
+        rows = [row for bucket in by_age.values() for row in bucket]
+        self.assertEqual(len(scan_unmerged_branches.StaleBranchIndex(results)), len(rows))
+        for name, bucket in by_age.items():
+            self.assertEqual(sorted((row['days'] for row in bucket), reverse=True), [row['days'] for row in bucket])
+            low, high = name.rstrip('+').split('-') if '-' in name else (name.rstrip('+'), None)
+            for row in bucket:
+                self.assertGreaterEqual(row['days'], int(low))
+                if high is not None:
+                    self.assertLessEqual(row['days'], int(high))
+        self.assertIn('origin/feature/fresh-work', [row['branch'] for row in by_age['0-29']])
+        # materialized results (commit dicts) give the same groupings
+        facts = scan_unmerged_branches.ScanFacts(results)
+        self.assertEqual(sub.aggregate_scan_results_by_email(results), facts.by_email())
+        self.assertEqual(by_age, facts.by_age(now))
+
+    def test_facts_only_indexed_when_needed(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        sub = self.init_scanner()
+        with mock.patch.object(scan_unmerged_branches, 'ScanFacts', wraps=scan_unmerged_branches.ScanFacts) as facts:
+            facts.group_by_repo = scan_unmerged_branches.ScanFacts.group_by_repo
+            for report_kwargs in ({}, {'report_by_repo': True}):
+                sub.scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False, **report_kwargs)
+            self.assertEqual(0, facts.call_count)
+            sub.scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False, report_by_email=True)
+            self.assertEqual(1, facts.call_count)
+
+
+class TestQueryService(TestSyntheticRepoBase):
+
+    def results(self):
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        return self.init_scanner().scan_multiple(configs, return_report=True, fetch_first=False, stale=0)
+
+    def test_index_query(self):
+        results = self.results()
+        index = scan_unmerged_branches.StaleBranchIndex(results)
+        now = int(time.time())
+        expected_rows = []
+        for result in results:
+            for branch, commits_by_author in result['report'].items():
+                for author, commits in commits_by_author.items():
+                    newest = max(int(datetime.datetime.fromisoformat(c['date']).timestamp()) for c in commits)
+                    expected_rows.append((result['repo_dir'], result['branch'], branch, author, newest))
+        for author in ('alice@example.com', 'carol@example.com', 'nobody@example.com'):
+            for older_than in (None, 0, 30, 45):
+                rows = index.query(older_than, now, author=author, repo='repo')
+                expected = sorted(
+                    (row for row in expected_rows if row[3] == author
+                     and (older_than is None or (now - row[4]) // 86400 >= older_than)), key=lambda row: row[4])
+                self.assertEqual(expected, [(row['repo_dir'], row['target'], row['branch'], row['author'],
+                                             row['newest_timestamp']) for row in rows])
+        self.assertEqual(len(expected_rows), len(index.query()))
+        self.assertEqual([row for row in index.query(now=now) if row['days'] >= 45], index.query(45, now))
+        self.assertEqual([], index.query(target='no-such-target'))
+
+    def test_query_server(self):
+        server = scan_unmerged_branches.ScanQueryServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        def get(path):
+            with urllib.request.urlopen(url + path) as response:
+                return json.load(response)
+
+        self.assertEqual(0, get('/health')['rows'])
+        server.update(self.results())
+        branches = get('/branches?author=alice%40example.com&older_than=30')['branches']
+        self.assertEqual(server.index.query(30, author='alice@example.com'), branches)
+        self.assertEqual({'origin/feature/old-work', 'origin/feature/shared', 'origin/feature/fresh-work'},
+                         set(row['branch'] for row in get('/branches?author=alice%40example.com')['branches']))
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            get('/branches?colour=red')
+        self.assertEqual(400, raised.exception.code)
+        server.update([])
+        self.assertEqual([], get('/branches')['branches'])
+
+
+class TestScanHistory(TestSyntheticRepoBase):
+
+    def test_history_delta(self):
+        history_db = os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='history.'), 'history.sqlite')
+        configs = [{'branch': target, 'repo_dir': self.repo_dir} for target in ('main', 'development')]
+        sub = self.init_scanner()
+
+        def run(stale):
+            results = sub.scan_multiple(copy.deepcopy(configs), return_report=True, fetch_first=False, stale=stale,
+                                        history_db=history_db)
+            return [(result['branch'], branch) for result in results for branch in result['report']]
+
+        def changes(key):
+            return [(change['target'], change['branch']) for change in scan_unmerged_branches.history_delta(
+                history_db)[key]]
+
+        all_stale = run(0)
+        self.assertEqual(sorted(all_stale), sorted(changes('new')))
+        self.assertEqual([], changes('gone'))
+        old_stale = run(45)
+        self.assertEqual([], changes('new'))
+        self.assertEqual(sorted(set(all_stale) - set(old_stale)), sorted(changes('gone')))
+        self.assertIn(('main', 'origin/feature/fresh-work'), changes('gone'))
+        run(0)
+        self.assertEqual(sorted(set(all_stale) - set(old_stale)), sorted(changes('new')))
+        self.assertEqual(['alice@example.com', 'bob@example.com'], next(
+            change['authors'] for change in scan_unmerged_branches.history_delta(history_db)['new']
+            if change['branch'] == 'origin/feature/fresh-work'))
+
+    def test_pipeline_changes(self):
+        history_db = os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='history.'), 'history.sqlite')
+        output = os.path.join(tempfile.mkdtemp(dir=self.root_dir, prefix='pipeline.'), 'pipeline.json')
+        for stale in (10, 0):
+            self.init_scanner().scan_multiple_pipeline(
+                [{'TARGET_BRANCH': 'main', 'REPO_NAME': 'repo'}], output, workspace=self.root_dir,
+                fetch_first=False, stale=stale, history_db=history_db)
+        with open(output) as f:
+            pipeline_report = json.load(f)
+        changes = pipeline_report['changes']
+        self.assertEqual(['origin/feature/fresh-work'], [change['branch'] for change in changes['new']])
+        self.assertEqual('new stale branches:\n - <repo>:main origin/feature/fresh-work (alice@example.com, '
+                         'bob@example.com)', pipeline_report['changes_message'])
+
+
+class TestPipelineShards(TestSyntheticRepoBase):
+
+    def test_merged_shards_match_single_node(self):
+        root_dir = tempfile.mkdtemp(dir=self.root_dir, prefix='shards.')
+        workspace = os.path.join(root_dir, 'workspace')
+        os.makedirs(workspace)
+        repo_names = ['repo-{}'.format(i) for i in range(6)]
+        for repo_name in repo_names:
+            os.symlink(self.repo_dir, os.path.join(workspace, repo_name))
+        configs = [{'TARGET_BRANCH': target, 'REPO_NAME': repo_name}
+                   for repo_name in repo_names for target in ('main', 'development')]
+        kwargs = {'workspace': workspace, 'fetch_first': False, 'stale': 10, 'now': int(time.time())}
+
+        single_output = os.path.join(root_dir, 'single.json')
+        self.init_scanner().scan_multiple_pipeline(copy.deepcopy(configs), single_output, **kwargs)
+        shard_outputs = []
+        for index in range(3):
+            shard_outputs.append(os.path.join(root_dir, 'shard-{}.json'.format(index)))
+            self.init_scanner().scan_multiple_pipeline(copy.deepcopy(configs), shard_outputs[-1], shard=(index, 3),
+                                                       **kwargs)
+        scanned = []
+        for shard_output in shard_outputs:
+            with open(shard_output) as f:
+                scanned.append(set(os.path.basename(result['repo_dir']) for result in json.load(f)['results']))
+        self.assertEqual(set(repo_names), set.union(*scanned))
+        self.assertEqual(len(repo_names), sum(len(names) for names in scanned))  # a repo is in one shard only
+
+        merged_output = os.path.join(root_dir, 'merged.json')
+        self.assertEqual(0, scan_unmerged_branches.main(
+            ['--merge', '--pipeline-output', merged_output] + list(reversed(shard_outputs))))
+        with open(single_output) as f, open(merged_output) as g:
+            self.assertEqual(json.load(f), json.load(g))
+        with self.assertRaises(AssertionError):
+            scan_unmerged_branches.merge_pipeline_shards(shard_outputs[:2], merged_output)
+
+    def test_shard_of(self):
+        self.assertEqual(scan_unmerged_branches.ScanUnmergedBranches.shard_of('repo', 4),
+                         int(hashlib.sha1(b'repo').hexdigest(), 16) % 4)
+        self.assertEqual((1, 4), scan_unmerged_branches.ScanUnmergedBranches.parse_shard('1/4'))
+        for value in ('4/4', '-1/4', '1', 'a/b'):
+            with self.assertRaises(ValueError):
+                scan_unmerged_branches.ScanUnmergedBranches.parse_shard(value)
+
+    def test_pipeline_write_errors(self):
+        sub = self.init_scanner()
+        output = tempfile.mkdtemp(dir=self.root_dir, prefix='pipeline.')  # a directory can not be replaced
+        self.assertEqual(1, sub.write_pipeline_shard([], output, (0, 1), raise_exceptions=False))
+        self.assertEqual(1, sub.write_pipeline_report([], output, raise_exceptions=False))
+        with self.assertRaises(OSError):
+            sub.write_pipeline_shard([], output, (0, 1))
+
+
+class TestMultiTarget(TestSyntheticRepoGitBase):
+
+    def configs(self):
+        return [
+            {'branch': 'main', 'repo_dir': self.repo_dir, 'fetch_first': False},
+            {'branch': 'development', 'repo_dir': self.repo_dir, 'fetch_first': False},
+            {'branch': 'main', 'repo_dir': self.repo_dir, 'fetch_first': False, 'stale': 45},
+            {'branch': 'development', 'repo_dir': self.repo_dir, 'fetch_first': False, 'include_main': True},
+            {'branch': 'NotExistBranch', 'repo_dir': self.repo_dir, 'fetch_first': False},
+        ]
+
+    def test_multi_target_same_results(self):
+        expected = self.execute_code_scan_multiple(self.configs())
+        result, cmds = self.count_git_commands(self.execute_code_scan_multiple, self.configs(), multi_target=True)
+        self.assertEqual(expected, result)
+        self.assertEqual(1, len([cmd for cmd in cmds if ' log ' in cmd]))
+
+    def test_multi_target_cache(self):
+        cache_dir = os.path.join(self.root_dir, 'multi_target_cache')
+        configs = [dict(config, cache_dir=cache_dir) for config in self.configs()]
+        expected = [result['report'] for result in self.execute_code_scan_multiple(self.configs())]
+        for _ in range(2):
+            result, calls = self.record_git_commands(self.execute_code_scan_multiple, copy.deepcopy(configs),
+                                                     multi_target=True)
+            self.assertEqual(expected, [r['report'] for r in result])
+        # the second walk leaves out the branches cached for both targets
+        walked = [cmd_kwargs['input'].split() for cmd, cmd_kwargs in calls if ' log ' in cmd][0]
+        self.assertNotIn(git_run(['rev-parse', 'origin/feature/old-work'], self.repo_dir), walked)
+        self.assertIn(git_run(['rev-parse', 'origin/development'], self.repo_dir), walked)
+
+    def test_multi_target_no_batch(self):
+        configs = [dict(config, batch=False) for config in self.configs()]
+        with self.assertRaises(AssertionError):
+            self.execute_code_scan_multiple(configs, multi_target=True)
+
+    def test_multi_target_unmerged_commits(self):
+        sub = self.init_scanner()
+        branches = list(sub.get_remote_branch_tips(self.repo_dir))
+        targets = ['main', 'development']
+        result = sub.get_dict_of_unmerged_commits_by_target(branches, targets, self.repo_dir)
+        for target in targets:
+            unmerged_branches = sub.get_list_of_unmerged_branches(target, self.repo_dir, include_main=True)
+            self.assertEqual(unmerged_branches, list(result[target]))
+            expected = sub.fetch_unmerged_commits_by_branch(unmerged_branches, target, self.repo_dir, batch=False)
+            self.assertEqual(expected, result[target])
+
+
+class TestGitBackends(TestSyntheticRepoGitBase):
+
+    def test_cat_file_same_commits(self):
+        sub = self.init_scanner()
+        self.addCleanup(sub.close)
+        cat_file = sub.open_backend('cat-file')
+        for target in ('main', 'development'):
+            branches = sub.get_list_of_unmerged_branches(target, self.repo_dir, include_main=True)
+            for batch in (True, False):
+                expected = sub.fetch_unmerged_commits_by_branch(branches, target, self.repo_dir, batch=batch)
+                result, cmds = self.count_git_commands(
+                    sub.fetch_unmerged_commits_by_branch, branches, target, self.repo_dir, batch=batch,
+                    backend=cat_file)
+                self.assertEqual(expected, result)
+                self.assertFalse(any(' log ' in cmd for cmd in cmds))
+        self.assertEqual([], sub.get_list_of_unmerged_commits('NotExistBranch', 'main', self.repo_dir,
+                                                              backend=cat_file))
+
+    def test_cat_file_multi_target(self):
+        sub = self.init_scanner()
+        self.addCleanup(sub.close)
+        branches = list(sub.get_remote_branch_tips(self.repo_dir))
+        targets = ['main', 'development']
+        expected = sub.get_dict_of_unmerged_commits_by_target(branches, targets, self.repo_dir)
+        result = sub.get_dict_of_unmerged_commits_by_target(branches, targets, self.repo_dir,
+                                                            backend=sub.open_backend('cat-file'))
+        self.assertEqual(expected, result)
+
+    def test_cat_file_reads_off_the_event_loop(self):
+        sub = self.init_scanner()
+        self.addCleanup(sub.close)
+        expected = sub.scan('main', self.repo_dir, fetch_first=False, return_report=True)
+        threads = set()
+        read_object = scan_unmerged_branches.CatFileReader.read_object
+
+        def record_thread(reader, name):
+            threads.add(threading.current_thread())
+            return read_object(reader, name)
+
+        with mock.patch.object(scan_unmerged_branches.CatFileReader, 'read_object', autospec=True,
+                               side_effect=record_thread):
+            result = asyncio.run(scan_unmerged_branches.scan_async('main', self.repo_dir, fetch_first=False,
+                                                                   return_report=True, backend='cat-file'))
+        self.assertEqual(expected, result)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_odb_same_as_git(self):
+        packed_dir = os.path.join(self.root_dir, 'packed')
+        git_run(['clone', '-q', '--no-local', self.repo_dir, packed_dir], self.root_dir)
+        git_run(['fetch', '-q', os.path.join(self.root_dir, 'origin.git'), 'refs/heads/*:refs/remotes/origin/*'],
+                packed_dir)
+        for repack_config in ('repack.useDeltaBaseOffset=true', 'repack.useDeltaBaseOffset=false'):
+            git_run(['-c', repack_config, 'repack', '-q', '-a', '-d', '-f', '--depth=10'], packed_dir)
+            for repo_dir in (self.repo_dir, packed_dir):
+                sub = self.init_scanner()
+                self.addCleanup(sub.close)
+                odb = sub.open_backend('odb')
+                self.assertEqual(sub.get_remote_branch_refs(repo_dir),
+                                 self.assert_no_git(sub.get_remote_branch_refs, repo_dir, backend=odb))
+                for target in ('main', 'development'):
+                    expected = sub.get_list_of_unmerged_branches(target, repo_dir)
+                    self.assertEqual(expected, self.assert_no_git(
+                        sub.get_list_of_unmerged_branches, target, repo_dir, backend=odb))
+                    self.assertEqual(
+                        sub.fetch_unmerged_commits_by_branch(expected, target, repo_dir, batch=False),
+                        self.assert_no_git(sub.fetch_unmerged_commits_by_branch, expected, target, repo_dir,
+                                           batch=False, backend=odb))
+                self.assertEqual(
+                    sub.scan('main', repo_dir, fetch_first=False, return_report=True),
+                    self.assert_no_git(sub.scan, 'main', repo_dir, fetch_first=False, return_report=True,
+                                       backend='odb'))
+
+    def test_odb_falls_back_to_git(self):
+        shallow_dir = os.path.join(self.root_dir, 'shallow')
+        origin_url = 'file://' + os.path.join(self.root_dir, 'origin.git')
+        git_run(['clone', '-q', '--depth', '2', '--no-single-branch', origin_url, shallow_dir], self.root_dir)
+        sub = self.init_scanner()
+        self.addCleanup(sub.close)
+        kwargs = {'fetch_first': False, 'return_report': True, 'stale': 0}
+        expected = sub.scan('main', shallow_dir, **kwargs)
+        result, cmds = self.count_git_commands(sub.scan, 'main', shallow_dir, backend='odb', **kwargs)
+        self.assertEqual(expected, result)
+        self.assertTrue(any(' log ' in cmd for cmd in cmds))
+        self.assertIsNone(sub.open_backend('odb').open_reader(shallow_dir))
+
+    def test_odb_reachability_is_exact(self):
+        skewed_dir = os.path.join(self.root_dir, 'skewed')
+        git_run(['clone', '-q', '--no-local', os.path.join(self.root_dir, 'origin.git'), skewed_dir], self.root_dir)
+        # a commit dated years ahead, merged long before the tip of the target: the limited walk of git log (and of
+        # git branch --no-merged) stops looking before it reaches the merge, so it takes the commit for unmerged
+        git_run(['checkout', '-q', '--orphan', 'skewed'], skewed_dir)
+        skewed = git_commit(skewed_dir, 'dated in the future', -3650)
+        git_run(['checkout', '-q', '-b', 'skew-main', 'origin/main'], skewed_dir)
+        git_run(['merge', '-q', '--allow-unrelated-histories', '-m', 'merge skewed', 'skewed'], skewed_dir, 12)
+        for days_ago in range(11, 3, -1):
+            git_commit(skewed_dir, 'after the merge', days_ago)
+        # the only other branch, so the walk has nothing else to look for
+        for refname in git_run(['for-each-ref', '--format=%(refname)', 'refs/remotes/'], skewed_dir).split():
+            git_run(['update-ref', '-d', refname], skewed_dir)
+        git_run(['update-ref', 'refs/remotes/origin/skew-main', 'skew-main'], skewed_dir)
+        git_run(['update-ref', 'refs/remotes/origin/skewed', skewed], skewed_dir)
+        git_run(['merge-base', '--is-ancestor', skewed, 'skew-main'], skewed_dir)
+        self.assertEqual(skewed, git_run(['log', '--format=%H', skewed, '^skew-main'], skewed_dir))
+        for write_graph in (False, True):
+            if write_graph:
+                git_run(['commit-graph', 'write', '--reachable'], skewed_dir)
+            sub = self.init_scanner()
+            self.addCleanup(sub.close)
+            odb = sub.open_backend('odb')
+            self.assertEqual([], self.assert_no_git(sub.get_list_of_unmerged_branches, 'skew-main', skewed_dir,
+                                                    backend=odb))
+            self.assertEqual(write_graph, odb.open_reader(skewed_dir).graph is not None)
+
+    def test_odb_unsupported_config(self):
+        config_dir = os.path.join(self.root_dir, 'config')
+        git_run(['clone', '-q', '--no-local', os.path.join(self.root_dir, 'origin.git'), config_dir], self.root_dir)
+        odb = scan_unmerged_branches.OdbGitBackend
+        odb.new_reader(config_dir).close()
+        with mock.patch.dict(os.environ, {'GIT_CONFIG_COUNT': '0'}):
+            self.assertRaises(scan_unmerged_branches.UnsupportedRepository, odb.new_reader, config_dir)
+        for key in ('include.path', 'includeIf.gitdir:/nowhere/.path'):
+            git_run(['config', key, os.devnull], config_dir)
+            self.assertRaises(scan_unmerged_branches.UnsupportedRepository, odb.new_reader, config_dir)
+            git_run(['config', '--unset', key], config_dir)
+
+    def test_odb_refreshes_packs(self):
+        repack_dir = os.path.join(self.root_dir, 'repack')
+        git_run(['clone', '-q', '--no-local', os.path.join(self.root_dir, 'origin.git'), repack_dir], self.root_dir)
+        git_run(['repack', '-q', '-a', '-d'], repack_dir)
+        reader = scan_unmerged_branches.OdbGitBackend.new_reader(repack_dir)
+        self.addCleanup(reader.close)
+        old_packs = list(reader.packs.values())
+        new_commit = git_commit(repack_dir, 'packed after the reader opened', 0)
+        git_run(['repack', '-q', '-a', '-d'], repack_dir)
+        self.assertEqual(new_commit, reader.read_commit(new_commit).hash)
+        pack_dir = os.path.join(repack_dir, '.git', 'objects', 'pack')
+        self.assertEqual(sorted(os.path.join(pack_dir, name) for name in os.listdir(pack_dir) if name.endswith('.idx')),
+                         sorted(reader.packs))
+        self.assertTrue(all(pack.idx.closed for pack in old_packs))
+
+    def test_commit_graph(self):
+        graph_dir = os.path.join(self.root_dir, 'graph')
+        git_run(['clone', '-q', '--no-local', os.path.join(self.root_dir, 'origin.git'), graph_dir], self.root_dir)
+        sub = self.init_scanner()
+        self.addCleanup(sub.close)
+        _, cmds = self.count_git_commands(sub.execute_git_fetch, graph_dir, write_commit_graph=True)
+        self.assertIn('commit-graph write', cmds[-1])
+        self.assertTrue(os.path.exists(os.path.join(graph_dir, '.git', 'objects', 'info', 'commit-graphs')))
+        for backend in ('cat-file', 'odb'):
+            for target in ('main', 'development'):
+                branches = sub.get_list_of_unmerged_branches(target, graph_dir, include_main=True)
+                self.assertEqual(
+                    sub.fetch_unmerged_commits_by_branch(branches, target, graph_dir),
+                    sub.fetch_unmerged_commits_by_branch(branches, target, graph_dir,
+                                                         backend=sub.open_backend(backend)))
+            reader = sub.open_backend(backend).open_reader(graph_dir)
+            self.assertIsNotNone(reader.graph)
+            # generation numbers prove the history below the targets merged, the walks did not go down there
+            root_commit = git_run(['rev-list', '--max-parents=0', 'origin/main'], graph_dir)
+            self.assertNotIn(root_commit, reader.commits)
+
+    def assert_no_git(self, func, *args, **kwargs):
+        result, cmds = self.count_git_commands(func, *args, **kwargs)
+        self.assertEqual([], cmds)
+        return result
+
+    def configs(self):
+        return [{'branch': target, 'repo_dir': self.repo_dir, 'fetch_first': False}
+                for target in ('main', 'development')]
+
+    def test_scan_multiple_cat_file(self):
+        expected = [scan['report'] for scan in self.execute_code_scan_multiple(self.configs())]
+        for multi_target in (False, True):
+            result = self.execute_code_scan_multiple(self.configs(), backend='cat-file', multi_target=multi_target)
+            self.assertEqual(expected, [scan['report'] for scan in result])
+
+
+class TestMirrorCache(TestSyntheticRepoGitBase):
+
+    def setUp(self):
+        self.mirror_dir = tempfile.mkdtemp(dir=self.root_dir, prefix='mirrors.')
+        self.url = 'file://' + os.path.join(self.root_dir, 'origin.git')
+
+    def test_scan_url(self):
+        sub = self.init_scanner()
+        expected = sub.scan('main', self.repo_dir, fetch_first=False, return_report=True)
+        kwargs = {'mirror_dir': self.mirror_dir, 'fetch_first': False, 'return_report': True}
+        result, cmds = self.count_git_commands(sub.scan, 'main', self.url, **kwargs)
+        self.assertEqual(expected, result)
+        # a new mirror is fetched even without fetch_first
+        self.assertTrue(any(cmd.startswith('git init') for cmd in cmds))
+        self.assertTrue(any(' fetch ' in cmd for cmd in cmds))
+        result, cmds = self.count_git_commands(sub.scan, 'main', self.url, **kwargs)
+        self.assertEqual(expected, result)
+        self.assertFalse(any(cmd.startswith('git init') or ' fetch ' in cmd for cmd in cmds))
+
+    def test_scan_multiple_url(self):
+        targets = ('main', 'development')
+        configs = [{'branch': target, 'repo_dir': self.url, 'mirror_dir': self.mirror_dir} for target in targets]
+        sub = self.init_scanner()
+        results, cmds = self.count_git_commands(sub.scan_multiple, configs, return_report=True, fetch_first=False)
+        self.assertEqual(1, len([cmd for cmd in cmds if ' fetch ' in cmd]))
+        for target, result in zip(targets, results):
+            self.assertEqual(self.url, result['repo_dir'])
+            self.assertEqual(sub.scan(target, self.repo_dir, fetch_first=False, return_report=True), result['report'])
+        self.assertEqual({}, sub.mirror_dirs)
+
+    def test_mirror_is_a_partial_clone(self):
+        # an origin with a file, which lets clients filter out blobs
+        work_dir = os.path.join(self.root_dir, 'with-file')
+        filtered_dir = os.path.join(self.root_dir, 'filtered.git')
+        git_run(['clone', '-q', '--bare', '--no-local', os.path.join(self.root_dir, 'origin.git'), filtered_dir],
+                self.root_dir)
+        git_run(['config', 'uploadpack.allowFilter', 'true'], filtered_dir)
+        git_run(['clone', '-q', filtered_dir, work_dir], self.root_dir)
+        git_run(['checkout', '-q', '-b', 'feature/with-file', 'origin/main'], work_dir)
+        with open(os.path.join(work_dir, 'notes.txt'), 'w') as f:
+            f.write('not needed by scans\n')
+        git_run(['add', 'notes.txt'], work_dir)
+        git_run(['commit', '-q', '-m', 'add notes'], work_dir, 30)
+        blob = git_run(['rev-parse', 'HEAD:notes.txt'], work_dir)
+        git_run(['push', '-q', 'origin', 'feature/with-file'], work_dir)
+        url = 'file://' + filtered_dir
+        sub = self.init_scanner()
+        report = sub.scan('main', url, mirror_dir=self.mirror_dir, fetch_first=False, return_report=True)
+        self.assertIn('origin/feature/with-file', report)
+        # the single scan is saved under its url, not under the dir of its mirror
+        self.assertEqual(url, sub.scans[-1]['repo_dir'])
+        mirror_dir = scan_unmerged_branches.MirrorCache(self.mirror_dir).mirror_dir(url)
+        self.assertEqual('origin', git_run(['config', '--get', 'extensions.partialclone'], mirror_dir))
+        missing = git_run(['rev-list', '--objects', '--all', '--missing=print'], mirror_dir).split()
+        self.assertIn('?' + blob, missing)
+
+    def test_scan_url_async(self):
+        sub = self.init_scanner()
+        expected = sub.scan('main', self.repo_dir, fetch_first=False, return_report=True)
+        mirrors = scan_unmerged_branches.MirrorCache(self.mirror_dir)
+        lock = mirrors.lock
+        threads = set()
+
+        def record_thread(url):
+            threads.add(threading.current_thread())
+            return lock(url)
+
+        with mock.patch.object(scan_unmerged_branches.MirrorCache, 'lock', side_effect=record_thread):
+            result = asyncio.run(sub.scan_async('main', self.url, mirror_dir=self.mirror_dir, return_report=True))
+        self.assertEqual(expected, result)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_eviction_skips_locked_mirrors(self):
+        self.init_scanner().scan('main', self.url, mirror_dir=self.mirror_dir, return_report=True)
+        mirrors = scan_unmerged_branches.MirrorCache(self.mirror_dir, max_mb=0)
+        with mirrors.locked(self.url) as mirror_dir:
+            mirrors.evict()
+            self.assertTrue(mirrors.is_fetched(mirror_dir))
+        mirrors.evict()
+        self.assertFalse(os.path.exists(mirror_dir))
+
+
+class TestScanMetrics(TestSyntheticRepoGitBase):
+
+    def configs(self, fetch_first=False):
+        return [{'branch': target, 'repo_dir': self.repo_dir, 'fetch_first': fetch_first}
+                for target in ('main', 'development')]
+
+    def test_scan_multiple_metrics(self):
+        metrics_file = os.path.join(self.root_dir, 'metrics', 'scan.prom')
+        result, cmds = self.count_git_commands(
+            self.execute_code_scan_multiple, self.configs(fetch_first=True), metrics=True, metrics_file=metrics_file)
+        self.assertEqual([r['report'] for r in self.execute_code_scan_multiple(self.configs())],
+                         [r['report'] for r in result])
+        phases = result[0]['metrics']['phases']
+        self.assertEqual(['list_branches', 'branch_refs', 'collect_commits', 'staleness', 'report'], list(phases))
+        self.assertEqual(1, phases['collect_commits']['git_processes'])
+        self.assertGreater(phases['collect_commits']['git_output_bytes'], 0)
+        # the fetch stage is only in the per repo totals
+        scanned = sum(r['metrics']['total']['git_processes'] for r in result)
+        self.assertEqual(len(cmds) - 1, scanned)
+        with open(metrics_file) as f:
+            lines = f.read().splitlines()
+        self.assertIn('stale_branch_scanner_phase_git_processes{{repo="{}",phase="fetch"}} 1'.format(
+            os.path.abspath(self.repo_dir)), lines)
+        self.assertIn('# TYPE stale_branch_scanner_phase_duration_seconds gauge', lines)
+
+    def test_scan_metrics_without_save_scan(self):
+        sub = self.init_scanner()
+        report = sub.scan('main', self.repo_dir, fetch_first=False, return_report=True, save_scan=False, metrics=True)
+        self.assertEqual(self.execute_code_scan('main', self.repo_dir, fetch_first=False), report)
+        self.assertEqual([], sub.scans)
+        self.assertEqual(1, sub.last_scan_metrics['phases']['collect_commits']['git_processes'])
+
+    def test_git_output_bytes(self):
+        metrics = scan_unmerged_branches.ScanMetrics()
+
+        def steps():
+            res = yield scan_unmerged_branches.GitCmd('git log', {})
+            return res.stdout
+
+        measured = metrics.measure_steps('collect_commits', steps())
+        next(measured)
+        with self.assertRaises(StopIteration):
+            measured.send(scan_unmerged_branches.ExecRes(0, ['été'], []))
+        self.assertEqual(6, metrics.phases['collect_commits']['git_output_bytes'])  # 5 bytes and a newline
+
+    def test_pipeline_metrics(self):
+        input_ = os.path.join(self.root_dir, 'pipeline_metrics_input.json')
+        output = os.path.join(self.root_dir, 'pipeline_metrics_output.json')
+        with open(input_, 'w') as f:
+            json.dump([{'TARGET_BRANCH': target, 'REPO_NAME': 'repo', 'fetch_first': False}
+                       for target in ('main', 'development')], f)
+        self.execute_code_scan_multiple_pipeline(input_, output, workspace=self.root_dir, metrics=True)
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(['repo'], list(report['metrics']))
+        self.assertEqual(6, report['metrics']['repo']['total']['git_processes'])
+
+    def test_escape_label_value(self):
+        self.assertEqual('a\\"b\\\\c\\n', scan_unmerged_branches.ScanMetrics.escape_label_value('a"b\\c\n'))
+
+
+class TestTracing(TestSyntheticRepoBase):
+
+    def read_trace(self, trace):
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        self.assertIsNone(scan_unmerged_branches.ScanTracer.active)
+        return [event for event in events if event['ph'] == 'X']
+
+    def test_scan_trace(self):
+        trace = os.path.join(self.root_dir, 'traces', 'scan.json')
+        self.execute_code_scan('main', self.repo_dir, fetch_first=False, trace=trace)
+        events = self.read_trace(trace)
+        self.assertEqual(['git branch', 'list_branches', 'git for-each-ref', 'branch_refs', 'git log',
+                          'collect_commits', 'staleness', 'report', 'scan'], [event['name'] for event in events])
+        git_log = events[4]
+        self.assertEqual(os.path.abspath(self.repo_dir), git_log['args']['cwd'])
+        self.assertEqual(0, git_log['args']['rc'])
+        self.assertGreater(git_log['args']['stdout_bytes'], 0)
+        scan = events[-1]
+        self.assertLessEqual(scan['ts'], git_log['ts'])
+        self.assertGreaterEqual(scan['ts'] + scan['dur'], git_log['ts'] + git_log['dur'])
+
+    def test_scan_trace_ends_spans_on_errors(self):
+        trace = os.path.join(self.root_dir, 'traces', 'failed_scan.json')
+        sub = self.init_scanner()
+        with mock.patch.object(sub, 'finish_scan', side_effect=RuntimeError('report failed')):
+            with self.assertRaises(RuntimeError):
+                sub.scan('main', self.repo_dir, fetch_first=False, trace=trace)
+        self.assertEqual(['git branch', 'list_branches', 'git for-each-ref', 'branch_refs', 'git log',
+                          'collect_commits', 'scan'], [event['name'] for event in self.read_trace(trace)])
+
+    def test_git_output_bytes(self):
+        tracer = scan_unmerged_branches.ScanTracer().start()
+        try:
+            self.assertRaises(AssertionError, scan_unmerged_branches.ScanTracer().start)
+            res = scan_unmerged_branches.git_exec('printf "\\303\\251t\\303\\251"')  # été, 5 bytes in utf-8
+        finally:
+            tracer.stop()
+        self.assertEqual(['été'], res.stdout)
+        self.assertEqual(5, [event for event in tracer.events if event['ph'] == 'X'][0]['args']['stdout_bytes'])
+
+    def test_scan_multiple_async_trace(self):
+        trace = os.path.join(self.root_dir, 'scan_multiple_async.json')
+        configs = [{'branch': target, 'repo_dir': self.repo_dir, 'fetch_first': False}
+                   for target in ('main', 'development')]
+        asyncio.run(scan_unmerged_branches.scan_multiple_async(configs, return_report=True, trace=trace))
+        events = self.read_trace(trace)
+        self.assertEqual(2, len([event for event in events if event['name'] == 'scan']))
+        self.assertEqual(6, len([event for event in events if event['cat'] == 'git']))
+
+
+class TestNdjsonReports(TestSyntheticRepoBase):
+
+    def configs(self):
+        return [{'branch': target, 'repo_dir': self.repo_dir, 'fetch_first': False}
+                for target in ('main', 'development', 'NotExistBranch')]
+
+    def expected_records(self):
+        records = []
+        for result in self.execute_code_scan_multiple(self.configs()):
+            for branch, commits_by_author in result['report'].items():
+                records.append({'repo_dir': result['repo_dir'], 'target_branch': result['branch'],
+                                'branch': branch, 'commits_by_author': commits_by_author})
+        return records
+
+    def read_records(self, output):
+        with open(output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_scan_multiple_ndjson(self):
+        output = os.path.join(self.root_dir, 'reports', 'scan.ndjson')
+        rc = scan_unmerged_branches.scan_multiple(self.configs(), format='ndjson', output=output, jobs=2)
+        self.assertEqual(0, rc)
+        self.assertEqual(self.expected_records(), self.read_records(output))
+
+    def test_scan_multiple_async_ndjson(self):
+        output = os.path.join(self.root_dir, 'scan_async.ndjson')
+        rc = asyncio.run(scan_unmerged_branches.scan_multiple_async(self.configs(), format='ndjson', output=output))
+        self.assertEqual(0, rc)
+        self.assertEqual(self.expected_records(), self.read_records(output))
+
+    def test_scan_ndjson(self):
+        output = os.path.join(self.root_dir, 'scan_main.jsonl')
+        rc = scan_unmerged_branches.scan('main', self.repo_dir, fetch_first=False, format='ndjson', output=output)
+        self.assertEqual(0, rc)
+        self.assertEqual([record for record in self.expected_records() if record['target_branch'] == 'main'],
+                         self.read_records(output))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(dir=test_temp_dir, prefix='benchmark.')
+        self.addCleanup(shutil.rmtree, self.root_dir, ignore_errors=True)
+
+    def test_synthetic_workspace(self):
+        workspace, repo_names = benchmark_branch_scanning.create_workspace(
+            self.root_dir, n_repos=2, n_branches=5, n_commits=3, n_authors=2, max_age_days=60)
+        self.assertEqual(['repo-0', 'repo-1'], repo_names)
+        sub = scan_unmerged_branches.ScanUnmergedBranches()
+        branches = sub.get_list_of_unmerged_branches('main', os.path.join(workspace, 'repo-1'))
+        self.assertEqual(5, len(branches))
+        result = benchmark_branch_scanning.run_benchmark(
+            'scan_multiple', workspace, repo_names, {'fetch_first': False})
+        self.assertEqual(6, result['git_processes'])  # branch -r, for-each-ref and log for each repo
+        self.assertEqual('git_exec', scan_unmerged_branches.git_exec.__name__)  # restored after counting
+        with mock.patch.object(benchmark_branch_scanning, 'resource', None):  # as on windows
+            result = benchmark_branch_scanning.run_benchmark(
+                'scan_multiple_async', workspace, repo_names, {'fetch_first': False})
+        self.assertEqual(6, result['git_processes'])
+        self.assertNotIn('peak_rss_kb', result)
+        self.assertEqual('git_exec_async', scan_unmerged_branches.git_exec_async.__name__)
+
+    def test_aggregation(self):
+        result = benchmark_branch_scanning.benchmark_aggregation(2000, repeat=1)
+        self.assertEqual(2000, result['branches'])
+        self.assertTrue(result['identical'])
+
+    def test_compare_results(self):
+        params = {'repos': 1}
+        baseline = {'params': params, 'benchmarks': {'scan': {'wall_time': 1.0, 'git_processes': 3}}}
+        results = {'params': params, 'benchmarks': {'scan': {'wall_time': 1.2, 'git_processes': 3}}}
+        self.assertEqual([], benchmark_branch_scanning.compare_results(results, baseline, 0.25))
+        results['benchmarks']['scan'] = {'wall_time': 1.5, 'git_processes': 4}
+        self.assertEqual(2, len(benchmark_branch_scanning.compare_results(results, baseline, 0.25)))
+
+
 class TestValidators(unittest.TestCase):
 
     def test_branch_valid(self):